@@ -0,0 +1,405 @@
+import collections
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import click
+import numpy as np
+import rasterio
+import rasterio.shutil
+from eodatasets3.images import GridSpec
+from eodatasets3.serialise import to_path
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
+
+from wapor_v3_odc_products_py import prepare_wapor_soil_moisture_aggregate_metadata
+from wapor_v3_odc_products_py.block_cache import open_raster
+from wapor_v3_odc_products_py.footprints import get_valid_mask
+from wapor_v3_odc_products_py.io import get_filesystem, is_s3_path
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.prepare_wapor_soil_moisture_metadata import get_dataset_id
+from wapor_v3_odc_products_py.retile import COG_PROFILE
+from wapor_v3_odc_products_py.stac import write_stac_item
+from wapor_v3_odc_products_py.tasks import (
+    get_product_tasks,
+    get_task_id,
+    write_tasks_file,
+)
+from wapor_v3_odc_products_py.utils import get_dekad
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+AGGREGATION_PERIODS = ["monthly", "annual", "monthly_climatology"]
+
+# Code of each aggregation period in the aggregate codes e.g. WAPOR-3.L2-RSM-M.2020-01
+PERIOD_CODES = {"monthly": "M", "annual": "A", "monthly_climatology": "LTM"}
+
+# Aggregated products prepared from each source product
+AGGREGATED_PRODUCTS = {"wapor_soil_moisture": "wapor_soil_moisture_{period}"}
+
+# Size in pixels of the windows the rasters are aggregated by, a multiple of the
+# COG block size. Memory use is about 10 bytes per pixel of a window per worker.
+WINDOW_SIZE = 2048
+
+# Creation options of the intermediate tiled GeoTIFFs the windows are written to,
+# as the COG driver can only write a complete raster.
+STAGING_PROFILE = {
+    "driver": "GTiff",
+    "tiled": True,
+    "blockxsize": 512,
+    "blockysize": 512,
+    "compress": "DEFLATE",
+    "BIGTIFF": "IF_SAFER",
+}
+
+
+def get_period_key(raster_code: str, period: str) -> str:
+    """
+    Get the key of the aggregation period a dekadal raster belongs to
+    e.g. 2020-01 for monthly, 2020 for annual and 01 for monthly climatology.
+    """
+    year, month, _ = raster_code.split(".")[-1].split("-")
+    if period == "monthly":
+        return f"{year}-{month}"
+    elif period == "annual":
+        return year
+    elif period == "monthly_climatology":
+        return month
+    raise ValueError(f"Unknown aggregation period {period}")
+
+
+def get_aggregate_code(raster_code: str, period: str, period_key: str) -> str:
+    """
+    Get the code of an aggregate from the code of one of its dekadal rasters
+    e.g. WAPOR-3.L2-RSM-D.2020-01-D1 to WAPOR-3.L2-RSM-M.2020-01 for monthly.
+    """
+    mapset_prefix = raster_code.rsplit(".", 1)[0].rsplit("-", 1)[0]
+    return f"{mapset_prefix}-{PERIOD_CODES[period]}.{period_key}"
+
+
+def group_rasters_by_period(rasters: list[str], period: str) -> dict[str, list[str]]:
+    """Group dekadal rasters by the key of the aggregation period they belong to."""
+    groups = collections.defaultdict(list)
+    for raster in sorted(rasters, key=get_task_id):
+        groups[get_period_key(get_task_id(raster), period)].append(raster)
+    return dict(groups)
+
+
+def get_datetime_range(rasters: list[str]) -> tuple[datetime, datetime]:
+    """Get the start and end datetimes spanned by dekadal rasters."""
+    time_ranges = [get_dekad(*get_task_id(i).split(".")[-1].split("-"))[1] for i in rasters]
+    return min(i[0] for i in time_ranges), max(i[1] for i in time_ranges)
+
+
+def get_windows(shape: tuple[int, int], window_size: int) -> list[Window]:
+    """Split a raster grid into windows aligned to multiples of the window size."""
+    height, width = shape
+    return [
+        Window(
+            col_off=col_off,
+            row_off=row_off,
+            width=min(window_size, width - col_off),
+            height=min(window_size, height - row_off),
+        )
+        for row_off in range(0, height, window_size)
+        for col_off in range(0, width, window_size)
+    ]
+
+
+def accumulate_window(
+    sources: list[DatasetReader], window: Window
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Accumulate the sum and the count of the valid pixels of a window across rasters,
+    reading one raster at a time from the open `sources`.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The int32 sum, or float32 for floating point rasters, and int32 count of the
+        valid pixels of the window.
+    """
+    total, count = None, None
+    for src in sources:
+        array = src.read(1, window=window)
+        nodata = src.nodata
+        if total is None:
+            total_dtype = "float32" if np.issubdtype(array.dtype, np.floating) else "int32"
+            total = np.zeros(array.shape, dtype=total_dtype)
+            count = np.zeros(array.shape, dtype="int32")
+        valid = get_valid_mask(array, nodata)
+        np.add(total, array, out=total, where=valid)
+        count += valid
+    return total, count
+
+
+def get_mean(total: np.ndarray, count: np.ndarray, dtype: str, nodata: float | None) -> np.ndarray:
+    """Get the mean of the valid pixels from their sum and count, as the source dtype."""
+    fill = np.nan if nodata is None else nodata
+    mean = np.full(total.shape, fill, dtype=dtype)
+    valid = count > 0
+    values = total[valid] / count[valid]
+    if not np.issubdtype(np.dtype(dtype), np.floating):
+        values = np.rint(values)
+    mean[valid] = values.astype(dtype)
+    return mean
+
+
+def write_cog_from_staging(staging_path: str, output_path: str):
+    """Convert a tiled GeoTIFF into a COG written to a local file or S3."""
+    creation_options = {k: v for k, v in COG_PROFILE.items() if k != "driver"}
+    if is_s3_path(output_path):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cog_path = os.path.join(tmp_dir, os.path.basename(output_path))
+            rasterio.shutil.copy(staging_path, cog_path, driver="COG", **creation_options)
+            get_filesystem(path=output_path, anon=False).put(cog_path, output_path)
+    else:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        rasterio.shutil.copy(staging_path, output_path, driver="COG", **creation_options)
+
+
+def aggregate_period(
+    rasters: list[str],
+    source_product_name: str,
+    period: str,
+    period_key: str,
+    product_yaml: str | Path,
+    output_dir: str,
+    metadata_output_dir: str = None,
+    window_size: int = WINDOW_SIZE,
+    max_workers: int = 4,
+) -> str:
+    """
+    Aggregate the dekadal rasters of a period into the mean and the number of valid
+    dekads of each pixel, write them as COGs and write the aggregate's dataset doc
+    and stac item.
+
+    The rasters are streamed window by window, so memory use is bounded by the window
+    size and the number of workers, not by the size of the rasters.
+
+    :return: The code of the aggregate.
+    """
+    aggregate_code = get_aggregate_code(get_task_id(rasters[0]), period, period_key)
+    logger.info(f"Aggregating {len(rasters)} rasters into {aggregate_code}")
+
+    with open_raster(rasters[0]) as src:
+        profile = src.profile
+        scales, offsets = src.scales, src.offsets
+    for raster in rasters[1:]:
+        with open_raster(raster) as src:
+            if src.transform != profile["transform"] or src.shape != (
+                profile["height"],
+                profile["width"],
+            ):
+                raise ValueError(f"{raster} is not on the same grid as {rasters[0]}")
+
+    dtype, nodata = profile["dtype"], profile["nodata"]
+    base_profile = {
+        **STAGING_PROFILE,
+        "width": profile["width"],
+        "height": profile["height"],
+        "count": 1,
+        "crs": profile["crs"],
+        "transform": profile["transform"],
+    }
+    aggregate_dir = os.path.join(output_dir, aggregate_code)
+    measurement_paths = {
+        "relative_soil_moisture": os.path.join(
+            aggregate_dir, f"{aggregate_code}_relative_soil_moisture.tif"
+        ),
+        "count": os.path.join(aggregate_dir, f"{aggregate_code}_count.tif"),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mean_staging = os.path.join(tmp_dir, "relative_soil_moisture.tif")
+        count_staging = os.path.join(tmp_dir, "count.tif")
+        write_lock = threading.Lock()
+        # Each worker thread opens the rasters once and reads all its windows from them,
+        # as datasets can't be shared between threads
+        thread_sources = threading.local()
+        opened = []
+
+        def get_sources() -> list[DatasetReader]:
+            if not hasattr(thread_sources, "sources"):
+                thread_sources.sources = []
+                with write_lock:
+                    opened.append(thread_sources.sources)
+                for raster in rasters:
+                    thread_sources.sources.append(open_raster(raster))
+            return thread_sources.sources
+
+        with (
+            rasterio.open(mean_staging, "w", **base_profile, dtype=dtype, nodata=nodata) as mean_ds,
+            rasterio.open(count_staging, "w", **base_profile, dtype="uint8", nodata=0) as count_ds,
+        ):
+            mean_ds.scales, mean_ds.offsets = scales, offsets
+
+            def aggregate_window(window: Window):
+                total, count = accumulate_window(get_sources(), window)
+                mean = get_mean(total, count, dtype, nodata)
+                # Datasets opened for writing can not be written to concurrently
+                with write_lock:
+                    mean_ds.write(mean, 1, window=window)
+                    count_ds.write(np.minimum(count, 255).astype("uint8"), 1, window=window)
+
+            windows = get_windows((profile["height"], profile["width"]), window_size)
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    # Consume the results to raise the first error
+                    list(executor.map(aggregate_window, windows))
+            finally:
+                for sources in opened:
+                    for src in sources:
+                        src.close()
+
+        write_cog_from_staging(mean_staging, measurement_paths["relative_soil_moisture"])
+        write_cog_from_staging(count_staging, measurement_paths["count"])
+
+    if metadata_output_dir is not None:
+        metadata_output_path = Path(
+            os.path.join(metadata_output_dir, f"{aggregate_code}.odc-metadata.yaml")
+        )
+        output_path = metadata_output_path
+    else:
+        metadata_output_path = None
+        output_path = Path(os.path.join("/tmp", f"{aggregate_code}.odc-metadata.yaml"))
+
+    dataset_doc = prepare_wapor_soil_moisture_aggregate_metadata.prepare_dataset(
+        dataset_path=aggregate_dir,
+        product_yaml=product_yaml,
+        aggregate_code=aggregate_code,
+        measurement_paths=measurement_paths,
+        datetime_range=get_datetime_range(rasters),
+        source_dataset_ids=[get_dataset_id(get_task_id(i), source_product_name) for i in rasters],
+        output_path=output_path,
+        grid=GridSpec(
+            shape=(profile["height"], profile["width"]),
+            transform=profile["transform"],
+            crs=profile["crs"],
+        ),
+        processed=datetime.now(timezone.utc),
+        properties={"wapor:source_count": len(rasters)},
+    )
+
+    if metadata_output_path is not None:
+        to_path(metadata_output_path, dataset_doc)
+        logger.info(f"Wrote dataset to {metadata_output_path}")
+
+    write_stac_item(dataset_doc, os.path.join(aggregate_dir, f"{aggregate_code}.stac-item.json"))
+    return aggregate_code
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the dekadal product to aggregate",
+)
+@click.option(
+    "--period",
+    type=click.Choice(AGGREGATION_PERIODS),
+    default="monthly",
+    help="Period to aggregate the dekadal rasters over",
+)
+@click.option(
+    "--product-yaml",
+    type=click.Path(),
+    help="File path to the product definition yaml file of the aggregated product",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(),
+    help="Local directory or S3 prefix to write the aggregate COGs and stac files to",
+)
+@click.option(
+    "--metadata-output-dir",
+    type=click.Path(),
+    default=None,
+    help="Directory to write the metadata docs to",
+)
+@click.option(
+    "--tasks-file",
+    type=click.Path(),
+    default=None,
+    help="File listing the rasters to aggregate, as written by `create-tasks`",
+)
+@click.option(
+    "--window-size",
+    type=int,
+    default=WINDOW_SIZE,
+    help="Size in pixels of the windows the rasters are aggregated by",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=4,
+    help="Number of windows to aggregate concurrently",
+)
+def aggregate(
+    product_name: str,
+    period: str,
+    product_yaml: str,
+    output_dir: str,
+    metadata_output_dir: str,
+    tasks_file: str,
+    window_size: int,
+    max_workers: int,
+):
+    if product_name not in AGGREGATED_PRODUCTS:
+        raise NotImplementedError(f"Aggregation has not been implemented for {product_name}")
+
+    if isinstance(metadata_output_dir, str):
+        if is_s3_path(metadata_output_dir):
+            raise RuntimeError("Metadata files require to be written to a local directory")
+        else:
+            metadata_output_dir = Path(metadata_output_dir).resolve()
+            metadata_output_dir.mkdir(parents=True, exist_ok=True)
+
+    if isinstance(product_yaml, str) and not is_s3_path(product_yaml):
+        product_yaml = Path(product_yaml).resolve()
+    if not is_s3_path(output_dir):
+        output_dir = str(Path(output_dir).resolve())
+
+    rasters = get_product_tasks(product_name=product_name, tasks_file=tasks_file)
+    # Use a gsutil URI instead of the the public URL
+    rasters = [i.replace("https://storage.googleapis.com/", "gs://") for i in rasters]
+
+    groups = group_rasters_by_period(rasters, period)
+    logger.info(
+        f"Aggregating {len(rasters)} rasters into {len(groups)} "
+        f"{AGGREGATED_PRODUCTS[product_name].format(period=period)} datasets"
+    )
+
+    failed_tasks = []
+    for idx, (period_key, period_rasters) in enumerate(groups.items()):
+        logger.info(f"Aggregating period {period_key} {idx+1}/{len(groups)}")
+        try:
+            aggregate_period(
+                rasters=period_rasters,
+                source_product_name=product_name,
+                period=period,
+                period_key=period_key,
+                product_yaml=product_yaml,
+                output_dir=output_dir,
+                metadata_output_dir=metadata_output_dir,
+                window_size=window_size,
+                max_workers=max_workers,
+            )
+        except Exception as error:
+            logger.exception(error)
+            logger.error(f"Failed to aggregate period {period_key}")
+            failed_tasks.extend(period_rasters)
+
+    if failed_tasks:
+        failed_tasks_file = os.path.join(
+            output_dir, f"{product_name}_{period}_aggregate_failed_tasks"
+        )
+        write_tasks_file(failed_tasks, failed_tasks_file)
+        logger.info(f"{len(failed_tasks)} failed tasks written to {failed_tasks_file}")
+
+
+if __name__ == "__main__":
+    aggregate()
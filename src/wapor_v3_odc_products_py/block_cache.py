@@ -0,0 +1,354 @@
+import functools
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import rasterio
+from rasterio.abc import FileContainer
+
+from wapor_v3_odc_products_py.io import (
+    get_file_version,
+    get_filesystem,
+    get_remote_filesystem,
+    is_gcsfs_path,
+    is_s3_path,
+    is_url,
+    resolve_mirror_path,
+)
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.throttle import call_throttled, get_host
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Environment variables enabling the block cache for every process on a node
+CACHE_DIR_ENV = "WAPOR_BLOCK_CACHE_DIR"
+CACHE_MAX_MB_ENV = "WAPOR_BLOCK_CACHE_MAX_MB"
+DEFAULT_CACHE_MAX_MB = 10240
+
+# Size of the byte ranges cached. Large enough to hold a COG header, small
+# enough that reading one compressed tile doesn't fetch much more than the tile.
+BLOCK_SIZE = 2**18
+
+# Seconds the size and version of a remote file are trusted before being checked again
+FILE_INFO_TTL_SECONDS = 3600
+
+# Fraction of the maximum size the cache is evicted down to once it is full, so
+# eviction doesn't run on every new block
+EVICTION_TARGET = 0.9
+
+# Seconds between writes of the blocks read to the index, which are otherwise
+# batched until the file they were read from is closed
+ACCESS_FLUSH_SECONDS = 10
+
+
+def is_remote_path(path: str) -> bool:
+    return is_s3_path(path) or is_gcsfs_path(path) or is_url(path)
+
+
+class BlockCache:
+    """
+    Persistent cache of fixed size blocks of remote files, bounded in size with least
+    recently used blocks evicted first.
+
+    Blocks are stored as files under `cache_dir` and tracked in a SQLite index in the
+    same directory, so the cache is shared by every process and thread on a node.
+    Blocks are keyed by the file version, so a rewritten file is never served stale
+    blocks once its version is checked again.
+
+    The blocks read are recorded in the index in batches, when the file they were read
+    from is closed or every ACCESS_FLUSH_SECONDS, so reads of cached blocks don't touch
+    the index. The index keeps a running total of the size of the blocks, maintained by
+    triggers, so checking whether the cache is full doesn't scan every block.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, block_size: int = BLOCK_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.opener = BlockCacheOpener(self)
+        self._lock = threading.Lock()
+        self._accessed = {}
+        self._flushed = time.time()
+        (self.cache_dir / "tmp").mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, version TEXT, checked REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS blocks ("
+                "key TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS blocks_accessed ON blocks (accessed)")
+            # Seed the total from the blocks of a cache created before it was kept
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS total ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO total SELECT 0, COALESCE(SUM(size), 0) FROM blocks"
+            )
+            connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS blocks_insert AFTER INSERT ON blocks "
+                "BEGIN UPDATE total SET size = size + NEW.size; END"
+            )
+            connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS blocks_delete AFTER DELETE ON blocks "
+                "BEGIN UPDATE total SET size = size - OLD.size; END"
+            )
+            connection.execute("COMMIT")
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call, as connections can't be shared between threads
+        connection = sqlite3.connect(self.cache_dir / "index.db", timeout=60, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _get_block_path(self, key: str) -> Path:
+        return self.cache_dir / "blocks" / key[:2] / key
+
+    def get_file_info(self, path: str) -> tuple[int, str] | None:
+        """
+        Get the size and version of a remote file, or None if it doesn't exist. Both are
+        cached for FILE_INFO_TTL_SECONDS, including whether the file exists.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT size, version, checked FROM files WHERE path = ?", (path,)
+            ).fetchone()
+        if row is not None and time.time() - row[2] < FILE_INFO_TTL_SECONDS:
+            return None if row[0] < 0 else (row[0], row[1])
+
+        fs = get_remote_filesystem(path)
+        try:
+            info = call_throttled(get_host(path), fs.info, path)
+            size, version = int(info["size"]), get_file_version(info)
+        except FileNotFoundError:
+            size, version = -1, ""
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (path, size, version, time.time()),
+            )
+        return None if size < 0 else (size, version)
+
+    def _read_block(self, key: str) -> bytes | None:
+        try:
+            return self._get_block_path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def _write_block(self, key: str, data: bytes):
+        block_path = self._get_block_path(key)
+        block_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so other processes never read a partial block
+        tmp_path = self.cache_dir / "tmp" / uuid.uuid4().hex
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, block_path)
+
+    def read_range(self, path: str, version: str, size: int, start: int, end: int) -> bytes:
+        """Read the bytes `[start, end)` of a remote file, fetching only uncached blocks."""
+        end = min(end, size)
+        if start >= end:
+            return b""
+        file_key = hashlib.sha256(f"{path}\0{version}".encode()).hexdigest()
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        keys = {index: f"{file_key}-{index}" for index in range(first, last + 1)}
+
+        blocks = {index: self._read_block(key) for index, key in keys.items()}
+        missing = [index for index, data in blocks.items() if data is None]
+
+        # Fetch each run of consecutive missing blocks in a single request
+        runs = []
+        for index in missing:
+            if runs and runs[-1][-1] == index - 1:
+                runs[-1].append(index)
+            else:
+                runs.append([index])
+        fs = get_remote_filesystem(path)
+        for run in runs:
+            run_start = run[0] * self.block_size
+            run_end = min((run[-1] + 1) * self.block_size, size)
+            data = call_throttled(get_host(path), fs.cat_file, path, start=run_start, end=run_end)
+            for index in run:
+                offset = (index - run[0]) * self.block_size
+                blocks[index] = data[offset : offset + self.block_size]
+                self._write_block(keys[index], blocks[index])
+
+        now = time.time()
+        with self._lock:
+            for index, key in keys.items():
+                self._accessed[key] = (len(blocks[index]), now)
+            flush = now - self._flushed >= ACCESS_FLUSH_SECONDS
+        if flush:
+            self.flush()
+
+        data = b"".join(blocks[index] for index in range(first, last + 1))
+        offset = first * self.block_size
+        return data[start - offset : end - offset]
+
+    def flush(self):
+        """Record the blocks read since the last flush in the index, evicting if it's full."""
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+            self._flushed = time.time()
+        if not accessed:
+            return
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT INTO blocks VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET accessed = MAX(accessed, excluded.accessed)",
+                [(key, size, accessed_time) for key, (size, accessed_time) in accessed.items()],
+            )
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used blocks once the cache exceeds its maximum size."""
+        with self._connect() as connection:
+            total = connection.execute("SELECT size FROM total").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            target = total - int(self.max_bytes * EVICTION_TARGET)
+            for key, size in connection.execute("SELECT key, size FROM blocks ORDER BY accessed"):
+                if target <= 0:
+                    break
+                evicted.append(key)
+                target -= size
+            connection.executemany("DELETE FROM blocks WHERE key = ?", [(i,) for i in evicted])
+        for key in evicted:
+            self._get_block_path(key).unlink(missing_ok=True)
+        logger.debug(f"Evicted {len(evicted)} blocks from the block cache")
+
+    def open(self, path: str) -> "CachedFile":
+        """Open a remote file for reading through the cache."""
+        info = self.get_file_info(path)
+        if info is None:
+            raise FileNotFoundError(path)
+        return CachedFile(self, path, *info)
+
+
+class CachedFile(io.RawIOBase):
+    """Read only, seekable file object reading a remote file through a BlockCache."""
+
+    def __init__(self, cache: BlockCache, path: str, size: int, version: str):
+        self.cache = cache
+        self.path = path
+        self.size = size
+        self.version = version
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        data = self.cache.read_range(
+            self.path, self.version, self.size, self._position, self._position + len(buffer)
+        )
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.cache.flush()
+        super().close()
+
+
+class BlockCacheOpener(FileContainer):
+    """rasterio opener serving GDAL's reads of remote files from a BlockCache."""
+
+    def __init__(self, cache: BlockCache):
+        self.cache = cache
+
+    def open(self, path: str, mode: str = "r", **kwds):
+        return self.cache.open(path)
+
+    def isfile(self, path: str) -> bool:
+        return self.cache.get_file_info(path) is not None
+
+    def isdir(self, path: str) -> bool:
+        return False
+
+    def ls(self, path: str) -> list[str]:
+        return []
+
+    def mtime(self, path: str) -> int:
+        return 0
+
+    def size(self, path: str) -> int:
+        info = self.cache.get_file_info(path)
+        if info is None:
+            raise FileNotFoundError(path)
+        return info[0]
+
+    def rm(self, path: str):
+        raise PermissionError("The block cache is read only")
+
+
+@functools.lru_cache(maxsize=None)
+def get_block_cache() -> BlockCache | None:
+    """
+    Get the block cache of the node, enabled by setting WAPOR_BLOCK_CACHE_DIR and
+    bounded to WAPOR_BLOCK_CACHE_MAX_MB, or None if it isn't enabled.
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    max_mb = float(os.environ.get(CACHE_MAX_MB_ENV, DEFAULT_CACHE_MAX_MB))
+    logger.info(f"Caching remote raster reads in {cache_dir} up to {max_mb:.0f} MB")
+    return BlockCache(cache_dir, int(max_mb * 2**20))
+
+
+def open_raster(file_path: str | Path, **kwargs):
+    """
+    Open a raster with rasterio, preferring its mirrored copy and reading remote
+    rasters through the block cache.
+    """
+    file_path = resolve_mirror_path(file_path)
+    cache = get_block_cache()
+    if cache is not None and is_remote_path(str(file_path)):
+        return rasterio.open(str(file_path), opener=cache.opener, **kwargs)
+    return rasterio.open(file_path, **kwargs)
+
+
+def open_file(file_path: str, **kwargs):
+    """
+    Open a file with fsspec for reading, preferring its mirrored copy and reading
+    remote files through the block cache.
+    """
+    file_path = resolve_mirror_path(file_path)
+    cache = get_block_cache()
+    if cache is not None and is_remote_path(file_path):
+        return cache.open(file_path)
+    fs = get_filesystem(path=file_path, anon=True)
+    return fs.open(file_path, "rb", **kwargs)
@@ -0,0 +1,302 @@
+import csv
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import click
+import pystac
+import yaml
+from datacube import Datacube
+from datacube.cfg import ODCConfig
+from datacube.index.eo3 import prep_eo3
+from datacube.metadata import stac2ds
+from datacube.model import Product
+from datacube.utils.serialise import jsonify_document
+from datacube.utils.uris import split_uri
+from psycopg2.pool import ThreadedConnectionPool
+
+from wapor_v3_odc_products_py.explorer import (
+    get_period,
+    new_touched_periods,
+    record_touched_periods,
+)
+from wapor_v3_odc_products_py.io import get_filesystem, is_gcsfs_path, is_s3_path
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.throttle import call_throttled, get_host
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+DATASET_DOC_SUFFIXES = (".stac-item.json", ".odc-metadata.yaml")
+
+# Staging tables are temporary, so each pooled connection has its own, and are
+# emptied at the end of each transaction.
+CREATE_STAGING_TABLES = """
+CREATE TEMPORARY TABLE IF NOT EXISTS staging_dataset (
+    id uuid,
+    metadata_type_ref smallint,
+    dataset_type_ref smallint,
+    metadata jsonb
+) ON COMMIT DELETE ROWS;
+CREATE TEMPORARY TABLE IF NOT EXISTS staging_dataset_location (
+    dataset_ref uuid,
+    uri_scheme varchar,
+    uri_body varchar
+) ON COMMIT DELETE ROWS;
+CREATE TEMPORARY TABLE IF NOT EXISTS staging_dataset_source (
+    dataset_ref uuid,
+    classifier varchar,
+    source_dataset_ref uuid
+) ON COMMIT DELETE ROWS;
+"""
+
+INSERT_DATASETS = """
+INSERT INTO agdc.dataset (id, metadata_type_ref, dataset_type_ref, metadata)
+SELECT DISTINCT ON (id) id, metadata_type_ref, dataset_type_ref, metadata
+FROM staging_dataset
+ON CONFLICT (id) DO NOTHING
+RETURNING metadata #>> '{properties,datetime}'
+"""
+
+INSERT_DATASET_LOCATIONS = """
+INSERT INTO agdc.dataset_location (dataset_ref, uri_scheme, uri_body)
+SELECT DISTINCT dataset_ref, uri_scheme, uri_body
+FROM staging_dataset_location
+ON CONFLICT (uri_scheme, uri_body, dataset_ref) DO NOTHING
+"""
+
+# Lineage is only recorded for source datasets that are already indexed, as the
+# foreign key on source_dataset_ref would otherwise reject the whole batch.
+INSERT_DATASET_SOURCES = """
+INSERT INTO agdc.dataset_source (dataset_ref, classifier, source_dataset_ref)
+SELECT DISTINCT staging.dataset_ref, staging.classifier, staging.source_dataset_ref
+FROM staging_dataset_source AS staging
+JOIN agdc.dataset AS source ON source.id = staging.source_dataset_ref
+ON CONFLICT (dataset_ref, classifier) DO NOTHING
+"""
+
+
+def get_db_url(env: str = None) -> str:
+    """
+    Get the URL of the ODC database of an ODC environment, in the form accepted
+    by psycopg2.
+    """
+    db_url = ODCConfig()[env].db_url
+    # Drop the SQLAlchemy driver, e.g. postgresql+psycopg2://
+    scheme, rest = db_url.split("://", 1)
+    return f"{scheme.split('+')[0]}://{rest}"
+
+
+def find_dataset_docs(directory_path: str) -> list[str]:
+    """Find the stac items and eo3 dataset documents in a directory."""
+    fs = get_filesystem(path=directory_path, anon=False)
+
+    dataset_doc_paths = []
+    for root, dirs, files in call_throttled(
+        get_host(directory_path), lambda: list(fs.walk(directory_path))
+    ):
+        for file_name in files:
+            if file_name.endswith(DATASET_DOC_SUFFIXES):
+                dataset_doc_paths.append(os.path.join(root, file_name))
+
+    if is_s3_path(path=directory_path):
+        dataset_doc_paths = [f"s3://{file}" for file in dataset_doc_paths]
+    if is_gcsfs_path(path=directory_path):
+        dataset_doc_paths = [f"gs://{file}" for file in dataset_doc_paths]
+    return sorted(dataset_doc_paths)
+
+
+def get_uri(path: str) -> str:
+    """Get the URI a dataset document is indexed with."""
+    if is_s3_path(path) or is_gcsfs_path(path):
+        return path
+    return Path(path).resolve().as_uri()
+
+
+def read_dataset_doc(path: str, product: Product) -> tuple[dict, list[tuple[str, str]]]:
+    """
+    Read a stac item or an eo3 dataset document of a product into the metadata stored
+    in the index, without the per document database queries of `Doc2Dataset`.
+
+    Returns
+    -------
+    tuple[dict, list[tuple[str, str]]]
+        The prepared eo3 metadata without lineage and the classifier and id of each
+        source dataset.
+    """
+    fs = get_filesystem(path=path, anon=False)
+    with call_throttled(get_host(path), fs.open, path, "r") as file:
+        doc = json.load(file) if path.endswith(".json") else yaml.safe_load(file)
+
+    if doc.get("type") == "Feature":
+        item = pystac.Item.from_dict(doc)
+        doc = next(stac2ds([item], product_cache={product.name: product})).metadata_doc
+    else:
+        doc = prep_eo3(doc)
+    if doc.get("product", {}).get("name") != product.name:
+        raise ValueError(f"{path} is not a dataset of the product {product.name}")
+
+    lineage = doc.get("lineage", {})
+    sources = [
+        (classifier, source["id"])
+        for classifier, source in lineage.get("source_datasets", {}).items()
+    ]
+    # Lineage is stored in the dataset_source table, as `Dataset.metadata_doc_without_lineage`
+    doc["lineage"] = {"source_datasets": {}} if "source_datasets" in lineage else {}
+    return doc, sources
+
+
+def get_staging_rows(
+    product: Product, paths: list[str]
+) -> tuple[list[tuple], list[tuple], list[tuple], list[str]]:
+    """
+    Read a batch of dataset documents into the rows of the dataset, dataset location
+    and dataset source staging tables.
+
+    Returns
+    -------
+    tuple[list[tuple], list[tuple], list[tuple], list[str]]
+        The rows of each staging table and the documents that could not be read.
+    """
+    dataset_rows, location_rows, source_rows, failed = [], [], [], []
+    for path in paths:
+        try:
+            doc, sources = read_dataset_doc(path, product)
+        except Exception as error:
+            logger.error(f"Failed to read {path}: {error}")
+            failed.append(path)
+            continue
+        dataset_rows.append(
+            (doc["id"], product.metadata_type.id, product.id, json.dumps(jsonify_document(doc)))
+        )
+        location_rows.append((doc["id"], *split_uri(get_uri(path))))
+        source_rows.extend((doc["id"], classifier, source) for classifier, source in sources)
+    return dataset_rows, location_rows, source_rows, failed
+
+
+def copy_rows(cursor, table: str, rows: list):
+    """Stream rows into a table with COPY."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def load_batch(
+    pool: ThreadedConnectionPool, product: Product, paths: list[str]
+) -> tuple[list[str], list[str]]:
+    """
+    Load a batch of dataset documents into the index in one transaction: COPY the
+    batch into the staging tables, then insert it with one set based insert per
+    table, skipping the datasets and locations already indexed.
+
+    Returns
+    -------
+    tuple[list[str], list[str]]
+        The datetimes of the datasets added and the documents that could not be read.
+    """
+    dataset_rows, location_rows, source_rows, failed = get_staging_rows(product, paths)
+    if not dataset_rows:
+        return [], failed
+
+    connection = pool.getconn()
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(CREATE_STAGING_TABLES)
+                copy_rows(cursor, "staging_dataset", dataset_rows)
+                copy_rows(cursor, "staging_dataset_location", location_rows)
+                copy_rows(cursor, "staging_dataset_source", source_rows)
+                cursor.execute(INSERT_DATASETS)
+                added = [row[0] for row in cursor.fetchall()]
+                cursor.execute(INSERT_DATASET_LOCATIONS)
+                if source_rows:
+                    cursor.execute(INSERT_DATASET_SOURCES)
+    finally:
+        pool.putconn(connection)
+    return added, failed
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the product the dataset documents belong to",
+)
+@click.option(
+    "--dataset-docs-dir",
+    type=click.Path(),
+    help="Directory containing the stac items or eo3 dataset documents to index",
+)
+@click.option(
+    "--env",
+    default=None,
+    help="ODC environment of the index to load the datasets into",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=1000,
+    help="Number of datasets loaded into the index per transaction",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=4,
+    help="Number of workers loading batches in parallel, each with its own connection",
+)
+@click.option(
+    "--touched-periods-file",
+    type=click.Path(),
+    default=None,
+    help="File to record the months touched in, to only refresh their Explorer summaries",
+)
+def bulk_index(
+    product_name: str,
+    dataset_docs_dir: str,
+    env: str,
+    batch_size: int,
+    max_workers: int,
+    touched_periods_file: str,
+):
+    dc = Datacube(env=env, app="wapor-bulk-index")
+    if dc.index.name != "pg_index":
+        raise NotImplementedError("Bulk loading is only implemented for the postgres index driver")
+    product = dc.index.products.get_by_name_unsafe(product_name)
+
+    paths = find_dataset_docs(dataset_docs_dir)
+    batches = [paths[i : i + batch_size] for i in range(0, len(paths), batch_size)]
+    logger.info(f"Loading {len(paths)} dataset documents in {len(batches)} batches")
+
+    start = time.monotonic()
+    total_added, failed_docs = 0, []
+    touched = new_touched_periods()
+    pool = ThreadedConnectionPool(1, max_workers, get_db_url(env))
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(load_batch, pool, product, batch) for batch in batches]
+            for idx, future in enumerate(as_completed(futures)):
+                added, failed = future.result()
+                total_added += len(added)
+                failed_docs.extend(failed)
+                touched[product_name].update(get_period(i) for i in added if i)
+                logger.info(f"Loaded batch {idx+1}/{len(batches)}, {len(added)} datasets added")
+    finally:
+        pool.closeall()
+        if touched_periods_file:
+            record_touched_periods(touched_periods_file, touched)
+
+    minutes = (time.monotonic() - start) / 60
+    logger.info(
+        f"Added {total_added} datasets, skipped {len(paths) - len(failed_docs) - total_added} "
+        f"already indexed in {minutes:.2f} minutes "
+        f"({total_added / max(minutes, 1e-9):.0f} datasets per minute)"
+    )
+    if failed_docs:
+        raise RuntimeError(f"Failed to read {len(failed_docs)} dataset documents")
+
+
+if __name__ == "__main__":
+    bulk_index()
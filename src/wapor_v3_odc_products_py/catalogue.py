@@ -0,0 +1,149 @@
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from wapor_v3_odc_products_py.io import get_filesystem, is_gcsfs_path, is_s3_path
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.throttle import throttled_request
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Fields of the catalogue items used to list the rasters of a mapset
+DEFAULT_COLUMNS = ("code", "downloadUrl")
+
+
+class CatalogueListing:
+    """
+    Compact columnar listing of WaPOR v3 catalogue items.
+
+    Each column is a field of the items, stored as UTF-8 bytes in a fixed width field of
+    a NumPy structured array rather than as Python objects. A listing can be saved to a
+    `.npy` file and loaded back memory-mapped, so only the pages of the columns that are
+    read are loaded.
+    """
+
+    def __init__(self, array: np.ndarray):
+        self._array = array
+
+    @classmethod
+    def from_columns(cls, columns: dict[str, np.ndarray | list]) -> "CatalogueListing":
+        """Create a listing from equal length columns of strings or bytes."""
+        arrays = {}
+        for name, values in columns.items():
+            values = np.asarray(values)
+            if values.dtype.kind == "U":
+                values = np.char.encode(values, "utf-8")
+            # An empty column still needs a non zero width
+            arrays[name] = values if values.dtype.itemsize else values.astype("S1")
+        lengths = {len(values) for values in arrays.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+
+        array = np.empty(
+            lengths.pop() if lengths else 0,
+            dtype=[(name, values.dtype) for name, values in arrays.items()],
+        )
+        for name, values in arrays.items():
+            array[name] = values
+        return cls(array)
+
+    @classmethod
+    def concatenate(cls, listings: list["CatalogueListing"]) -> "CatalogueListing":
+        """Concatenate listings with the same columns, e.g. of several mapsets."""
+        columns = listings[0].columns
+        return cls.from_columns(
+            {name: np.concatenate([i._array[name] for i in listings]) for name in columns}
+        )
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "CatalogueListing":
+        """
+        Load a listing saved with `save`. Local files are memory-mapped unless `mmap`
+        is False, files in an object store are read into memory.
+        """
+        if is_s3_path(path) or is_gcsfs_path(path):
+            fs = get_filesystem(path=path, anon=True)
+            with fs.open(path, "rb") as file:
+                return cls(np.load(file, allow_pickle=False))
+        return cls(np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False))
+
+    def save(self, path: str):
+        """Save the listing to a `.npy` file on the local file system or in S3."""
+        fs = get_filesystem(path=path, anon=False)
+        if not is_s3_path(path) and not is_gcsfs_path(path):
+            fs.mkdirs(str(Path(path).parent), exist_ok=True)
+        with fs.open(path, "wb") as file:
+            np.save(file, self._array, allow_pickle=False)
+
+    @property
+    def columns(self) -> tuple[str]:
+        return self._array.dtype.names or ()
+
+    def __len__(self) -> int:
+        return len(self._array)
+
+    def get_column(self, name: str) -> list[str]:
+        """Get the values of a column as strings."""
+        return [value.decode("utf-8") for value in self._array[name]]
+
+    def sort(self, column: str) -> "CatalogueListing":
+        """Get the listing sorted by a column."""
+        # UTF-8 bytes sort in the same order as the strings they encode
+        return CatalogueListing(self._array[np.argsort(self._array[column], kind="stable")])
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame({name: self.get_column(name) for name in self.columns})
+
+
+def get_column_value(item: dict, column: str) -> str:
+    """
+    Get the value of a field of a catalogue item as a string. As in `get_WaPORv3_info`,
+    `links` is the first link of the item, and missing fields are empty.
+    """
+    value = item.get(column)
+    if column == "links" and value:
+        value = value[0]["href"]
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def get_catalogue_listing(url: str, columns: tuple[str] = DEFAULT_COLUMNS) -> CatalogueListing:
+    """
+    Get a listing of the WaPOR v3 catalogue items, e.g. the rasters of a mapset, with
+    only the fields in `columns`.
+
+    Each page of the response is parsed straight into columns of bytes, so at most one
+    page of items is held as Python objects however many items there are.
+
+    Parameters
+    ----------
+    url : str
+        URL to get the items from
+    columns : tuple[str]
+        Fields of the items to keep
+
+    Returns
+    -------
+    CatalogueListing
+        The listing of the items, in the order of the catalogue.
+    """
+    pages = {column: [] for column in columns}
+    next_url = url
+    while next_url:
+        response = throttled_request("GET", next_url)
+        response.raise_for_status()
+        data = response.json()["response"]
+        for column in columns:
+            values = [get_column_value(item, column).encode("utf-8") for item in data["items"]]
+            pages[column].append(np.array(values, dtype="S"))
+        next_url = next((i["href"] for i in data["links"] if i["rel"] == "next"), None)
+
+    listing = CatalogueListing.from_columns(
+        {column: np.concatenate(arrays) for column, arrays in pages.items()}
+    )
+    logger.debug(f"Listed {len(listing)} items from {url}")
+    return listing
@@ -0,0 +1,474 @@
+import asyncio
+import logging
+import random
+import re
+import struct
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import aiohttp
+from affine import Affine
+from eodatasets3.images import GridSpec
+from rasterio.crs import CRS
+
+from wapor_v3_odc_products_py.block_cache import open_file
+from wapor_v3_odc_products_py.io import is_gcsfs_path, is_url, resolve_mirror_path
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.plan import GDAL_INGESTED_BYTES_AT_OPEN, HEADER_BLOCK_SIZE
+from wapor_v3_odc_products_py.throttle import (
+    DEFAULT_RATE_LIMIT,
+    HOST_RATE_LIMITS,
+    REQUEST_TIMEOUT,
+    THROTTLING_STATUS_CODES,
+    get_host,
+)
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Number of headers read concurrently from a single event loop
+DEFAULT_MAX_CONCURRENCY = 256
+
+# Attempts made to read a header before giving up on transient errors
+MAX_ATTEMPTS = 5
+
+# TIFF field types: struct format and size in bytes of a value
+FIELD_TYPES = {
+    1: ("B", 1),  # BYTE
+    2: ("s", 1),  # ASCII
+    3: ("H", 2),  # SHORT
+    4: ("I", 4),  # LONG
+    5: ("II", 8),  # RATIONAL
+    6: ("b", 1),  # SBYTE
+    7: ("B", 1),  # UNDEFINED
+    8: ("h", 2),  # SSHORT
+    9: ("i", 4),  # SLONG
+    10: ("ii", 8),  # SRATIONAL
+    11: ("f", 4),  # FLOAT
+    12: ("d", 8),  # DOUBLE
+    16: ("Q", 8),  # LONG8
+    17: ("q", 8),  # SLONG8
+    18: ("Q", 8),  # IFD8
+}
+
+# TIFF and GeoTIFF tags read from each image file directory. The tile offsets and
+# byte counts, the largest tags of a COG header, are not needed so never read.
+TAGS = {
+    254: "subfile_type",
+    256: "width",
+    257: "height",
+    258: "bits_per_sample",
+    259: "compression",
+    277: "samples_per_pixel",
+    284: "planar_configuration",
+    317: "predictor",
+    322: "tile_width",
+    323: "tile_height",
+    339: "sample_format",
+    33550: "pixel_scale",
+    33922: "tiepoint",
+    34264: "transformation",
+    34735: "geo_keys",
+    42112: "gdal_metadata",
+    42113: "gdal_nodata",
+}
+
+# Names GDAL gives the TIFF compression schemes in its IMAGE_STRUCTURE metadata
+COMPRESSIONS = {
+    5: "LZW",
+    7: "JPEG",
+    8: "DEFLATE",
+    32773: "PACKBITS",
+    32946: "DEFLATE",
+    34887: "LERC",
+    50000: "ZSTD",
+    50001: "WEBP",
+    50002: "JXL",
+}
+
+SAMPLE_FORMATS = {1: "uint", 2: "int", 3: "float"}
+
+# GeoKeys
+GT_RASTER_TYPE = 1025
+GEOGRAPHIC_TYPE = 2048
+PROJECTED_CS_TYPE = 3072
+RASTER_PIXEL_IS_POINT = 2
+USER_DEFINED = 32767
+
+
+class NeedMoreBytes(Exception):
+    """Raised by the parser when it needs bytes of the file that haven't been read."""
+
+    def __init__(self, start: int, end: int):
+        super().__init__(start, end)
+        self.start = start
+        self.end = end
+
+
+class HeaderBytes:
+    """
+    Ranges of the bytes of a file read so far. The directories of a GeoTIFF whose
+    overviews were added after it was written are at the end of the file, so the
+    header is read as ranges rather than as one prefix of the file.
+    """
+
+    def __init__(self):
+        self._ranges = []
+
+    def add(self, start: int, data: bytes):
+        self._ranges.append((start, data))
+
+    def get(self, start: int, size: int) -> bytes:
+        for range_start, data in self._ranges:
+            if range_start <= start and start + size <= range_start + len(data):
+                return data[start - range_start : start - range_start + size]
+        raise NeedMoreBytes(start, start + size)
+
+    def unpack(self, fmt: str, offset: int) -> tuple:
+        return struct.unpack(fmt, self.get(offset, struct.calcsize(fmt)))
+
+
+class ImageFileDirectory(dict):
+    """Tags of one image of a TIFF, full resolution, overview or mask."""
+
+    @property
+    def is_overview(self) -> bool:
+        return bool(self.get("subfile_type", 0) & 1)
+
+    @property
+    def is_mask(self) -> bool:
+        return bool(self.get("subfile_type", 0) & 4)
+
+
+def _unpack_value(data: HeaderBytes, offset: int, byte_order: str, field_type: int, count: int):
+    fmt = FIELD_TYPES[field_type][0]
+    if field_type == 2:
+        return data.get(offset, count).decode("latin-1").rstrip("\x00")
+    values = data.unpack(f"{byte_order}{fmt[0] * len(fmt) * count}", offset)
+    if len(fmt) == 2:
+        values = tuple(values[i] / values[i + 1] for i in range(0, len(values), 2))
+    return values[0] if count == 1 else values
+
+
+def parse_tiff_header(data: HeaderBytes) -> list[ImageFileDirectory]:
+    """
+    Parse the image file directories of a classic or BigTIFF, only decoding the tags
+    in TAGS.
+
+    Raises NeedMoreBytes with the range of the file needed when it hasn't been read.
+    """
+    byte_order = {b"II": "<", b"MM": ">"}.get(data.get(0, 2))
+    if byte_order is None:
+        raise ValueError("Not a TIFF file")
+    version = data.unpack(f"{byte_order}H", 2)[0]
+    if version == 42:
+        count_fmt, entry_size, inline_size, offset_fmt = "H", 12, 4, "I"
+        next_offset = data.unpack(f"{byte_order}I", 4)[0]
+    elif version == 43:
+        count_fmt, entry_size, inline_size, offset_fmt = "Q", 20, 8, "Q"
+        next_offset = data.unpack(f"{byte_order}Q", 8)[0]
+    else:
+        raise ValueError(f"Unexpected TIFF version {version}")
+    count_size, offset_size = struct.calcsize(count_fmt), struct.calcsize(offset_fmt)
+    count_fmt, offset_fmt = f"{byte_order}{count_fmt}", f"{byte_order}{offset_fmt}"
+
+    directories, seen = [], set()
+    while next_offset and next_offset not in seen:
+        seen.add(next_offset)
+        entry_count = data.unpack(count_fmt, next_offset)[0]
+        entries_offset = next_offset + count_size
+        directory_end = entries_offset + entry_count * entry_size + offset_size
+        # Read the whole directory at once rather than one entry at a time
+        data.get(next_offset, directory_end - next_offset)
+
+        directory = ImageFileDirectory()
+        for idx in range(entry_count):
+            entry_offset = entries_offset + idx * entry_size
+            tag, field_type = data.unpack(f"{byte_order}HH", entry_offset)
+            if tag not in TAGS or field_type not in FIELD_TYPES:
+                continue
+            count = data.unpack(offset_fmt, entry_offset + 4)[0]
+            value_offset = entry_offset + 4 + offset_size
+            if FIELD_TYPES[field_type][1] * count > inline_size:
+                value_offset = data.unpack(offset_fmt, value_offset)[0]
+            directory[TAGS[tag]] = _unpack_value(data, value_offset, byte_order, field_type, count)
+        directories.append(directory)
+        next_offset = data.unpack(offset_fmt, directory_end - offset_size)[0]
+    return directories
+
+
+def _get_geo_keys(geo_keys: tuple) -> dict[int, int]:
+    # Keys stored in other tags (doubles and ASCII) are not needed to find an EPSG code
+    return {
+        geo_keys[i]: geo_keys[i + 3]
+        for i in range(4, 4 + 4 * geo_keys[3], 4)
+        if geo_keys[i + 1] == 0
+    }
+
+
+def _get_scale_offset(gdal_metadata: str | None) -> tuple[float, float]:
+    scale, offset = 1.0, 0.0
+    if not gdal_metadata:
+        return scale, offset
+    for item in ET.fromstring(gdal_metadata).iter("Item"):
+        if item.get("sample", "0") != "0":
+            continue
+        if item.get("role") == "scale":
+            scale = float(item.text)
+        elif item.get("role") == "offset":
+            offset = float(item.text)
+    return scale, offset
+
+
+class CogHeader:
+    """
+    Grid and storage parameters of a GeoTIFF decoded from its header, without GDAL.
+    Only EPSG coded coordinate reference systems are supported.
+    """
+
+    def __init__(self, directories: list[ImageFileDirectory]):
+        images = [i for i in directories if not i.is_mask]
+        self.image = images[0]
+        self.overviews = [i for i in images[1:] if i.is_overview]
+
+        geo_keys = _get_geo_keys(self.image.get("geo_keys", (1, 1, 0, 0)))
+        epsg = geo_keys.get(PROJECTED_CS_TYPE) or geo_keys.get(GEOGRAPHIC_TYPE)
+        if epsg is None or epsg == USER_DEFINED:
+            raise ValueError("The GeoTIFF does not have an EPSG coded CRS")
+        self.crs = CRS.from_epsg(epsg)
+
+        if "transformation" in self.image:
+            a, b, _, c, d, e, _, f = self.image["transformation"][:8]
+            transform = Affine(a, b, c, d, e, f)
+        else:
+            i, j, _, x, y, _ = self.image["tiepoint"][:6]
+            scale_x, scale_y = self.image["pixel_scale"][:2]
+            transform = Affine(scale_x, 0, x - i * scale_x, 0, -scale_y, y + j * scale_y)
+        # As GDAL does, the origin of a pixel is its corner rather than its centre
+        if geo_keys.get(GT_RASTER_TYPE) == RASTER_PIXEL_IS_POINT:
+            transform = transform * Affine.translation(-0.5, -0.5)
+        self.transform = transform
+
+        nodata = self.image.get("gdal_nodata")
+        self.nodata = float(nodata) if nodata else None
+        self.scale_factor, self.add_offset = _get_scale_offset(self.image.get("gdal_metadata"))
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.image["height"], self.image["width"]
+
+    @property
+    def grid(self) -> GridSpec:
+        return GridSpec(shape=self.shape, transform=self.transform, crs=self.crs)
+
+    @property
+    def count(self) -> int:
+        return self.image.get("samples_per_pixel", 1)
+
+    @property
+    def dtype(self) -> str:
+        bits = self.image.get("bits_per_sample", 8)
+        bits = bits[0] if isinstance(bits, tuple) else bits
+        sample_format = self.image.get("sample_format", 1)
+        sample_format = sample_format[0] if isinstance(sample_format, tuple) else sample_format
+        return f"{SAMPLE_FORMATS[sample_format]}{bits}"
+
+    @property
+    def block_shape(self) -> tuple[int, int] | None:
+        if "tile_width" not in self.image:
+            return None
+        return self.image["tile_height"], self.image["tile_width"]
+
+    @property
+    def overview_factors(self) -> list[int]:
+        return sorted(round(self.image["width"] / i["width"]) for i in self.overviews)
+
+    @property
+    def is_cog(self) -> bool:
+        """
+        Check if the GeoTIFF follows the Cloud Optimized GeoTIFF layout, i.e. it is
+        internally tiled and has overviews unless it fits in a single block.
+        """
+        if self.block_shape is None:
+            return False
+        block_y, block_x = self.block_shape
+        needs_overviews = self.image["width"] > block_x or self.image["height"] > block_y
+        return bool(self.overviews) or not needs_overviews
+
+    def get_storage_parameters(self) -> dict:
+        """
+        Get the storage parameters and the internal layout of the GeoTIFF, as
+        `get_raster_storage_parameters` reads them with GDAL.
+        """
+        res_x, res_y = self.transform.a, self.transform.e
+        block_y, block_x = self.block_shape or (1, self.image["width"])
+        planar_configuration = self.image.get("planar_configuration", 1)
+        return {
+            "crs": f"EPSG:{self.crs.to_epsg()}",
+            "res_x": res_x,
+            "res_y": res_y,
+            "align_x": round(self.transform.c % abs(res_x), 12),
+            "align_y": round(self.transform.f % abs(res_y), 12),
+            "add_offset": self.add_offset,
+            "scale_factor": self.scale_factor,
+            "dtype": self.dtype,
+            "nodata": self.nodata,
+            "block_x": block_x,
+            "block_y": block_y,
+            "overview_factors": self.overview_factors,
+            "compression": COMPRESSIONS.get(self.image.get("compression", 1)),
+            "predictor": self.image.get("predictor", 1),
+            "interleave": "PIXEL" if planar_configuration == 1 and self.count > 1 else "BAND",
+            "is_cog": self.is_cog,
+        }
+
+
+def get_http_url(path: str) -> str | None:
+    """Get the public HTTP URL of a raster, or None if it can't be read over HTTP."""
+    if is_url(path):
+        return path
+    if is_gcsfs_path(path):
+        return re.sub(r"^(gs|gcs)://", "https://storage.googleapis.com/", path)
+    return None
+
+
+class HostRateLimiter:
+    """Spacing of the requests started to each host to at most its rate limit."""
+
+    def __init__(self):
+        self._next_start = {}
+
+    async def wait(self, host: str):
+        interval = 1 / HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT)
+        now = time.monotonic()
+        start = max(now, self._next_start.get(host, now))
+        self._next_start[host] = start + interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+async def fetch_range(
+    session: aiohttp.ClientSession, url: str, start: int, end: int, limiter: HostRateLimiter
+) -> bytes:
+    """
+    Fetch the bytes `[start, end)` of a file with a range request, retrying throttled
+    requests and connection errors with exponential backoff. Fewer bytes are returned
+    if the file ends before `end`.
+    """
+    headers = {"Range": f"bytes={start}-{end - 1}"}
+    for attempt in range(MAX_ATTEMPTS):
+        await limiter.wait(get_host(url))
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status in THROTTLING_STATUS_CODES and attempt < MAX_ATTEMPTS - 1:
+                    await asyncio.sleep(2**attempt + random.random())
+                    continue
+                if response.status == 416:
+                    # The range starts after the end of the file
+                    return b""
+                response.raise_for_status()
+                data = await response.read()
+                if response.status == 200:
+                    # The server ignored the range and sent the whole file
+                    return data[start:end]
+                return data
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(2**attempt + random.random())
+
+
+def _read_bytes(path: str, start: int, end: int) -> bytes:
+    with open_file(path, block_size=HEADER_BLOCK_SIZE) as file:
+        file.seek(start)
+        return file.read(end - start)
+
+
+async def read_cog_header(
+    session: aiohttp.ClientSession,
+    path: str,
+    limiter: HostRateLimiter = None,
+    initial_bytes: int = GDAL_INGESTED_BYTES_AT_OPEN,
+) -> CogHeader:
+    """
+    Read the header of a GeoTIFF with range requests of at least `initial_bytes`,
+    starting with the first bytes of the file and fetching more only where the
+    directories or tag values continue. Rasters that can't be read over HTTP, e.g.
+    local files, are read in a thread instead. Mirrored rasters are read from the mirror,
+    resolved in a thread as checking the mirror is current makes blocking requests.
+    """
+    path = await asyncio.to_thread(resolve_mirror_path, path)
+    limiter = limiter or HostRateLimiter()
+    url = get_http_url(path)
+    data, file_size = HeaderBytes(), None
+    start, end = 0, initial_bytes
+    while True:
+        if url is not None:
+            chunk = await fetch_range(session, url, start, end, limiter)
+        else:
+            chunk = await asyncio.to_thread(_read_bytes, path, start, end)
+        data.add(start, chunk)
+        if len(chunk) < end - start:
+            file_size = start + len(chunk)
+        try:
+            return CogHeader(parse_tiff_header(data))
+        except NeedMoreBytes as error:
+            if file_size is not None and error.end > file_size:
+                raise ValueError(f"The header of {path} ends after the end of the file") from None
+            start, end = error.start, max(error.end, error.start + initial_bytes)
+
+
+async def read_cog_headers_async(
+    paths: list[str], max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+) -> tuple[dict[str, CogHeader], list[str]]:
+    """
+    Read the headers of GeoTIFFs concurrently from a single event loop, sharing one
+    pool of HTTP connections.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limiter = HostRateLimiter()
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+
+    headers, failed = {}, []
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def read(path: str):
+            async with semaphore:
+                try:
+                    headers[path] = await read_cog_header(session, path, limiter)
+                except Exception as error:
+                    logger.exception(error)
+                    logger.error(f"Failed to read the header of {path}")
+                    failed.append(path)
+
+        await asyncio.gather(*(read(path) for path in paths))
+    return headers, failed
+
+
+def read_cog_headers(
+    paths: list[str], max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+) -> tuple[dict[str, CogHeader], list[str]]:
+    """
+    Read the headers of GeoTIFFs concurrently, without GDAL.
+
+    Parameters
+    ----------
+    paths : list[str]
+        URLs, gsutil URIs or local file paths of the GeoTIFFs.
+    max_concurrency : int
+        Number of headers read at the same time.
+
+    Returns
+    -------
+    tuple[dict[str, CogHeader], list[str]]
+        The header of each GeoTIFF by path, and the paths that could not be read.
+    """
+    start = time.monotonic()
+    headers, failed = asyncio.run(read_cog_headers_async(paths, max_concurrency))
+    seconds = time.monotonic() - start
+    logger.info(
+        f"Read {len(headers)} headers in {seconds:.1f}s "
+        f"({len(headers) / max(seconds, 1e-9):.0f} headers per second), {len(failed)} failed"
+    )
+    return headers, failed
@@ -1,20 +1,29 @@
 #!python3
 
+import functools
 import os
 import re
 import uuid
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import urlparse
 
 import boto3
+import gcsfs
+import numpy as np
 import rasterio
 import yaml
 from eodatasets3 import serialise
-from eodatasets3.images import GridSpec, MeasurementBundler
+from eodatasets3.images import GridSpec, MeasurementBundler, ValidDataMethod
 from eodatasets3.model import AccessoryDoc, DatasetDoc, ProductDoc
 from eodatasets3.properties import Eo3Interface
 from eodatasets3.validate import Level, ValidationExpectations, validate_dataset
+from rasterio.windows import Window
+from shapely.geometry import box
+from shapely.ops import unary_union
+
+from wapor_v3_odc_products_py.block_cache import open_raster
 
 # Uncomment and add logging if and where needed
 # import logging
@@ -26,6 +35,174 @@ from eodatasets3.validate import Level, ValidationExpectations, validate_dataset
 
 OUTPUT_NAME = "odc-metadata.yaml"
 
+# Number of prefixes listed concurrently in an object store
+LIST_MAX_WORKERS = 8
+
+# Size in pixels of the windows read to compute the valid data mask of a file
+VALID_DATA_WINDOW_SIZE = 2048
+
+
+@functools.lru_cache(maxsize=None)
+def load_product_definition(product_yaml: str) -> dict:
+    """Load a product definition yaml, once per process however many datasets are prepared."""
+    with Path(product_yaml).open() as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    """
+    Return an S3 client shared by all EasiPrepare instances.
+    Creating a client is slow and boto3 clients are thread safe.
+    """
+    return boto3.client("s3")
+
+
+@functools.lru_cache(maxsize=None)
+def get_gcs_filesystem():
+    """
+    Return a GCS filesystem shared by all EasiPrepare instances.
+    Credentials are found from the environment, falling back to anonymous access.
+    """
+    return gcsfs.GCSFileSystem()
+
+
+def _has_extension(name: str, extensions: tuple = None) -> bool:
+    """Test if a file name has an extension, or one of the given extensions"""
+    if extensions is None:
+        return "." in name
+    return name.lower().endswith(extensions)
+
+
+def _list_s3_prefix(bucket: str, prefix: str, delimiter: str = None, **kwargs) -> tuple:
+    """
+    List all the object keys under a prefix, following the pagination of list_objects_v2.
+    If delimiter is given, also return the common prefixes at the next level.
+    """
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    pagination_kwargs = {"Bucket": bucket, "Prefix": prefix, **kwargs}
+    if delimiter:
+        pagination_kwargs["Delimiter"] = delimiter
+    keys, common_prefixes = [], []
+    for page in paginator.paginate(**pagination_kwargs):
+        keys.extend(item["Key"] for item in page.get("Contents", []))
+        common_prefixes.extend(item["Prefix"] for item in page.get("CommonPrefixes", []))
+    return keys, common_prefixes
+
+
+def list_s3_keys(
+    bucket: str,
+    prefix: str,
+    extensions: tuple = None,
+    max_workers: int = LIST_MAX_WORKERS,
+    **kwargs,
+) -> list:
+    """
+    List the object keys under an S3 prefix.
+    The first level of sub-prefixes is listed concurrently, each one paginated.
+
+    :param extensions: Only return keys with one of these (lower case) extensions
+    :param kwargs: Passed to list_objects_v2, e.g. RequestPayer
+    """
+    keys, common_prefixes = _list_s3_prefix(bucket, prefix, delimiter="/", **kwargs)
+    if common_prefixes:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for sub_keys, _ in executor.map(
+                lambda sub_prefix: _list_s3_prefix(bucket, sub_prefix, **kwargs),
+                common_prefixes,
+            ):
+                keys.extend(sub_keys)
+    return sorted(k for k in keys if _has_extension(os.path.basename(k), extensions))
+
+
+def list_gcs_keys(
+    bucket: str,
+    prefix: str,
+    extensions: tuple = None,
+    max_workers: int = LIST_MAX_WORKERS,
+) -> list:
+    """
+    List the object keys under a GCS prefix.
+    The first level of sub-prefixes is listed concurrently, each one paginated by gcsfs.
+
+    :param extensions: Only return keys with one of these (lower case) extensions
+    """
+    fs = get_gcs_filesystem()
+    path = f"{bucket}/{prefix}".rstrip("/")
+    if fs.isfile(path):
+        paths = [path]
+    else:
+        paths, sub_prefixes = [], []
+        for item in fs.ls(path, detail=True):
+            if item["type"] == "directory":
+                sub_prefixes.append(item["name"])
+            else:
+                paths.append(item["name"])
+        if sub_prefixes:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for sub_paths in executor.map(fs.find, sub_prefixes):
+                    paths.extend(sub_paths)
+    keys = [re.sub(f"^{re.escape(bucket)}/", "", p) for p in paths]
+    return sorted(k for k in keys if _has_extension(os.path.basename(k), extensions))
+
+
+def list_local_files(path: Path, extensions: tuple = None) -> list:
+    """
+    Recursively list the files in a local directory with os.scandir,
+    checking the extension on the entry name before creating a Path.
+
+    :param extensions: Only return files with one of these (lower case) extensions
+    """
+    files = []
+    directories = [str(path)]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif _has_extension(entry.name, extensions):
+                    files.append(Path(entry.path))
+    return sorted(files)
+
+
+def read_valid_data_mask(
+    ds: rasterio.DatasetReader, bands: list, window_size: int = VALID_DATA_WINDOW_SIZE
+) -> np.ndarray:
+    """
+    Return the union of the valid data masks of bands of an open raster in one windowed
+    pass, so only a window of every band is held in memory at a time.
+
+    Only the pixel data is streamed: the returned mask covers the full raster at one
+    byte per pixel, as the valid data polygon is computed from the whole mask. Use the
+    bounds valid data method for rasters whose mask doesn't fit in memory.
+
+    A pixel is valid where it is not the band nodata value, or finite where the band has
+    no nodata value and is floating point. Integer bands without a nodata value use 0.
+    """
+    mask = np.zeros(ds.shape, dtype=bool)
+    nodatas = []
+    for band in bands:
+        nodata = ds.nodatavals[band - 1]
+        if nodata is None:
+            nodata = float("nan") if np.issubdtype(ds.dtypes[band - 1], np.floating) else 0
+        nodatas.append(nodata)
+
+    for row_off in range(0, ds.height, window_size):
+        for col_off in range(0, ds.width, window_size):
+            window = Window(
+                col_off,
+                row_off,
+                min(window_size, ds.width - col_off),
+                min(window_size, ds.height - row_off),
+            )
+            rows, cols = window.toslices()
+            for array, nodata in zip(ds.read(bands, window=window), nodatas):
+                if np.isnan(nodata):
+                    mask[rows, cols] |= np.isfinite(array)
+                else:
+                    mask[rows, cols] |= array != nodata
+    return mask
+
 
 class EasiPrepare(Eo3Interface):
     def __init__(
@@ -57,6 +234,8 @@ class EasiPrepare(Eo3Interface):
         self._dataset_key = None  # Set by self._set_dataset_path()
         self._output_path = None  # Set by self._set_output_path()
         self._measurements = MeasurementBundler()
+        self._valid_data_bounds = []  # Set by self.note_measurement() for ValidDataMethod.bounds
+        self._measurement_bands = {}  # Band numbers of measurements in multi-band files
 
         # Handle inputs
         self._set_dataset_path(dataset_path)
@@ -227,22 +406,18 @@ class EasiPrepare(Eo3Interface):
         """
         Return the product name from the product yaml
         """
-        with self._product_yaml.open() as f:
-            y = yaml.load(f, Loader=yaml.FullLoader)
-            return y["name"]
+        return load_product_definition(str(self._product_yaml))["name"]
 
     def get_product_measurements(self) -> list:
         """
         Return list of (measurement, alias, ..) tuples
         """
         measurements = []  # list of tuples (measurement name, alias, ...)
-        with self._product_yaml.open() as f:
-            y = yaml.load(f, Loader=yaml.FullLoader)
-            for m in y["measurements"]:
-                t = [m["name"]]
-                if "aliases" in m:
-                    t.extend(m["aliases"])
-                measurements.append(tuple(t))
+        for m in load_product_definition(str(self._product_yaml))["measurements"]:
+            t = [m["name"]]
+            if "aliases" in m:
+                t.extend(m["aliases"])
+            measurements.append(tuple(t))
         return measurements
 
     def _match_measurement_names_to_band_ids(
@@ -283,6 +458,7 @@ class EasiPrepare(Eo3Interface):
         self,
         band_regex: str,
         supplementary: dict = None,
+        extensions: tuple = None,
     ) -> dict:
         """
         Return dict of {measurement names: path} for matching file paths in self._dataset_path.
@@ -302,7 +478,15 @@ class EasiPrepare(Eo3Interface):
         :param supplementary:
         Dict mapping any band IDs (from band_regex) to measurement names.
         Use where the unique band ID does not directly match a measurement name.
+        Several measurements can map to the band ID of one multi-band file, see
+        note_measurements() to reference them with a single read of the file.
+
+        :param extensions:
+        Optional tuple of file extensions, e.g. (".tif", ".tiff"). Only file paths with
+        one of these extensions are matched against band_regex. Default is any extension.
         """
+        if extensions is not None:
+            extensions = tuple(e.lower() for e in extensions)
 
         # Match band_ids to file paths
         p = re.compile(band_regex)
@@ -313,7 +497,7 @@ class EasiPrepare(Eo3Interface):
         # File system
         if self._dataset_scheme == "file":
             if self._dataset_path.is_dir():
-                for filename in self._dataset_path.rglob("*.*"):
+                for filename in list_local_files(self._dataset_path, extensions):
                     m = p.search(str(filename))
                     if m:
                         band_ids[m.group(1)] = filename
@@ -323,22 +507,21 @@ class EasiPrepare(Eo3Interface):
                 if m:
                     band_ids[m.group(1)] = filename
 
-        # S3; obtain a list of object keys for the dataset
-        if self._dataset_scheme == "s3":
-            client = boto3.client("s3")
-            response = client.list_objects_v2(
-                Bucket=self._dataset_bucket,
-                Prefix=self._dataset_key,
-                RequestPayer="requester",  # Make a parameter if/when required
-            )
-            # print(f'Debug: {response}')
-            if response["KeyCount"] > 0:
-                for item in response["Contents"]:
-                    key = item["Key"]
-                    m = p.search(key)
-                    if m:
-                        band_ids[m.group(1)] = f"s3://{self._dataset_bucket}/{key}"
-                        continue
+        # S3 or GCS; obtain a list of object keys for the dataset
+        if self._dataset_scheme in ("s3", "gs", "gcs"):
+            if self._dataset_scheme == "s3":
+                keys = list_s3_keys(
+                    self._dataset_bucket,
+                    self._dataset_key,
+                    extensions,
+                    RequestPayer="requester",  # Make a parameter if/when required
+                )
+            else:
+                keys = list_gcs_keys(self._dataset_bucket, self._dataset_key, extensions)
+            for key in keys:
+                m = p.search(key)
+                if m:
+                    band_ids[m.group(1)] = f"{self._dataset_scheme}://{self._dataset_bucket}/{key}"
 
         if len(band_ids) == 0:
             raise RuntimeError(f"No matching file paths found for regex: {band_regex}")
@@ -359,6 +542,7 @@ class EasiPrepare(Eo3Interface):
         grid=None,
         array=None,
         nodata=None,
+        band: int = 1,
     ):
         """
         Reference a measurement from its existing file path.
@@ -378,7 +562,15 @@ class EasiPrepare(Eo3Interface):
             A given data array. Default is to read from the file_path
         :param nodata:
             A given nodata value. Default is to read from the file_path
+        :param band:
+            Band number of the measurement in a multi-band file. Default is 1
         """
+        if not grid and array is None and nodata is None:
+            self.note_measurements_from_file(
+                file_path, {measurement_name: band}, expand_valid_data, relative_to_metadata
+            )
+            return
+
         # Relative path to file
         written_path = str(file_path)
         if relative_to_metadata:
@@ -388,29 +580,129 @@ class EasiPrepare(Eo3Interface):
         if self.geometry:
             expand_valid_data = False
 
+        # The bounds of the image don't depend on the pixels, so don't read them.
+        bounds_only = expand_valid_data and self.valid_data_method is ValidDataMethod.bounds
+        if bounds_only:
+            expand_valid_data = False
+
         if not grid:
-            with rasterio.open(file_path) as ds:
-                # TODO: fix for multi-band files
-                if ds.count != 1:
-                    raise NotImplementedError("TODO: Only single-band files currently supported")
+            with open_raster(file_path) as ds:
+                if not 1 <= band <= ds.count:
+                    raise ValueError(f"Band {band} not in {ds.count} band file: {file_path}")
                 grid = GridSpec.from_rio(ds)
-                if not array:
-                    array = ds.read(1)
+                # The pixels are only needed to compute the valid data mask
+                if array is None and expand_valid_data:
+                    array = ds.read(band)
                 if not nodata:
-                    nodata = ds.nodata
+                    nodata = ds.nodatavals[band - 1]
+
+        self._record_measurement(
+            measurement_name, grid, written_path, array, nodata, expand_valid_data, band
+        )
+        if bounds_only:
+            self._valid_data_bounds.append(box(*grid.bounds))
+
+    def note_measurements_from_file(
+        self,
+        file_path: Path,
+        measurement_bands: dict,
+        expand_valid_data: bool = True,
+        relative_to_metadata: bool = True,
+    ):
+        """
+        Reference the measurements of a single or multi-band file with one read of the
+        file. The grid and nodata values are read once, and the valid data mask is the
+        union of the bands, computed in one windowed pass over the file. The mask itself
+        is held at full resolution, see read_valid_data_mask().
+
+        :param file_path:
+            Path to data file for these measurements
+        :param measurement_bands:
+            Dict of {measurement name: band number} of the measurements in the file
+        :param expand_valid_data:
+            Calculate the union of valid data polygons across all measurements
+        :param relative_to_metadata:
+            File paths in the dataset doc will be written relative to output metadata path
+        """
+        # Relative path to file
+        written_path = str(file_path)
+        if relative_to_metadata:
+            written_path = self.relative_to_metadata_path(file_path)
 
-        # This could be a layer name in a multi-band file; need to test it
-        layer = None
+        # If we have a polygon already, there's no need to compute valid data.
+        if self.geometry:
+            expand_valid_data = False
+
+        # The bounds of the image don't depend on the pixels, so don't read them.
+        bounds_only = expand_valid_data and self.valid_data_method is ValidDataMethod.bounds
+        if bounds_only:
+            expand_valid_data = False
+
+        mask = None
+        with open_raster(file_path) as ds:
+            for band in measurement_bands.values():
+                if not 1 <= band <= ds.count:
+                    raise ValueError(f"Band {band} not in {ds.count} band file: {file_path}")
+            grid = GridSpec.from_rio(ds)
+            if expand_valid_data:
+                mask = read_valid_data_mask(ds, sorted(set(measurement_bands.values())))
+
+        for measurement_name, band in measurement_bands.items():
+            # The mask already covers every band, so it is only added to the valid data once
+            self._record_measurement(
+                measurement_name, grid, written_path, mask, 0, mask is not None, band
+            )
+            mask = None
+        if bounds_only:
+            self._valid_data_bounds.append(box(*grid.bounds))
+
+    def note_measurements(
+        self,
+        measurement_paths: dict,
+        measurement_bands: dict = None,
+        expand_valid_data: bool = True,
+        relative_to_metadata: bool = True,
+    ):
+        """
+        Reference measurements from their existing file paths, opening each file once for
+        all the measurements it holds.
+
+        :param measurement_paths:
+            Dict of {measurement name: file path}, e.g. from map_measurements_to_paths()
+        :param measurement_bands:
+            Dict of {measurement name: band number} of measurements in multi-band files.
+            Default is band 1
+        :param expand_valid_data:
+            Calculate the union of valid data polygons across all measurements
+        :param relative_to_metadata:
+            File paths in the dataset doc will be written relative to output metadata path
+        """
+        measurement_bands = measurement_bands or {}
+        file_measurements = {}
+        for measurement_name, file_path in measurement_paths.items():
+            bands = file_measurements.setdefault(str(file_path), (file_path, {}))[1]
+            bands[measurement_name] = measurement_bands.get(measurement_name, 1)
+
+        for file_path, bands in file_measurements.values():
+            self.note_measurements_from_file(
+                file_path, bands, expand_valid_data, relative_to_metadata
+            )
 
+    def _record_measurement(
+        self, measurement_name, grid, written_path, array, nodata, expand_valid_data, band
+    ):
         self._measurements.record_image(
             measurement_name,  # str
             grid,  # GridSpec
             written_path,  # Path, str
             array,  # numpy.ndarray
-            layer,  # str [None]. Layer name in a multi-band file?
+            None,  # str [None]. Layer name, for file formats with named layers
             nodata=nodata,  # float, int [None: 'nan' if float else 0]
             expand_valid_data=expand_valid_data,  # bool [True: create valid_values mask with nodata]
         )
+        # The bundler doesn't keep band numbers, they're added to the measurement docs
+        if band != 1:
+            self._measurement_bands[measurement_name] = band
 
     def note_accessory_file(self, name: str, file_path: Path, relative_to_metadata: bool = True):
         """
@@ -432,11 +724,22 @@ class EasiPrepare(Eo3Interface):
                 raise ValueError(f"Duplicate accessory name {name!r}")
         self.accessories[name] = AccessoryDoc(path=written_path, name=name)
 
+    def note_source_datasets(self, classifier: str, *dataset_ids: uuid.UUID):
+        """
+        Record the source datasets this dataset was derived from in its lineage.
+
+        :param classifier: identifying name of the sources, eg 'source'
+        :param dataset_ids: UUIDs of the source datasets
+        """
+        if self._dataset.lineage is None:
+            self._dataset.lineage = {}
+        self._dataset.lineage.setdefault(classifier, []).extend(dataset_ids)
+
     def relative_to_metadata_path(self, path: Path) -> str:
         """Return path relative to output metadata path"""
         if self._dataset_scheme == "file":
             p = os.path.relpath(path, self._output_path.parent)  # str
-        elif self._dataset_scheme == "s3":
+        elif self._dataset_scheme in ("s3", "gs", "gcs"):
             p = re.sub(f"^{self._dataset_path}[/]?", "", path)
         else:
             raise ValueError(
@@ -470,6 +773,8 @@ class EasiPrepare(Eo3Interface):
         crs, grid_docs, measurement_docs = self._measurements.as_geo_docs()
         dataset.grids = grid_docs
         dataset.measurements = measurement_docs
+        for measurement_name, band in self._measurement_bands.items():
+            dataset.measurements[measurement_name.replace(":", "_")].band = band
         if sort_measurements:
             dataset.measurements = dict(sorted(dataset.measurements.items()))
 
@@ -494,6 +799,8 @@ class EasiPrepare(Eo3Interface):
             valid_data = self._measurements.consume_and_get_valid_data(
                 valid_data_method=self.valid_data_method
             )
+            if self._valid_data_bounds:
+                valid_data = unary_union([valid_data, *self._valid_data_bounds])
         if valid_data.is_empty:
             valid_data = None
             expect_geometry = False
@@ -549,6 +856,7 @@ class EasiPrepare(Eo3Interface):
         return f"epsg:{crs.to_epsg()}" if crs.is_epsg_code else crs.to_wkt()
 
     # Borrowed from https://github.com/opendatacube/eo-datasets/blob/develop/eodatasets3/images.py
+    @staticmethod
     def _valid_shape(shape: "BaseGeometry") -> "BaseGeometry":  # type: ignore  # noqa: F821
         if shape.is_valid:
             return shape
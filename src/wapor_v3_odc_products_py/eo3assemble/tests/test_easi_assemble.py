@@ -2,8 +2,19 @@
 # https://www.nerdwallet.com/blog/engineering/5-pytest-best-practices/
 # https://realpython.com/pytest-python-testing/
 
+import numpy as np
 import pytest
-from iwmi_odr_odc_product_py.eo3assemble.easi_assemble import OUTPUT_NAME, EasiPrepare
+import rasterio
+import yaml
+from eodatasets3.images import ValidDataMethod
+from rasterio.transform import from_origin
+
+from wapor_v3_odc_products_py.eo3assemble import easi_assemble
+from wapor_v3_odc_products_py.eo3assemble.easi_assemble import (
+    OUTPUT_NAME,
+    EasiPrepare,
+    read_valid_data_mask,
+)
 
 # Uncomment when required
 # import datetime
@@ -111,3 +122,112 @@ def test_easiprepare_match_measurement_names_to_band_ids(test_input, expected):
         None, test_input["mtuples"], test_input["band_ids"], test_input["supplementary"]
     )
     assert measurement2path == expected["measurement2path"]
+
+
+def test_list_local_files_extensions(dataset_dir):
+    (dataset_dir / "sub" / "deeper").mkdir(parents=True)
+    for name in ["a_B01.tif", "sub/a_B02.TIF", "sub/deeper/a_B03.tif", "sub/notes.txt", "README"]:
+        (dataset_dir / name).write_text("")
+    files = easi_assemble.list_local_files(dataset_dir, (".tif",))
+    assert [f.name for f in files] == ["a_B01.tif", "a_B02.TIF", "a_B03.tif"]
+    assert len(easi_assemble.list_local_files(dataset_dir)) == 4
+
+
+class FakePaginator:
+    """Serve list_objects_v2 pages of at most 2 keys from a list of keys"""
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def paginate(self, Bucket, Prefix, Delimiter=None, **kwargs):
+        keys = [k for k in self.keys if k.startswith(Prefix)]
+        prefixes = set()
+        if Delimiter:
+            prefixes = {
+                Prefix + k[len(Prefix) :].split(Delimiter)[0] + Delimiter
+                for k in keys
+                if Delimiter in k[len(Prefix) :]
+            }
+            keys = [k for k in keys if Delimiter not in k[len(Prefix) :]]
+        for i in range(0, max(len(keys), 1), 2):
+            yield {
+                "Contents": [{"Key": k} for k in keys[i : i + 2]],
+                "CommonPrefixes": [{"Prefix": p} for p in sorted(prefixes)] if i == 0 else [],
+            }
+
+
+def test_map_measurements_to_paths_s3_paginated(monkeypatch, product_file, writeable_file):
+    keys = [f"some-key/tile/{i:02d}/data_{i:02d}.tif" for i in range(5)]
+    keys += ["some-key/tile/data_test_data.tif", "some-key/tile/data_test_data.xml"]
+
+    class FakeClient:
+        def get_paginator(self, name):
+            return FakePaginator(keys)
+
+    monkeypatch.setattr(easi_assemble, "get_s3_client", lambda: FakeClient())
+    assert easi_assemble.list_s3_keys("some-bucket", "some-key/tile/") == sorted(keys)
+
+    ep = EasiPrepare("s3://some-bucket/some-key/tile/", product_file, str(writeable_file))
+    measurement2path = ep.map_measurements_to_paths(r"data_(test_data)\.", extensions=(".tif",))
+    assert measurement2path == {"test_data": "s3://some-bucket/some-key/tile/data_test_data.tif"}
+
+
+def write_multiband_file(path):
+    arrays = np.full((2, 4, 6), -9999, dtype="int16")
+    arrays[0, :2, :2] = 1
+    arrays[1, 3, 5] = 2
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=6,
+        height=4,
+        count=2,
+        dtype="int16",
+        nodata=-9999,
+        crs="EPSG:4326",
+        transform=from_origin(0, 4, 1, 1),
+    ) as ds:
+        ds.write(arrays)
+    return arrays != -9999
+
+
+def test_read_valid_data_mask(tmp_path):
+    path = tmp_path / "WAPOR-3.L2-QUAL.tif"
+    expected = write_multiband_file(path)
+    with rasterio.open(path) as ds:
+        np.testing.assert_array_equal(
+            read_valid_data_mask(ds, [1, 2], window_size=3), expected.any(0)
+        )
+        np.testing.assert_array_equal(read_valid_data_mask(ds, [2], window_size=3), expected[1])
+
+
+def test_note_measurements_multiband(tmp_path):
+    write_multiband_file(tmp_path / "WAPOR-3.L2-QUAL.tif")
+    product_yaml = tmp_path / "product.yaml"
+    product_yaml.write_text(
+        yaml.safe_dump(
+            {
+                "name": "test_product",
+                "measurements": [
+                    {"name": "quality_a", "dtype": "int16", "nodata": -9999, "units": "1"},
+                    {"name": "quality_b", "dtype": "int16", "nodata": -9999, "units": "1"},
+                ],
+            }
+        )
+    )
+
+    p = EasiPrepare(tmp_path, product_yaml)
+    p.valid_data_method = ValidDataMethod.thorough
+    measurement_paths = p.map_measurements_to_paths(
+        r"L2-(\w+)\.tif", supplementary={"quality_a": "QUAL", "quality_b": "QUAL"}
+    )
+    p.note_measurements(measurement_paths, {"quality_b": 2})
+    measurements = p._measurements.as_geo_docs()[2]
+
+    assert len(p.measurements) == 2
+    assert measurements["quality_a"].path == measurements["quality_b"].path
+    p.to_dataset_doc(validate_correctness=False)
+    assert p._dataset.measurements["quality_a"].band == 1
+    assert p._dataset.measurements["quality_b"].band == 2
+    assert p._dataset.geometry.bounds == (0.0, 0.0, 6.0, 4.0)
@@ -0,0 +1,160 @@
+import collections
+import fcntl
+import json
+import logging
+import os
+import shlex
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import click
+
+from wapor_v3_odc_products_py.logs import get_logger
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+
+def get_period(value: datetime | str) -> str:
+    """Get the `YYYY-MM` month Explorer summarises a dataset datetime in."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return f"{value.year:04d}-{value.month:02d}"
+
+
+def new_touched_periods() -> dict[str, set[str]]:
+    """Get an empty record of the months touched in each product."""
+    return collections.defaultdict(set)
+
+
+@contextmanager
+def locked(path: str):
+    """Hold an exclusive lock on a local file, shared by every process on the node."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(f"{path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read(path: str) -> dict[str, set[str]]:
+    touched = new_touched_periods()
+    if os.path.exists(path):
+        with open(path) as file:
+            for product_name, periods in json.load(file).items():
+                touched[product_name].update(periods)
+    return touched
+
+
+def _write(path: str, touched: dict[str, set[str]]):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump({k: sorted(v) for k, v in sorted(touched.items())}, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_touched_periods(path: str) -> dict[str, set[str]]:
+    """Read the months touched in each product since Explorer was last refreshed."""
+    with locked(path):
+        return _read(path)
+
+
+def record_touched_periods(path: str, touched: dict[str, set[str]]):
+    """
+    Add the months touched in each product by an indexing run to the record of the
+    months to refresh in Explorer, shared by the indexing commands running on a node.
+    """
+    touched = {product_name: periods for product_name, periods in touched.items() if periods}
+    if not touched:
+        return
+    with locked(path):
+        recorded = _read(path)
+        for product_name, periods in touched.items():
+            recorded[product_name].update(periods)
+        _write(path, recorded)
+
+
+def clear_touched_periods(path: str, refreshed: dict[str, set[str]]):
+    """
+    Remove the refreshed products from the record, keeping the months recorded by
+    indexing runs while Explorer was being refreshed.
+    """
+    with locked(path):
+        recorded = _read(path)
+        for product_name, periods in refreshed.items():
+            remaining = recorded.pop(product_name, set()) - periods
+            if remaining:
+                recorded[product_name] = remaining
+        _write(path, recorded)
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the product the stac items were indexed into",
+)
+@click.option(
+    "--touched-periods-file",
+    type=click.Path(),
+    help="File to record the months touched in, to only refresh their Explorer summaries",
+)
+@click.argument("stac_item_files", nargs=-1, type=click.Path(exists=True))
+def record_touched_periods_cli(
+    product_name: str, touched_periods_file: str, stac_item_files: tuple[str]
+):
+    """
+    Record the months of stac items indexed outside of the indexing commands, e.g. with
+    `datacube dataset add`, so that `refresh-explorer` refreshes their summaries too.
+    """
+    touched = new_touched_periods()
+    for stac_item_file in stac_item_files:
+        with open(stac_item_file) as file:
+            properties = json.load(file)["properties"]
+        touched[product_name].add(get_period(properties["datetime"]))
+    record_touched_periods(touched_periods_file, touched)
+    logger.info(f"Recorded the months of {len(stac_item_files)} stac items of {product_name}")
+
+
+@click.command()
+@click.option(
+    "--touched-periods-file",
+    type=click.Path(),
+    help="File the indexing commands record the products and months they touched in",
+)
+@click.option(
+    "--command",
+    default="cubedash-gen",
+    help="Explorer summary generation command, e.g. run through docker compose exec",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Only log the products and months that would be refreshed",
+)
+def refresh_explorer(touched_periods_file: str, command: str, dry_run: bool):
+    """
+    Refresh the Explorer summaries of only the products touched by indexing since the
+    last refresh. cubedash-gen updates incrementally, regenerating only the months and
+    years of a product with datasets changed since its last refresh, so a daily add of a
+    few dekads regenerates a few months rather than every period of every product.
+    """
+    touched = read_touched_periods(touched_periods_file)
+    if not touched:
+        logger.info("No products were touched since Explorer was last refreshed")
+        return
+    for product_name, periods in sorted(touched.items()):
+        logger.info(f"{product_name}: {', '.join(sorted(periods))}")
+    if dry_run:
+        return
+
+    subprocess.run([*shlex.split(command), *sorted(touched)], check=True)
+    clear_touched_periods(touched_periods_file, touched)
+    logger.info(f"Refreshed the Explorer summaries of {len(touched)} products")
+
+
+if __name__ == "__main__":
+    refresh_explorer()
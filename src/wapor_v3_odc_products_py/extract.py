@@ -0,0 +1,418 @@
+import json
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import click
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds
+
+from wapor_v3_odc_products_py.block_cache import open_raster
+from wapor_v3_odc_products_py.io import get_filesystem, load_vector_file
+from wapor_v3_odc_products_py.loading import get_storage_profile
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.tasks import (
+    PARTITION_METHODS,
+    get_product_tasks,
+    get_shard_tasks,
+    get_task_id,
+)
+from wapor_v3_odc_products_py.utils import get_dekad
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+STATISTICS = ["count", "mean", "min", "max"]
+
+
+def get_raster_datetime(task: str) -> pd.Timestamp:
+    """Get the datetime of the dekad a WaPOR v3 raster is for from its raster code."""
+    year, month, dekad_label = get_task_id(task).split(".")[-1].split("-")
+    input_datetime, _ = get_dekad(year, month, dekad_label)
+    return pd.Timestamp(input_datetime)
+
+
+def get_rasters_from_stac_items(stac_dir: str, measurement: str) -> list[str]:
+    """Get the file paths of a measurement from the stac item files in a directory."""
+    fs = get_filesystem(path=stac_dir, anon=True)
+    rasters = []
+    for stac_item_file in sorted(fs.glob(os.path.join(stac_dir, "*.stac-item.json"))):
+        with fs.open(stac_item_file, "r") as file:
+            stac_item = json.load(file)
+        rasters.append(stac_item["assets"][measurement]["href"])
+    return rasters
+
+
+def get_block_windows(
+    gdf: gpd.GeoDataFrame, profile: dict
+) -> list[tuple[Window, np.ndarray, np.ndarray]]:
+    """
+    Group geometries by the COG blocks they touch and get, for each block, its
+    window and the flat indices of the pixels each geometry covers within it.
+
+    A geometry spanning several blocks is split across them, so each block is
+    read once per raster for all the geometries within it.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Point or polygon geometries in the CRS of the rasters.
+    profile : dict
+        Storage profile of the rasters from `get_storage_profile`.
+
+    Returns
+    -------
+    list[tuple[Window, np.ndarray, np.ndarray]]
+        For each block, the window, the flat pixel indices and the position
+        of the geometry in `gdf` each pixel index belongs to.
+    """
+    transform = profile["transform"]
+    height, width = profile["shape"]
+    block_y, block_x = profile["block_shape"]
+
+    groups = {}
+    for position, geometry in enumerate(gdf.geometry):
+        if geometry is None or geometry.is_empty:
+            continue
+        window = from_bounds(*geometry.bounds, transform=transform)
+        row_start = max(int(math.floor(window.row_off)), 0)
+        col_start = max(int(math.floor(window.col_off)), 0)
+        row_stop = min(int(math.floor(window.row_off + window.height)) + 1, height)
+        col_stop = min(int(math.floor(window.col_off + window.width)) + 1, width)
+        if row_start >= row_stop or col_start >= col_stop:
+            continue
+        for block_row in range(row_start // block_y, (row_stop - 1) // block_y + 1):
+            for block_col in range(col_start // block_x, (col_stop - 1) // block_x + 1):
+                groups.setdefault((block_row, block_col), []).append(position)
+
+    block_windows = []
+    for (block_row, block_col), positions in sorted(groups.items()):
+        row_off = block_row * block_y
+        col_off = block_col * block_x
+        window = Window(
+            col_off=col_off,
+            row_off=row_off,
+            width=min(block_x, width - col_off),
+            height=min(block_y, height - row_off),
+        )
+        window_transform = rasterio.windows.transform(window, transform)
+        window_shape = (int(window.height), int(window.width))
+
+        pixel_indices = []
+        geometry_indices = []
+        for position in positions:
+            geometry = gdf.geometry.iloc[position]
+            if geometry.geom_type in ("Point", "MultiPoint"):
+                rows, cols = rasterio.transform.rowcol(
+                    window_transform,
+                    [point.x for point in getattr(geometry, "geoms", [geometry])],
+                    [point.y for point in getattr(geometry, "geoms", [geometry])],
+                )
+                rows, cols = np.array(rows), np.array(cols)
+                # Points of a multi-point in other blocks
+                within = (rows >= 0) & (rows < window_shape[0]) & (cols >= 0)
+                within &= cols < window_shape[1]
+                flat = np.ravel_multi_index((rows[within], cols[within]), window_shape)
+            else:
+                mask = geometry_mask(
+                    [geometry], out_shape=window_shape, transform=window_transform, invert=True
+                )
+                flat = np.flatnonzero(mask)
+            pixel_indices.append(flat)
+            geometry_indices.append(np.full(flat.shape, position))
+
+        pixel_indices = np.concatenate(pixel_indices)
+        if len(pixel_indices):
+            block_windows.append((window, pixel_indices, np.concatenate(geometry_indices)))
+    return block_windows
+
+
+def get_zonal_totals(
+    values: np.ndarray,
+    geometry_indices: np.ndarray,
+    number_of_geometries: int,
+    nodata: float | int | None,
+) -> dict[str, np.ndarray]:
+    """
+    Get the count, sum, min and max of the valid values covered by each geometry,
+    which can be combined across the blocks a geometry spans.
+    """
+    if nodata is None or np.isnan(nodata):
+        valid = ~np.isnan(values) if np.issubdtype(values.dtype, np.floating) else None
+    else:
+        valid = values != nodata
+    if valid is not None:
+        values = values[valid]
+        geometry_indices = geometry_indices[valid]
+
+    values = values.astype("float64")
+    minimum = np.full(number_of_geometries, np.inf)
+    maximum = np.full(number_of_geometries, -np.inf)
+    np.minimum.at(minimum, geometry_indices, values)
+    np.maximum.at(maximum, geometry_indices, values)
+    return {
+        "count": np.bincount(geometry_indices, minlength=number_of_geometries),
+        "total": np.bincount(geometry_indices, weights=values, minlength=number_of_geometries),
+        "min": minimum,
+        "max": maximum,
+    }
+
+
+def get_zonal_statistics_from_totals(totals: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """Get the count, mean, min and max of each geometry from its zonal totals."""
+    count = totals["count"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = totals["total"] / count
+    has_data = count > 0
+    return {
+        "count": count,
+        "mean": np.where(has_data, mean, np.nan),
+        "min": np.where(has_data, totals["min"], np.nan),
+        "max": np.where(has_data, totals["max"], np.nan),
+    }
+
+
+def get_zonal_statistics(
+    values: np.ndarray,
+    geometry_indices: np.ndarray,
+    number_of_geometries: int,
+    nodata: float | int | None,
+) -> dict[str, np.ndarray]:
+    """
+    Get the count, mean, min and max of the valid values covered by each geometry.
+    """
+    return get_zonal_statistics_from_totals(
+        get_zonal_totals(values, geometry_indices, number_of_geometries, nodata)
+    )
+
+
+def extract_raster(
+    raster: str,
+    block_windows: list,
+    ids: np.ndarray,
+    profile: dict,
+) -> pd.DataFrame:
+    """
+    Read the blocks of a single raster and get the statistics
+    of the values covered by each geometry.
+    """
+    scale_factor = profile["scale_factor"] or 1
+    add_offset = profile["add_offset"] or 0
+    # The geometries covering any pixels of the grid
+    positions = np.unique(
+        np.concatenate([geometry_indices for _, _, geometry_indices in block_windows] or [[]])
+    ).astype(int)
+    totals = {
+        "count": np.zeros(len(positions), dtype="int64"),
+        "total": np.zeros(len(positions)),
+        "min": np.full(len(positions), np.inf),
+        "max": np.full(len(positions), -np.inf),
+    }
+
+    if block_windows:
+        with open_raster(raster) as ds:
+            if ds.transform != profile["transform"] or ds.shape != tuple(profile["shape"]):
+                raise ValueError(f"The grid of {raster} does not match the grid of the mapset")
+            for window, pixel_indices, geometry_indices in block_windows:
+                array = ds.read(1, window=window)
+                # Re-index the geometries in the block to keep the bincounts small
+                block_positions, local_indices = np.unique(geometry_indices, return_inverse=True)
+                block_totals = get_zonal_totals(
+                    array.ravel()[pixel_indices],
+                    local_indices,
+                    len(block_positions),
+                    profile["nodata"],
+                )
+                # Combine with the totals of the other blocks each geometry spans
+                index = np.searchsorted(positions, block_positions)
+                totals["count"][index] += block_totals["count"]
+                totals["total"][index] += block_totals["total"]
+                totals["min"][index] = np.minimum(totals["min"][index], block_totals["min"])
+                totals["max"][index] = np.maximum(totals["max"][index], block_totals["max"])
+
+    df = pd.DataFrame(get_zonal_statistics_from_totals(totals), columns=STATISTICS)
+    for statistic in ["mean", "min", "max"]:
+        df[statistic] = df[statistic] * scale_factor + add_offset
+    df.insert(0, "id", ids[positions])
+    df.insert(1, "time", get_raster_datetime(raster))
+    df.insert(2, "raster", get_task_id(raster))
+    return df
+
+
+def extract_time_series(
+    gdf: gpd.GeoDataFrame,
+    rasters: list[str],
+    output_file: str,
+    id_column: str = None,
+    max_workers: int = 8,
+) -> list[str]:
+    """
+    Extract the time series of statistics for each geometry across rasters
+    sharing the same grid, streaming the results to a Parquet file.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Point or polygon geometries to extract the time series for.
+    rasters : list[str]
+        File paths or URLs of the rasters.
+    output_file : str
+        Parquet file to write the results to.
+    id_column : str
+        Column in `gdf` identifying each geometry. Default is the index of `gdf`.
+    max_workers : int
+        Number of rasters to read concurrently.
+
+    Returns
+    -------
+    list[str]
+        Rasters that failed to be read.
+    """
+    if not rasters:
+        logger.warning(f"No rasters to extract the time series from, {output_file} not written")
+        return []
+
+    profile = get_storage_profile(rasters[0])
+    gdf = gdf.to_crs(profile["crs"])
+    ids = gdf[id_column].to_numpy() if id_column else gdf.index.to_numpy()
+
+    block_windows = get_block_windows(gdf, profile)
+    logger.info(f"{len(gdf)} geometries are grouped into {len(block_windows)} blocks")
+    if not block_windows:
+        logger.warning(f"None of the {len(gdf)} geometries cover any pixels of the rasters")
+
+    fs = get_filesystem(path=output_file, anon=False)
+    failed_rasters = []
+    writer = None
+    with (
+        fs.open(output_file, "wb") as file,
+        ThreadPoolExecutor(max_workers=max_workers) as executor,
+    ):
+        futures = {
+            executor.submit(extract_raster, raster, block_windows, ids, profile): raster
+            for raster in rasters
+        }
+        for idx, future in enumerate(as_completed(futures)):
+            raster = futures[future]
+            try:
+                table = pa.Table.from_pandas(future.result(), preserve_index=False)
+            except Exception as error:
+                logger.exception(error)
+                logger.error(f"Failed to extract the time series from {raster}")
+                failed_rasters.append(raster)
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(file, table.schema)
+            writer.write_table(table)
+            logger.info(f"Extracted {raster} {idx+1}/{len(rasters)}")
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        # Every raster failed, so don't leave behind an empty file that isn't Parquet
+        fs.rm(output_file)
+    return failed_rasters
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the product to extract the time series from",
+)
+@click.option(
+    "--vector-file",
+    type=click.Path(),
+    help="File path to the point or polygon geometries to extract the time series for",
+)
+@click.option(
+    "--output-file",
+    type=click.Path(),
+    help="Parquet file to write the time series to",
+)
+@click.option(
+    "--id-column",
+    default=None,
+    help="Column in the vector file identifying each geometry, default is the row index",
+)
+@click.option(
+    "--stac-dir",
+    type=click.Path(),
+    default=None,
+    help="Directory of stac item files to get the rasters from instead of the catalogue",
+)
+@click.option(
+    "--measurement",
+    default="relative_soil_moisture",
+    help="Measurement to extract when reading the rasters from stac item files",
+)
+@click.option(
+    "--shard",
+    default=None,
+    help="Only process the shard i/N of the product's rasters, where 0 <= i < N",
+)
+@click.option(
+    "--partition-method",
+    type=click.Choice(PARTITION_METHODS),
+    default="time",
+    help="Method used to split the rasters into shards",
+)
+@click.option(
+    "--tasks-file",
+    type=click.Path(),
+    default=None,
+    help="File listing the rasters to process, as written by `create-tasks`",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=8,
+    help="Number of rasters to read concurrently",
+)
+def extract_time_series_cli(
+    product_name: str,
+    vector_file: str,
+    output_file: str,
+    id_column: str,
+    stac_dir: str,
+    measurement: str,
+    shard: str,
+    partition_method: str,
+    tasks_file: str,
+    max_workers: int,
+):
+    if stac_dir is not None:
+        rasters = get_rasters_from_stac_items(stac_dir, measurement)
+        if shard is not None:
+            rasters = get_shard_tasks(rasters, shard, partition_method)
+    else:
+        rasters = get_product_tasks(
+            product_name=product_name,
+            shard=shard,
+            partition_method=partition_method,
+            tasks_file=tasks_file,
+        )
+
+    gdf = load_vector_file(vector_file)
+    logger.info(f"Extracting the time series for {len(gdf)} geometries from {len(rasters)} rasters")
+
+    failed_rasters = extract_time_series(
+        gdf=gdf,
+        rasters=rasters,
+        output_file=output_file,
+        id_column=id_column,
+        max_workers=max_workers,
+    )
+    if len(failed_rasters) < len(rasters):
+        logger.info(f"Time series written to {output_file}")
+    if failed_rasters:
+        logger.warning(f"Failed to extract the time series from {len(failed_rasters)} rasters")
+
+
+if __name__ == "__main__":
+    extract_time_series_cli()
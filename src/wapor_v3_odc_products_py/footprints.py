@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+from affine import Affine
+from eodatasets3.images import GridSpec, MeasurementBundler, ValidDataMethod
+from rasterio.enums import Resampling
+from rasterio.transform import array_bounds
+from shapely.geometry import JOIN_STYLE, box, mapping, shape
+from shapely.geometry.base import BaseGeometry
+
+from wapor_v3_odc_products_py.block_cache import open_raster
+from wapor_v3_odc_products_py.io import check_file_exists, get_filesystem
+from wapor_v3_odc_products_py.logs import get_logger
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Maximum size in pixels of the longest side of the overview read
+# to compute the valid data mask from.
+OVERVIEW_MAX_SIZE = 2048
+
+# Number of overview pixels the valid data polygon is grown by, as a nearest
+# resampled overview can place the edge of the valid data up to a pixel inwards
+FOOTPRINT_BUFFER_PIXELS = 1
+
+
+def read_overview(
+    file_path: str | Path, max_size: int = OVERVIEW_MAX_SIZE
+) -> tuple[np.ndarray, GridSpec, dict]:
+    """
+    Read the first band of a raster from the finest COG overview whose longest side
+    is at most `max_size` pixels.
+
+    Parameters
+    ----------
+    file_path : str | Path
+        File path or URL of the raster.
+    max_size : int
+        Maximum size in pixels of the longest side of the array.
+
+    Returns
+    -------
+    tuple[np.ndarray, GridSpec, dict]
+        The array, the grid of the array and the nodata value, scale, offset and
+        decimation factor of the array.
+    """
+    with open_raster(file_path) as ds:
+        height, width = ds.shape
+        decimation = max(math.ceil(max(height, width) / max_size), 1)
+        # Snap to an overview level so GDAL does not need to resample.
+        overview_factors = [f for f in sorted(ds.overviews(1)) if f >= decimation]
+        if overview_factors:
+            decimation = overview_factors[0]
+
+        out_shape = (math.ceil(height / decimation), math.ceil(width / decimation))
+        array = ds.read(1, out_shape=out_shape, resampling=Resampling.nearest)
+        transform = ds.transform * Affine.scale(width / out_shape[1], height / out_shape[0])
+        attributes = {
+            "nodata": ds.nodata,
+            "scale": ds.scales[0],
+            "offset": ds.offsets[0],
+            "decimation": decimation,
+        }
+        crs = ds.crs
+    return array, GridSpec(shape=out_shape, transform=transform, crs=crs), attributes
+
+
+def get_valid_mask(array: np.ndarray, nodata: float | None) -> np.ndarray:
+    """Get the valid data mask of an array from its nodata value."""
+    if nodata is None or math.isnan(nodata):
+        return np.isfinite(array) if np.issubdtype(array.dtype, np.floating) else array != 0
+    return array != nodata
+
+
+def read_overview_mask(
+    file_path: str | Path, max_size: int = OVERVIEW_MAX_SIZE
+) -> tuple[np.ndarray, GridSpec]:
+    """
+    Read a low resolution valid data mask for a raster from the finest COG
+    overview whose longest side is at most `max_size` pixels.
+
+    Parameters
+    ----------
+    file_path : str | Path
+        File path or URL of the raster.
+    max_size : int
+        Maximum size in pixels of the longest side of the mask.
+
+    Returns
+    -------
+    tuple[np.ndarray, GridSpec]
+        The boolean valid data mask and the grid of the mask.
+    """
+    array, grid, attributes = read_overview(file_path, max_size)
+    return get_valid_mask(array, attributes["nodata"]), grid
+
+
+def get_mask_fingerprint(mask: np.ndarray) -> str:
+    """Get a fingerprint of a valid data mask i.e. a hash of its shape and packed bits."""
+    digest = hashlib.sha256(str(mask.shape).encode("utf-8"))
+    digest.update(np.packbits(mask).tobytes())
+    return digest.hexdigest()
+
+
+def get_footprint(
+    mask: np.ndarray, grid: GridSpec, valid_data_method: ValidDataMethod
+) -> BaseGeometry:
+    """
+    Get the valid data polygon, in the CRS of the grid, for a valid data mask
+    using the same methods eodatasets3 uses for full resolution measurements.
+
+    The polygon is grown by FOOTPRINT_BUFFER_PIXELS pixels of the mask, within the
+    bounds of the grid, so a polygon from a decimated mask covers all the valid
+    data at full resolution rather than causing spatial queries to skip it. Valid
+    areas smaller than a mask pixel that the decimation misses entirely are not
+    recovered.
+    """
+    measurements = MeasurementBundler()
+    measurements.record_image(
+        "valid_data", grid, "", mask.astype("uint8"), nodata=0, expand_valid_data=True
+    )
+    footprint = measurements.consume_and_get_valid_data(valid_data_method=valid_data_method)
+
+    pixel_size = max(abs(grid.transform.a), abs(grid.transform.e))
+    bounds = box(*array_bounds(*grid.shape, grid.transform))
+    return footprint.buffer(
+        FOOTPRINT_BUFFER_PIXELS * pixel_size, join_style=JOIN_STYLE.mitre
+    ).intersection(bounds)
+
+
+class FootprintCache:
+    """
+    Cache of valid data polygons keyed by product and by the fingerprint of
+    the low resolution valid data mask of a raster.
+
+    The cache is held in memory and, if `cache_dir` is given, also persisted
+    as GeoJSON files so it can be shared between runs and workers.
+    """
+
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = cache_dir
+        self._footprints = {}
+
+    def _get_cache_path(self, product_name: str, key: str) -> str:
+        return os.path.join(self.cache_dir, product_name, f"{key}.geojson")
+
+    def get(self, product_name: str, key: str) -> BaseGeometry | None:
+        if (product_name, key) in self._footprints:
+            return self._footprints[(product_name, key)]
+
+        if self.cache_dir is not None:
+            cache_path = self._get_cache_path(product_name, key)
+            if check_file_exists(cache_path):
+                fs = get_filesystem(path=cache_path, anon=False)
+                with fs.open(cache_path, "r") as file:
+                    footprint = shape(json.load(file))
+                self._footprints[(product_name, key)] = footprint
+                return footprint
+        return None
+
+    def put(self, product_name: str, key: str, footprint: BaseGeometry):
+        self._footprints[(product_name, key)] = footprint
+
+        if self.cache_dir is not None:
+            cache_path = self._get_cache_path(product_name, key)
+            fs = get_filesystem(path=cache_path, anon=False)
+            fs.mkdirs(os.path.dirname(cache_path), exist_ok=True)
+            with fs.open(cache_path, "w") as file:
+                json.dump(mapping(footprint), file)
+
+    def get_footprint(
+        self,
+        product_name: str,
+        file_path: str | Path,
+        valid_data_method: ValidDataMethod,
+    ) -> BaseGeometry:
+        """
+        Get the valid data polygon for a raster, computing it from an overview
+        read only if no raster with the same valid data mask has been seen before.
+        """
+        mask, grid = read_overview_mask(file_path)
+        key = (
+            f"{get_mask_fingerprint(mask)}_{valid_data_method.name}"
+            f"_buffer{FOOTPRINT_BUFFER_PIXELS}"
+        )
+
+        footprint = self.get(product_name, key)
+        if footprint is None:
+            logger.info(f"Computing the {valid_data_method.name} footprint for {file_path}")
+            footprint = get_footprint(mask, grid, valid_data_method)
+            self.put(product_name, key, footprint)
+        else:
+            logger.debug(f"Using the cached footprint {key} for {file_path}")
+        return footprint
@@ -0,0 +1,143 @@
+import _thread
+import logging
+import signal
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import psutil
+
+from wapor_v3_odc_products_py.block_cache import open_raster
+from wapor_v3_odc_products_py.cog_header import CogHeader
+from wapor_v3_odc_products_py.logs import get_logger
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+ON_LIMIT_ACTIONS = ["fallback", "abort"]
+
+MB = 1024 * 1024
+
+
+class ResourceLimitExceeded(RuntimeError):
+    """Raised when processing an item exceeds its memory or time limit."""
+
+
+def estimate_read_bytes(file_path: str, header: CogHeader = None) -> int:
+    """
+    Estimate the memory needed to read all the pixels of a raster and build its
+    valid data mask, from the raster header, or from `header` if it was already read.
+    """
+    if header is not None:
+        (height, width), dtype = header.shape, header.dtype
+    else:
+        with open_raster(file_path) as ds:
+            (height, width), dtype = ds.shape, ds.dtypes[0]
+    # The pixels of the first band plus a boolean valid data mask
+    return height * width * (np.dtype(dtype).itemsize + 1)
+
+
+class ResourceGuard:
+    """
+    Context manager tracking the peak RSS, peak traced Python allocations and wall
+    time of processing one item, and enforcing optional memory and time limits.
+
+    Limits are enforced by raising ResourceLimitExceeded in the main thread, which
+    happens once the current call into C code (e.g. a raster read) returns. The guard
+    only limits the Python level work: it can't interrupt a single large read, which
+    may exhaust the memory of the node before returning, so reads too large for the
+    limit have to be avoided up front with `estimate_read_bytes`. In other threads
+    the limits are only recorded in the report.
+
+    Parameters
+    ----------
+    name : str
+        Name of the item recorded in the report.
+    max_memory_mb : float
+        Maximum increase in RSS in MB while processing the item.
+    max_seconds : float
+        Maximum wall time in seconds to process the item.
+    sample_interval : float
+        Interval in seconds at which the RSS is sampled.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_memory_mb: float = None,
+        max_seconds: float = None,
+        sample_interval: float = 0.05,
+    ):
+        self.name = name
+        self.max_memory_mb = max_memory_mb
+        self.max_seconds = max_seconds
+        self.sample_interval = sample_interval
+        self.exceeded = None
+        self.report = {}
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._enforce = False
+
+    def _raise_exceeded(self, signum, frame):
+        if self.exceeded is None:
+            self.exceeded = "time"
+        raise ResourceLimitExceeded(f"{self.name} exceeded its {self.exceeded} limit")
+
+    def _sample_rss(self):
+        while not self._stop.wait(self.sample_interval):
+            rss = self._process.memory_info().rss
+            self._peak_rss = max(self._peak_rss, rss)
+            if (
+                self.max_memory_mb is not None
+                and self.exceeded is None
+                and (rss - self._start_rss) / MB > self.max_memory_mb
+            ):
+                self.exceeded = "memory"
+                if self._enforce:
+                    _thread.interrupt_main(signal.SIGALRM)
+
+    def __enter__(self):
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+
+        self._start_rss = self._peak_rss = self._process.memory_info().rss
+        self._start_time = time.monotonic()
+
+        self._enforce = threading.current_thread() is threading.main_thread()
+        if self._enforce:
+            self._previous_handler = signal.signal(signal.SIGALRM, self._raise_exceeded)
+            if self.max_seconds is not None:
+                signal.setitimer(signal.ITIMER_REAL, self.max_seconds)
+
+        self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._sampler.join()
+        if self._enforce:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._previous_handler)
+
+        self._peak_rss = max(self._peak_rss, self._process.memory_info().rss)
+        _, traced_peak = tracemalloc.get_traced_memory()
+        if self._started_tracing:
+            tracemalloc.stop()
+
+        seconds = time.monotonic() - self._start_time
+        if self.max_seconds is not None and self.exceeded is None and seconds > self.max_seconds:
+            self.exceeded = "time"
+
+        self.report = {
+            "name": self.name,
+            "seconds": round(seconds, 3),
+            "peak_rss_mb": round(self._peak_rss / MB, 1),
+            "rss_increase_mb": round((self._peak_rss - self._start_rss) / MB, 1),
+            "traced_peak_mb": round(traced_peak / MB, 1),
+            "exceeded": self.exceeded,
+        }
+        return False
@@ -1,6 +1,10 @@
+import functools
+import json
 import logging
 import os
 import re
+import threading
+import time
 from pathlib import Path
 
 import fsspec
@@ -12,9 +16,31 @@ from fsspec.implementations.local import LocalFileSystem
 from s3fs.core import S3FileSystem
 
 from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.throttle import call_throttled, get_host
 
 logger = get_logger(Path(__file__).stem, level=logging.INFO)
 
+# GDAL configuration kept open by long lived workers, so connections and cached
+# file headers are reused between work items
+GDAL_ENV_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "VSI_CACHE": "TRUE",
+}
+
+# Environment variable pointing to a JSON file mapping source prefixes to the
+# prefixes of their local or S3 mirror, as recorded by `mirror-rasters`
+MIRROR_MAP_ENV = "WAPOR_MIRROR_MAP"
+
+# Suffix of the file next to a mirrored raster recording the source version it
+# was mirrored from
+MIRROR_SIDECAR_SUFFIX = ".mirror.json"
+
+# Seconds whether a raster's mirrored copy is current is trusted before being
+# checked again, so long running services pick up newly mirrored or republished rasters
+MIRROR_CHECK_TTL_SECONDS = 600
+
 
 def is_s3_path(path: str) -> bool:
     return path.startswith("s3://")
@@ -46,7 +72,7 @@ def get_filesystem(
 
 def check_file_exists(path: str) -> bool:
     fs = get_filesystem(path=path, anon=True)
-    if fs.exists(path) and fs.isfile(path):
+    if call_throttled(get_host(path), lambda: fs.exists(path) and fs.isfile(path)):
         return True
     else:
         return False
@@ -54,12 +80,123 @@ def check_file_exists(path: str) -> bool:
 
 def check_directory_exists(path: str) -> bool:
     fs = get_filesystem(path=path, anon=True)
-    if fs.exists(path) and fs.isdir(path):
+    if call_throttled(get_host(path), lambda: fs.exists(path) and fs.isdir(path)):
         return True
     else:
         return False
 
 
+@functools.lru_cache(maxsize=None)
+def get_mirror_map() -> dict[str, str]:
+    """
+    Get the mapping of source prefixes to mirror prefixes from the file set in
+    WAPOR_MIRROR_MAP, or an empty mapping if no mirror is configured.
+    """
+    map_file = os.environ.get(MIRROR_MAP_ENV)
+    if not map_file:
+        return {}
+    with open(map_file) as file:
+        mirror_map = json.load(file)
+    logger.info(f"Preferring mirrored rasters from {map_file}")
+    # Match the longest, most specific, prefixes first
+    return dict(sorted(mirror_map.items(), key=lambda item: len(item[0]), reverse=True))
+
+
+def get_remote_filesystem(path: str):
+    if is_url(path):
+        return fsspec.filesystem("https")
+    return get_filesystem(path=path, anon=True)
+
+
+def get_file_version(info: dict) -> str:
+    """Get a value that changes when a file is rewritten, from its fsspec info."""
+    for key in ("generation", "ETag", "etag", "md5Hash", "LastModified", "updated", "mtime"):
+        if info.get(key) is not None:
+            return str(info[key])
+    return ""
+
+
+def read_mirror_sidecar(mirror_path: str) -> dict | None:
+    """Read the source version a raster was mirrored from, or None if it isn't mirrored."""
+    sidecar_path = f"{mirror_path}{MIRROR_SIDECAR_SUFFIX}"
+    fs = get_filesystem(path=sidecar_path, anon=False)
+    try:
+        return json.loads(call_throttled(get_host(sidecar_path), fs.cat_file, sidecar_path))
+    except FileNotFoundError:
+        return None
+
+
+_mirror_checks: dict[str, tuple[float, bool]] = {}
+_mirror_checks_lock = threading.Lock()
+
+
+def check_mirror_is_current(source: str, mirror_path: str) -> bool:
+    """
+    Check a raster has been mirrored from the current version of the source, by
+    comparing the version recorded next to the mirrored copy with the version of
+    the source. The result is trusted for MIRROR_CHECK_TTL_SECONDS.
+
+    If the source can't be reached the mirrored copy is trusted, so rasters can be
+    reprocessed from the mirror while the source is unavailable.
+    """
+    with _mirror_checks_lock:
+        checked = _mirror_checks.get(mirror_path)
+    if checked is not None and time.time() - checked[0] < MIRROR_CHECK_TTL_SECONDS:
+        return checked[1]
+
+    sidecar = read_mirror_sidecar(mirror_path)
+    if sidecar is None:
+        is_current = False
+    else:
+        source_fs = get_remote_filesystem(source)
+        try:
+            info = call_throttled(get_host(source), source_fs.info, source)
+        except FileNotFoundError:
+            is_current = False
+        except Exception as error:
+            logger.warning(f"Failed to check the version of {source}, using its mirror: {error}")
+            is_current = True
+        else:
+            is_current = sidecar["version"] == get_file_version(info)
+            if not is_current:
+                logger.warning(f"The mirror of {source} is out of date, reading the source")
+
+    with _mirror_checks_lock:
+        _mirror_checks[mirror_path] = (time.time(), is_current)
+    return is_current
+
+
+def resolve_mirror_path(path: str | Path) -> str | Path:
+    """
+    Rewrite the path of a raster to its mirrored copy if the raster has been
+    mirrored from the current version of the source, otherwise return the path
+    unchanged.
+
+    The version of the mirrored copy is recorded once it is complete and verified,
+    so a raster that is missing, still downloading or out of date in the mirror is
+    read from the source.
+
+    Parameters
+    ----------
+    path : str | Path
+        Path or public URL of the raster.
+
+    Returns
+    -------
+    str | Path
+        Path of the mirrored raster, or `path`.
+    """
+    mirror_map = get_mirror_map()
+    if not mirror_map:
+        return path
+    source = str(path).replace("https://storage.googleapis.com/", "gs://")
+    for source_prefix, mirror_prefix in mirror_map.items():
+        if source.startswith(source_prefix):
+            mirror_path = mirror_prefix + source[len(source_prefix) :]
+            return mirror_path if check_mirror_is_current(source, mirror_path) else path
+    return path
+
+
 def check_file_extension(path: str, accepted_file_extensions: list[str]) -> bool:
     _, file_extension = os.path.splitext(path)
     if file_extension.lower() in accepted_file_extensions:
@@ -80,9 +217,14 @@ def is_geotiff(path: str) -> bool:
 
 def load_vector_file(path: str) -> gpd.GeoDataFrame:
     if is_parquet(path=path):
-        gdf = gpd.read_parquet(path, filesystem=get_filesystem(path=path, anon=True))
+        gdf = call_throttled(
+            get_host(path),
+            gpd.read_parquet,
+            path,
+            filesystem=get_filesystem(path=path, anon=True),
+        )
     else:
-        gdf = gpd.read_file(path)
+        gdf = call_throttled(get_host(path), gpd.read_file, path)
     return gdf
 
 
@@ -93,7 +235,9 @@ def find_geotiff_files(directory_path: str, file_name_pattern: str = ".*") -> li
 
     geotiff_file_paths = []
 
-    for root, dirs, files in fs.walk(directory_path):
+    for root, dirs, files in call_throttled(
+        get_host(directory_path), lambda: list(fs.walk(directory_path))
+    ):
         for file_name in files:
             if is_geotiff(path=file_name):
                 if re.search(file_name_pattern, file_name):
@@ -117,7 +261,9 @@ def find_parquet_files(directory_path: str, file_name_pattern: str = ".*") -> li
 
     parquet_file_paths = []
 
-    for root, dirs, files in fs.walk(directory_path):
+    for root, dirs, files in call_throttled(
+        get_host(directory_path), lambda: list(fs.walk(directory_path))
+    ):
         for file_name in files:
             if is_parquet(path=file_name):
                 if re.search(file_name_pattern, file_name):
@@ -0,0 +1,242 @@
+import logging
+import math
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+from datacube import Datacube
+from datacube.storage import measurement_paths
+
+from wapor_v3_odc_products_py.block_cache import open_raster
+from wapor_v3_odc_products_py.logs import get_logger
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Target size in bytes of a single dask chunk of a measurement.
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def get_storage_profile(file_path: str) -> dict:
+    """
+    Get the storage profile of a raster from its header.
+
+    Parameters
+    ----------
+    file_path : str
+        File path or URL of the raster.
+
+    Returns
+    -------
+    dict
+        The CRS, resolution, shape, internal block shape, overview factors,
+        data type, nodata, scale factor and offset of the raster.
+    """
+    with open_raster(file_path) as ds:
+        res_x, res_y = ds.res
+        block_y, block_x = ds.block_shapes[0]
+        profile = {
+            "crs": ds.crs.to_string(),
+            "res_x": res_x,
+            "res_y": res_y,
+            "transform": ds.transform,
+            "shape": ds.shape,
+            "block_shape": (block_y, block_x),
+            "overview_factors": sorted(ds.overviews(1)),
+            "dtype": ds.dtypes[0],
+            "nodata": ds.nodata,
+            "scale_factor": ds.scales[0],
+            "add_offset": ds.offsets[0],
+        }
+    return profile
+
+
+def get_product_storage_profile(dc: Datacube, product: str) -> dict:
+    """
+    Get the storage profile of a product, with the layout read from the header
+    of one of the product's datasets and the per measurement data type, nodata,
+    scale factor and offset taken from the product definition.
+    """
+    datasets = dc.find_datasets(product=product, limit=1)
+    if not datasets:
+        raise ValueError(f"No datasets found for the product {product}")
+
+    paths = measurement_paths(datasets[0])
+    profile = get_storage_profile(next(iter(paths.values())))
+
+    profile["measurements"] = {}
+    for name, measurement in dc.index.products.get_by_name(product).measurements.items():
+        profile["measurements"][name] = {
+            "dtype": measurement["dtype"],
+            "nodata": measurement.get("nodata", profile["nodata"]),
+            "scale_factor": measurement.get("scale_factor", profile["scale_factor"]),
+            "add_offset": measurement.get("add_offset", profile["add_offset"]),
+        }
+    return profile
+
+
+def select_overview_factor(
+    native_resolution: float, target_resolution: float, overview_factors: list[int]
+) -> int:
+    """
+    Select the coarsest overview whose resolution is not coarser than the
+    target resolution, or 1 for the full resolution image.
+    """
+    factor = 1
+    for overview_factor in sorted(overview_factors):
+        if native_resolution * overview_factor <= abs(target_resolution) * (1 + 1e-9):
+            factor = overview_factor
+    return factor
+
+
+def get_spatial_dims(crs: str) -> tuple[str, str]:
+    """
+    Get the names datacube gives the y and x dimensions of data loaded in a CRS,
+    latitude and longitude for EPSG:4326 and y and x otherwise.
+    """
+    if crs == "EPSG:4326":
+        return "latitude", "longitude"
+    return "y", "x"
+
+
+def get_dask_chunks(
+    block_shape: tuple[int, int], dtype: str, chunk_bytes: int = DEFAULT_CHUNK_BYTES
+) -> dict:
+    """
+    Get dask chunks for one time step that are a whole number of COG blocks
+    and at most `chunk_bytes` in size.
+    """
+    block_y, block_x = block_shape
+    block_bytes = block_y * block_x * np.dtype(dtype).itemsize
+    blocks_per_side = max(int(math.sqrt(chunk_bytes / block_bytes)), 1)
+    return {"time": 1, "y": block_y * blocks_per_side, "x": block_x * blocks_per_side}
+
+
+def align_to_blocks(
+    x: tuple[float, float],
+    y: tuple[float, float],
+    transform,
+    block_shape: tuple[int, int],
+    factor: int = 1,
+) -> tuple[tuple[float, float], tuple[float, float]]:
+    """
+    Expand a query extent outwards to the edges of the COG blocks
+    (of the overview level `factor`) of a raster with the given transform.
+    """
+    block_y, block_x = block_shape
+    block_width = transform.a * block_x * factor
+    block_height = abs(transform.e) * block_y * factor
+
+    min_x = transform.c + math.floor((min(x) - transform.c) / block_width) * block_width
+    max_x = transform.c + math.ceil((max(x) - transform.c) / block_width) * block_width
+    max_y = transform.f - math.floor((transform.f - max(y)) / block_height) * block_height
+    min_y = transform.f - math.ceil((transform.f - min(y)) / block_height) * block_height
+    return (min_x, max_x), (min_y, max_y)
+
+
+def to_float(ds: xr.Dataset, profile: dict) -> xr.Dataset:
+    """
+    Apply the scale factor and offset of each measurement and mask the nodata
+    pixels, returning float32 measurements.
+    """
+    scaled = {}
+    for name, da in ds.data_vars.items():
+        measurement = profile["measurements"].get(name, profile)
+        nodata = measurement["nodata"]
+        scale_factor = measurement["scale_factor"] or 1
+        add_offset = measurement["add_offset"] or 0
+        valid = da != nodata if nodata is not None and not np.isnan(nodata) else da.notnull()
+        scaled_da = da.where(valid).astype("float32") * np.float32(scale_factor) + np.float32(
+            add_offset
+        )
+        scaled_da.attrs = {k: v for k, v in da.attrs.items() if k not in ["nodata"]}
+        scaled_da.attrs["nodata"] = np.nan
+        scaled[name] = scaled_da
+    return ds.assign(scaled)
+
+
+def load_product(
+    dc: Datacube,
+    product: str,
+    x: tuple[float, float],
+    y: tuple[float, float],
+    resolution: float = None,
+    snap_to_overview: bool = False,
+    as_float: bool = False,
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+    **query,
+) -> xr.Dataset:
+    """
+    Lazily load a product with dask chunks aligned to the COG blocks of its datasets.
+
+    The query extent is expanded to the block edges so every dask chunk reads
+    whole blocks. For output resolutions coarser than the native resolution GDAL
+    reads from the matching COG overview, and the resolution can optionally be
+    snapped to the overview's resolution so its pixels are read without resampling.
+
+    Only the header of the dataset the storage profile is read from goes through the
+    block cache. The pixels are read by datacube, which opens the rasters with GDAL
+    directly, so they are not cached.
+
+    Parameters
+    ----------
+    dc : Datacube
+        Datacube to load the product from.
+    product : str
+        Name of the product to load.
+    x : tuple[float, float]
+        Extent in the x dimension in the CRS of the product.
+    y : tuple[float, float]
+        Extent in the y dimension in the CRS of the product.
+    resolution : float
+        Output resolution in the units of the CRS of the product.
+        Default is the native resolution.
+    snap_to_overview : bool
+        Load at the resolution of the coarsest overview not coarser than
+        `resolution` instead of at `resolution`.
+    as_float : bool
+        Apply the scale factor and offset and mask nodata, returning float32
+        measurements. Default is to keep the stored (scaled integer) values.
+    chunk_bytes : int
+        Target size in bytes of a single dask chunk.
+    **query
+        Other arguments passed to `Datacube.load` e.g. time, measurements.
+
+    Returns
+    -------
+    xr.Dataset
+        The dask backed dataset.
+    """
+    profile = get_product_storage_profile(dc, product)
+
+    native_resolution = profile["res_x"]
+    if resolution is None:
+        resolution = native_resolution
+    resolution = abs(resolution)
+    factor = select_overview_factor(native_resolution, resolution, profile["overview_factors"])
+    if factor > 1:
+        logger.info(f"Loading {product} from the overview with decimation factor {factor}")
+        if snap_to_overview:
+            resolution = native_resolution * factor
+
+    transform = profile["transform"]
+    x, y = align_to_blocks(x, y, transform, profile["block_shape"], factor)
+    chunks = get_dask_chunks(profile["block_shape"], profile["dtype"], chunk_bytes)
+    # Keyed by the dimension names of the loaded data, which depend on the CRS
+    y_dim, x_dim = get_spatial_dims(profile["crs"])
+    dask_chunks = {"time": chunks["time"], y_dim: chunks["y"], x_dim: chunks["x"]}
+
+    ds = dc.load(
+        product=product,
+        x=x,
+        y=y,
+        output_crs=profile["crs"],
+        resolution=(-resolution, resolution),
+        align=(transform.c % resolution, transform.f % resolution),
+        dask_chunks=dask_chunks,
+        resampling="nearest",
+        **query,
+    )
+
+    if as_float:
+        ds = to_float(ds, profile)
+    return ds
@@ -0,0 +1,118 @@
+import collections
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+import click
+import yaml
+
+from wapor_v3_odc_products_py.io import check_directory_exists, get_filesystem
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.storage_parameters import get_recommended_product_section
+from wapor_v3_odc_products_py.tasks import get_task_id, write_tasks_file
+from wapor_v3_odc_products_py.utils import get_unique_dicts
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Shard suffix of a per-shard output, before the file extension if it has one
+SHARD_SUFFIX_PATTERN = r"_shard_\d+_of_\d+(?=(\.yaml)?$)"
+
+RECOMMENDED_SECTION_SUFFIX = "_recommended_product_section.yaml"
+
+
+def get_merged_output_name(file_path: str) -> str:
+    """Get the name of the merged output a per-shard output file is merged into."""
+    return re.sub(SHARD_SUFFIX_PATTERN, "", os.path.basename(file_path))
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the product to merge the per-shard outputs for",
+)
+@click.option(
+    "--input-dir",
+    type=click.Path(),
+    help="Directory containing the per-shard output files",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(),
+    help="Directory to write the merged output files to",
+)
+def merge_shard_outputs(
+    product_name: str,
+    input_dir: str,
+    output_dir: str,
+):
+    fs = get_filesystem(path=input_dir, anon=False)
+    output_fs = get_filesystem(path=output_dir, anon=False)
+    if not check_directory_exists(path=output_dir):
+        output_fs.mkdirs(path=output_dir, exist_ok=True)
+        logger.info(f"Created directory {output_dir}")
+
+    # Group the per-shard files by the name of the merged output.
+    shard_outputs = collections.defaultdict(list)
+    for file_path in sorted(fs.glob(os.path.join(input_dir, f"{product_name}_*_shard_*_of_*"))):
+        shard_outputs[get_merged_output_name(file_path)].append(file_path)
+
+    merged_storage_parameters = {}
+    for output_name, file_paths in shard_outputs.items():
+        output_file = os.path.join(output_dir, output_name)
+        if output_name.endswith("_storage_parameters"):
+            # Storage parameters from each shard are merged into a single unique set.
+            storage_parameters_list = []
+            for file_path in file_paths:
+                with fs.open(file_path, "r") as file:
+                    storage_parameters_list.extend(json.load(file))
+            merged_storage_parameters[output_name] = get_unique_dicts(storage_parameters_list)
+            with output_fs.open(output_file, "w") as file:
+                file.write(json.dumps(merged_storage_parameters[output_name]))
+        elif output_name.endswith("_run_report"):
+            # Run reports from each shard are concatenated.
+            run_report = []
+            for file_path in file_paths:
+                with fs.open(file_path, "r") as file:
+                    run_report.extend(json.load(file))
+            with output_fs.open(output_file, "w") as file:
+                json.dump(run_report, file, indent=2)
+        elif output_name.endswith("_failed_tasks"):
+            # Failed tasks from each shard are merged into a single tasks file
+            # that can be rerun using the `--tasks-file` option.
+            failed_tasks = set()
+            for file_path in file_paths:
+                with fs.open(file_path, "r") as file:
+                    failed_tasks.update(json.load(file))
+            write_tasks_file(sorted(failed_tasks, key=get_task_id), output_file)
+        else:
+            continue
+        logger.info(f"Merged {len(file_paths)} per-shard files into {output_file}")
+
+    for output_name, file_paths in shard_outputs.items():
+        if not output_name.endswith(RECOMMENDED_SECTION_SUFFIX):
+            continue
+        # Each shard only recommends from its own rasters, so the recommendation is
+        # recomputed from the merged storage parameters. These are unique, so the most
+        # common layout is the one shared by the most distinct sets of parameters.
+        storage_parameters_name = output_name.replace(
+            RECOMMENDED_SECTION_SUFFIX, "_storage_parameters"
+        )
+        storage_parameters_list = merged_storage_parameters.get(storage_parameters_name)
+        if not storage_parameters_list:
+            logger.warning(f"No per-shard storage parameters to recommend {output_name} from")
+            continue
+        output_file = os.path.join(output_dir, output_name)
+        with output_fs.open(output_file, "w") as file:
+            yaml.safe_dump(
+                get_recommended_product_section(storage_parameters_list), file, sort_keys=False
+            )
+        logger.info(f"Recommended product definition sections written to {output_file}")
+
+    if not shard_outputs:
+        logger.warning(f"No per-shard outputs found for {product_name} in {input_dir}")
+
+
+if __name__ == "__main__":
+    merge_shard_outputs()
@@ -0,0 +1,360 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import click
+from fsspec.core import split_protocol
+
+from wapor_v3_odc_products_py.io import (
+    MIRROR_SIDECAR_SUFFIX,
+    get_file_version,
+    get_filesystem,
+    get_remote_filesystem,
+    is_s3_path,
+    read_mirror_sidecar,
+)
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.tasks import (
+    PARTITION_METHODS,
+    get_product_tasks,
+    get_shard_suffix,
+    get_task_id,
+    write_tasks_file,
+)
+from wapor_v3_odc_products_py.throttle import call_throttled, get_host
+from wapor_v3_odc_products_py.writes import get_json_bytes, write_bytes
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Size of the byte ranges downloaded in parallel
+DEFAULT_PART_SIZE_MB = 64
+
+# Suffixes of the partial download of a raster and of its completed parts
+PART_SUFFIX = ".part"
+PART_STATE_SUFFIX = ".part.json"
+
+# Size of the chunks read when checksumming a downloaded file
+CHECKSUM_BLOCK_SIZE = 2**24
+
+
+def get_mirror_prefix(source: str, mirror_dir: str) -> tuple[str, str]:
+    """
+    Get the source prefix of a raster's bucket, or file system root, and the
+    prefix it is mirrored to under `mirror_dir`.
+    """
+    protocol, path = split_protocol(source)
+    root = path.lstrip("/").split("/", 1)[0]
+    source_prefix = f"{protocol}://{root}/" if protocol else f"/{root}/"
+    return source_prefix, f"{mirror_dir.rstrip('/')}/{root}/"
+
+
+def get_mirror_path(source: str, mirror_dir: str) -> str:
+    """Get the path a raster is mirrored to, keeping its bucket and key under `mirror_dir`."""
+    source_prefix, mirror_prefix = get_mirror_prefix(source, mirror_dir)
+    return mirror_prefix + source.removeprefix(source_prefix)
+
+
+def get_part_ranges(size: int, part_size: int) -> list[tuple[int, int]]:
+    """Split a file of `size` bytes into [start, end) ranges of at most `part_size` bytes."""
+    return [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+
+
+def get_md5_hash(path: str) -> str:
+    """Base64 encoded MD5 of a local file, as GCS reports in an object's md5Hash."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHECKSUM_BLOCK_SIZE):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode("ascii")
+
+
+def verify_download(path: str, info: dict):
+    """
+    Check a downloaded file has the size and, where the source reports one, the
+    MD5 checksum of the source file.
+
+    :param path: Path of the downloaded file
+    :param info: fsspec info of the source file
+    :raises ValueError: If the file doesn't match the source
+    """
+    size = os.path.getsize(path)
+    if size != info["size"]:
+        raise ValueError(f"{path} has {size} bytes, expected {info['size']}")
+
+    # Composite GCS objects and multipart S3 uploads have no MD5 of their content
+    expected_md5 = info.get("md5Hash")
+    etag = str(info.get("ETag") or "").strip('"')
+    if expected_md5 is None and etag and "-" not in etag:
+        expected_md5 = base64.b64encode(bytes.fromhex(etag)).decode("ascii")
+    if expected_md5 is not None and get_md5_hash(path) != expected_md5:
+        raise ValueError(f"{path} doesn't match the MD5 checksum {expected_md5} of the source")
+
+
+def _write_json(path: str, doc: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(get_json_bytes(doc))
+    os.replace(tmp_path, path)
+
+
+def download_file(
+    source: str,
+    destination: str,
+    info: dict,
+    part_size: int,
+    max_workers: int,
+):
+    """
+    Download a file with parallel range requests into a partial file, resuming
+    the parts a previous interrupted download completed for the same version of
+    the source, and move it into place once its size and checksum are verified.
+
+    :param source: Path or URL of the file to download
+    :param destination: Local path to download the file to
+    :param info: fsspec info of the source file
+    :param part_size: Size in bytes of the ranges downloaded in parallel
+    :param max_workers: Number of ranges downloaded concurrently
+    """
+    part_path = f"{destination}{PART_SUFFIX}"
+    state_path = f"{destination}{PART_STATE_SUFFIX}"
+    version = get_file_version(info)
+
+    state = None
+    if os.path.exists(part_path) and os.path.exists(state_path):
+        with open(state_path) as file:
+            state = json.load(file)
+        if state.get("version") != version or state.get("size") != info["size"]:
+            logger.info(f"{source} has changed since its partial download, restarting")
+            state = None
+    if state is None:
+        state = {"version": version, "size": info["size"], "parts": []}
+        with open(part_path, "wb") as file:
+            file.truncate(info["size"])
+        _write_json(state_path, state)
+
+    ranges = get_part_ranges(info["size"], part_size)
+    completed = set(state["parts"])
+    pending = [i for i in range(len(ranges)) if i not in completed]
+    if completed:
+        logger.info(f"Resuming {source}, {len(completed)} of {len(ranges)} parts already done")
+
+    fs = get_remote_filesystem(source)
+    host = get_host(source)
+    lock = threading.Lock()
+
+    def download_part(index: int):
+        start, end = ranges[index]
+        data = call_throttled(host, fs.cat_file, source, start=start, end=end)
+        if len(data) != end - start:
+            raise IOError(f"Got {len(data)} bytes of {source} at {start}, expected {end - start}")
+        with open(part_path, "r+b") as file:
+            os.pwrite(file.fileno(), data, start)
+        with lock:
+            completed.add(index)
+            _write_json(state_path, {**state, "parts": sorted(completed)})
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in as_completed([executor.submit(download_part, i) for i in pending]):
+            future.result()
+
+    try:
+        verify_download(part_path, info)
+    except ValueError:
+        # Start again from scratch next time rather than resuming corrupt parts
+        os.remove(part_path)
+        os.remove(state_path)
+        raise
+    os.replace(part_path, destination)
+    os.remove(state_path)
+
+
+def mirror_raster(
+    source: str,
+    mirror_dir: str,
+    staging_dir: str = None,
+    part_size: int = DEFAULT_PART_SIZE_MB * 2**20,
+    max_workers: int = 8,
+) -> bool:
+    """
+    Mirror a raster to a local directory or S3, skipping rasters already mirrored
+    from the current generation, or ETag, of the source.
+
+    :param source: Path or gsutil URI of the raster
+    :param mirror_dir: Local directory or S3 prefix to mirror the raster to
+    :param staging_dir: Local directory rasters mirrored to S3 are downloaded to
+        before being uploaded
+    :param part_size: Size in bytes of the ranges downloaded in parallel
+    :param max_workers: Number of ranges downloaded concurrently
+    :return: True if the raster was downloaded, False if it was up to date
+    """
+    source_fs = get_remote_filesystem(source)
+    info = call_throttled(get_host(source), source_fs.info, source)
+    version = get_file_version(info)
+
+    destination = get_mirror_path(source, mirror_dir)
+    sidecar = read_mirror_sidecar(destination)
+    if sidecar is not None and sidecar["version"] == version and sidecar["size"] == info["size"]:
+        destination_fs = get_filesystem(path=destination, anon=False)
+        if call_throttled(get_host(destination), destination_fs.exists, destination):
+            return False
+
+    if is_s3_path(mirror_dir):
+        local_path = get_mirror_path(source, staging_dir or tempfile.gettempdir())
+    else:
+        local_path = destination
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    download_file(source, local_path, info, part_size, max_workers)
+
+    if is_s3_path(mirror_dir):
+        destination_fs = get_filesystem(path=destination, anon=False)
+        call_throttled(get_host(destination), destination_fs.put_file, local_path, destination)
+        os.remove(local_path)
+
+    doc = {"source": source, "version": version, "size": info["size"]}
+    write_bytes(
+        f"{destination}{MIRROR_SIDECAR_SUFFIX}",
+        get_json_bytes(doc),
+        content_type="application/json",
+    )
+    return True
+
+
+def record_mirror_map(map_file: str, mirror_map: dict[str, str]):
+    """Add source prefixes and the prefixes they are mirrored to, to a mirror map file."""
+    existing = {}
+    if os.path.exists(map_file):
+        with open(map_file) as file:
+            existing = json.load(file)
+    _write_json(map_file, {**existing, **mirror_map})
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the product to mirror the rasters of",
+)
+@click.option(
+    "--mirror-dir",
+    type=click.Path(),
+    help="Local directory or S3 prefix to mirror the rasters to",
+)
+@click.option(
+    "--staging-dir",
+    type=click.Path(),
+    default=None,
+    help="Local directory to download rasters mirrored to S3 to, before uploading them",
+)
+@click.option(
+    "--mirror-map-file",
+    type=click.Path(),
+    default=None,
+    help="JSON file to record the mirror in, to be read from by setting WAPOR_MIRROR_MAP to it",
+)
+@click.option(
+    "--shard",
+    type=str,
+    default=None,
+    help="Shard of the rasters to mirror, in the form index/count e.g. 0/4",
+)
+@click.option(
+    "--partition-method",
+    type=click.Choice(PARTITION_METHODS),
+    default="time",
+    help="Method used to split the rasters into shards",
+)
+@click.option(
+    "--tasks-file",
+    type=click.Path(),
+    default=None,
+    help="File listing the rasters to mirror, as written by `create-tasks`",
+)
+@click.option(
+    "--part-size-mb",
+    type=int,
+    default=DEFAULT_PART_SIZE_MB,
+    help="Size of the ranges of a raster downloaded in parallel",
+)
+@click.option(
+    "--max-files",
+    type=int,
+    default=4,
+    help="Number of rasters to mirror concurrently",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=8,
+    help="Number of ranges of each raster to download concurrently",
+)
+def mirror_rasters(
+    product_name: str,
+    mirror_dir: str,
+    staging_dir: str,
+    mirror_map_file: str,
+    shard: str,
+    partition_method: str,
+    tasks_file: str,
+    part_size_mb: int,
+    max_files: int,
+    max_workers: int,
+):
+    if not is_s3_path(mirror_dir):
+        mirror_dir = str(Path(mirror_dir).resolve())
+
+    rasters = get_product_tasks(
+        product_name=product_name,
+        shard=shard,
+        partition_method=partition_method,
+        tasks_file=tasks_file,
+    )
+    # Use a gsutil URI instead of the the public URL
+    rasters = [i.replace("https://storage.googleapis.com/", "gs://") for i in rasters]
+
+    failed_tasks = []
+    mirrored, skipped = 0, 0
+    with ThreadPoolExecutor(max_workers=max_files) as executor:
+        futures = {
+            executor.submit(
+                mirror_raster,
+                raster,
+                mirror_dir,
+                staging_dir,
+                part_size_mb * 2**20,
+                max_workers,
+            ): raster
+            for raster in rasters
+        }
+        for future in as_completed(futures):
+            raster = futures[future]
+            try:
+                downloaded = future.result()
+            except Exception as error:
+                logger.exception(error)
+                logger.error(f"Failed to mirror {raster}")
+                failed_tasks.append(raster)
+                continue
+            if downloaded:
+                mirrored += 1
+                logger.info(f"Mirrored {raster}")
+            else:
+                skipped += 1
+    logger.info(f"Mirrored {mirrored} rasters, {skipped} were already up to date")
+
+    if mirror_map_file is not None:
+        record_mirror_map(
+            mirror_map_file, dict(get_mirror_prefix(raster, mirror_dir) for raster in rasters)
+        )
+        logger.info(f"Recorded the mirror in {mirror_map_file}")
+
+    if failed_tasks:
+        failed_tasks_file = os.path.join(
+            mirror_dir, f"{product_name}_mirror_failed_tasks{get_shard_suffix(shard)}"
+        )
+        write_tasks_file(sorted(failed_tasks, key=get_task_id), failed_tasks_file)
+        logger.info(f"{len(failed_tasks)} failed tasks written to {failed_tasks_file}")
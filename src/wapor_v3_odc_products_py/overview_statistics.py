@@ -0,0 +1,114 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from wapor_v3_odc_products_py.footprints import (
+    OVERVIEW_MAX_SIZE,
+    get_valid_mask,
+    read_overview,
+)
+from wapor_v3_odc_products_py.logs import get_logger
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Prefix of the custom dataset properties the statistics are written to
+PROPERTY_PREFIX = "wapor"
+
+PERCENTILES = (10, 50, 90)
+
+# Maximum size in pixels of the longest side of the overview the statistics are
+# computed from. Coarser than the footprint overview as summary statistics do not
+# need the valid data edges to be accurate.
+STATISTICS_MAX_SIZE = OVERVIEW_MAX_SIZE // 2
+
+
+def get_array_statistics(
+    array: np.ndarray,
+    nodata: float | None,
+    scale: float = 1.0,
+    offset: float = 0.0,
+    percentiles: tuple[int] = PERCENTILES,
+) -> dict:
+    """
+    Compute the valid pixel fraction and the min, max, mean and percentiles of the
+    scaled valid pixels of an array.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        Array of raw pixel values.
+    nodata : float | None
+        Nodata value of the array.
+    scale : float
+        Scale factor applied to the raw pixel values.
+    offset : float
+        Offset added to the scaled pixel values.
+    percentiles : tuple[int]
+        Percentiles of the scaled pixel values to compute.
+
+    Returns
+    -------
+    dict
+        The statistics, keyed by the dataset property they are written to. Only the
+        valid pixel fraction is returned if the array has no valid pixels.
+    """
+    mask = get_valid_mask(array, nodata)
+    statistics = {f"{PROPERTY_PREFIX}:valid_fraction": round(float(mask.mean()), 4)}
+    if not mask.any():
+        return statistics
+
+    values = array[mask].astype("float64") * scale + offset
+    statistics[f"{PROPERTY_PREFIX}:min"] = round(float(values.min()), 4)
+    statistics[f"{PROPERTY_PREFIX}:max"] = round(float(values.max()), 4)
+    statistics[f"{PROPERTY_PREFIX}:mean"] = round(float(values.mean()), 4)
+    for percentile, value in zip(percentiles, np.percentile(values, percentiles)):
+        statistics[f"{PROPERTY_PREFIX}:p{percentile}"] = round(float(value), 4)
+    return statistics
+
+
+def get_overview_statistics(
+    file_path: str | Path,
+    max_size: int = STATISTICS_MAX_SIZE,
+    percentiles: tuple[int] = PERCENTILES,
+) -> dict:
+    """
+    Compute the summary statistics of a raster from its finest COG overview whose
+    longest side is at most `max_size` pixels, without reading full resolution pixels.
+    """
+    array, grid, attributes = read_overview(file_path, max_size)
+    return get_array_statistics(
+        array,
+        nodata=attributes["nodata"],
+        scale=attributes["scale"],
+        offset=attributes["offset"],
+        percentiles=percentiles,
+    )
+
+
+def get_rasters_statistics(
+    rasters: list[str], max_workers: int = 8, max_size: int = STATISTICS_MAX_SIZE
+) -> dict[str, dict]:
+    """
+    Compute the summary statistics of rasters in parallel. Rasters whose statistics
+    fail to compute are logged and left out of the result.
+
+    Returns
+    -------
+    dict[str, dict]
+        The statistics of each raster, by raster.
+    """
+
+    def get_statistics(raster: str) -> dict | None:
+        try:
+            return get_overview_statistics(raster, max_size=max_size)
+        except Exception as error:
+            logger.error(f"Failed to compute the statistics of {raster}: {error}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(get_statistics, rasters)
+        statistics = {raster: result for raster, result in zip(rasters, results) if result}
+    logger.info(f"Computed the statistics of {len(statistics)}/{len(rasters)} rasters")
+    return statistics
@@ -0,0 +1,158 @@
+import json
+import logging
+import math
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import tifffile
+from eodatasets3.images import ValidDataMethod
+
+from wapor_v3_odc_products_py.block_cache import open_file
+from wapor_v3_odc_products_py.footprints import OVERVIEW_MAX_SIZE
+from wapor_v3_odc_products_py.io import check_file_exists, get_filesystem
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.tasks import get_task_id
+from wapor_v3_odc_products_py.throttle import call_throttled, get_host
+from wapor_v3_odc_products_py.utils import get_last_modified
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Bytes GDAL reads in the first request when opening a GeoTIFF (GDAL_INGESTED_BYTES_AT_OPEN)
+GDAL_INGESTED_BYTES_AT_OPEN = 16384
+
+# Block size used to read remote files with fsspec
+HEADER_BLOCK_SIZE = 256 * 1024
+
+
+def get_file_layout(raster: str) -> dict:
+    """
+    Read the size of the header and the number of tiles and bytes of each resolution
+    level of a GeoTIFF from its header, without reading any pixels.
+
+    Returns
+    -------
+    dict
+        The header size in bytes, the time taken to read the header in seconds
+        and, for each level from full resolution to the coarsest overview, its
+        decimation factor, shape, number of tiles and compressed size in bytes.
+    """
+    start = time.monotonic()
+    with open_file(raster, block_size=HEADER_BLOCK_SIZE) as file:
+        with tifffile.TiffFile(file) as tif:
+            levels = []
+            for level in tif.series[0].levels:
+                page = level.pages[0]
+                levels.append(
+                    {
+                        "factor": round(tif.series[0].shape[-1] / level.shape[-1]),
+                        "shape": list(level.shape),
+                        "tiles": len(page.databytecounts),
+                        "bytes": int(sum(page.databytecounts)),
+                        "first_offset": int(min(page.dataoffsets)),
+                    }
+                )
+    header_bytes = min(level.pop("first_offset") for level in levels)
+    return {
+        "header_bytes": header_bytes,
+        "header_seconds": time.monotonic() - start,
+        "levels": levels,
+    }
+
+
+def get_header_requests(header_bytes: int) -> int:
+    """Estimate the number of range requests GDAL needs to read a header."""
+    return max(math.ceil(header_bytes / GDAL_INGESTED_BYTES_AT_OPEN), 1)
+
+
+def get_footprint_level(layout: dict, max_size: int = OVERVIEW_MAX_SIZE) -> dict:
+    """
+    Get the level the valid data mask is read from by `footprints.read_overview_mask`:
+    the finest overview whose longest side is at most `max_size` pixels.
+    """
+    height, width = layout["levels"][0]["shape"]
+    decimation = max(math.ceil(max(height, width) / max_size), 1)
+    levels = [level for level in layout["levels"] if level["factor"] >= decimation]
+    if levels:
+        return levels[0]
+    # Without a suitable overview GDAL decimates the full resolution image
+    return layout["levels"][0]
+
+
+def estimate_stac_item_cost(layout: dict, valid_data_method: ValidDataMethod) -> dict:
+    """
+    Estimate the remote requests and bytes read to create the stac item of one raster.
+
+    The bounds method only reads the header. Other methods also read the level the
+    valid data mask is computed from, at worst once per raster if no footprint is
+    cached. Tile requests are an upper bound as GDAL merges adjacent tile reads.
+    """
+    requests = 1 + get_header_requests(layout["header_bytes"])  # Last-Modified HEAD and header
+    bytes_read = layout["header_bytes"]
+    if valid_data_method is not ValidDataMethod.bounds:
+        level = get_footprint_level(layout)
+        requests += level["tiles"]
+        bytes_read += level["bytes"]
+    return {"requests": requests, "bytes_read": bytes_read}
+
+
+def get_modified_time(info: dict) -> datetime | None:
+    """Get the last modified time from the details of a file listed with fsspec."""
+    for key in ["LastModified", "updated", "mtime"]:
+        value = info.get(key)
+        if value is None:
+            continue
+        if isinstance(value, datetime):
+            return value
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value, tz=timezone.utc)
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return None
+
+
+def get_up_to_date_tasks(tasks: list[str], output_dir: str, suffix: str) -> list[str]:
+    """
+    Get the tasks whose output `{output_dir}/{task_id}{suffix}` exists and was written
+    after the source raster was last modified, from one listing of the output directory
+    and a HEAD request for each task with an output.
+    """
+    fs = get_filesystem(path=str(output_dir), anon=False)
+    try:
+        listing = call_throttled(
+            get_host(str(output_dir)), fs.ls, str(output_dir), detail=True, refresh=True
+        )
+    except FileNotFoundError:
+        return []
+    outputs = {os.path.basename(info["name"]): get_modified_time(info) for info in listing}
+
+    up_to_date = []
+    for task in tasks:
+        written = outputs.get(f"{get_task_id(task)}{suffix}")
+        if written is None:
+            continue
+        source_modified = get_last_modified(task)
+        if source_modified is not None and written >= source_modified:
+            up_to_date.append(task)
+    return up_to_date
+
+
+def get_recorded_seconds_per_item(run_report_file: str) -> float | None:
+    """Get the mean time taken per raster by a previous run, from its run report."""
+    if not check_file_exists(run_report_file):
+        return None
+    fs = get_filesystem(path=run_report_file, anon=False)
+    with fs.open(run_report_file, "r") as file:
+        run_report = json.load(file)
+    seconds = [item["seconds"] for item in run_report if item.get("status") == "ok"]
+    return sum(seconds) / len(seconds) if seconds else None
+
+
+def write_plan(plan: dict, plan_file: str):
+    """Log the estimates of a plan and write the plan to a JSON file."""
+    for key, value in plan["estimates"].items():
+        logger.info(f"{key}: {value}")
+    fs = get_filesystem(path=str(plan_file), anon=False)
+    with fs.open(str(plan_file), "w") as file:
+        json.dump(plan, file, indent=2)
+    logger.info(f"Plan written to {plan_file}")
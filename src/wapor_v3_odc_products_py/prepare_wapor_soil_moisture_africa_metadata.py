@@ -0,0 +1,104 @@
+#!python3
+# Prepare eo3 metadata for one tile of a re-tiled WaPOR v3 soil moisture raster.
+#
+## Main steps
+# 1. Populate EasiPrepare class from the source raster code and the tile
+# 2. Return the validated dataset doc
+
+import logging
+import os
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from eodatasets3.images import GridSpec, ValidDataMethod
+from eodatasets3.model import DatasetDoc
+
+from wapor_v3_odc_products_py.eo3assemble.easi_assemble import EasiPrepare
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.utils import get_dekad, get_last_modified
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+
+# Static namespace (seed) to generate uuids for datacube indexing
+UUID_NAMESPACE = uuid.UUID("12a05df0-ea16-4240-bdcc-9b6bc11bba63")
+
+
+def prepare_dataset(
+    dataset_path: str | Path,
+    product_yaml: str | Path,
+    source_dataset_path: str,
+    tile_index: str,
+    output_path: str = None,
+    grid: GridSpec = None,
+    array: np.ndarray = None,
+    nodata: float | int = None,
+    valid_data_method: ValidDataMethod = ValidDataMethod.filled,
+    processed: datetime = None,
+) -> DatasetDoc:
+    """
+    Prepare an eo3 metadata file for a tile of a WaPOR v3 soil moisture raster.
+    @param dataset_path: Path to the tile geotiff to create dataset metadata for.
+    @param product_yaml: Path to the product definition yaml file.
+    @param source_dataset_path: Path to the source raster the tile was cut from.
+    @param tile_index: Identifier of the tile in the tile grid e.g. x190y090.
+    @param output_path: Path to write the output metadata file.
+    @param grid: GridSpec of the tile. Default is to read from the dataset_path.
+    @param array: Pixels of the tile, used for the valid data polygon.
+        Default is to read from the dataset_path.
+    @param nodata: Nodata value of the tile. Default is to read from the dataset_path.
+    @param valid_data_method: Method used to compute the valid data polygon.
+    @param processed: When the source raster was created by the producer.
+        Default is to get it from the source_dataset_path.
+
+    :return: DatasetDoc
+    """
+    file_format = "GeoTIFF"
+    raster_code = os.path.basename(source_dataset_path).removesuffix(".tif")
+
+    p = EasiPrepare(dataset_path, product_yaml, output_path)
+
+    ## IDs and Labels should be dataset and Product unique
+    # The label combines the source raster code and the tile index as every
+    # source raster is cut into many tiles.
+    label = f"{raster_code.replace('.', '_')}_{tile_index}-{p.product_name}"
+    p.dataset_id = uuid.uuid5(UUID_NAMESPACE, label)
+    p.product_uri = f"https://explorer.digitalearth.africa/product/{p.product_name}"
+
+    ## Satellite, Instrument and Processing level
+    p.platform = "WaPORv3"
+    p.producer = "www.fao.org"
+    p.properties["odc:file_format"] = file_format
+    p.properties["odc:region_code"] = tile_index
+
+    ## Scene capture and Processing
+    # Datetime derived from the source raster code
+    year, month, dekad_label = raster_code.split(".")[-1].split("-")
+    input_datetime, time_range = get_dekad(year, month, dekad_label)
+    p.datetime = input_datetime
+    p.datetime_range = time_range
+
+    # When the source dataset was created by the producer, datetime object
+    processed_dt = processed or get_last_modified(source_dataset_path)
+    if processed_dt:
+        p.processed = processed_dt
+    p.dataset_version = "v3.0"
+
+    ## Geometry
+    # Tiles are small enough to compute a tight valid data polygon from the full
+    # resolution pixels, which lets ODC queries prune to the relevant tiles.
+    p.valid_data_method = valid_data_method
+
+    ## Add measurement paths
+    p.note_measurement(
+        "relative_soil_moisture",
+        dataset_path,
+        relative_to_metadata=False,
+        grid=grid,
+        array=array,
+        nodata=nodata,
+    )
+
+    return p.to_dataset_doc(validate_correctness=True, sort_measurements=True)
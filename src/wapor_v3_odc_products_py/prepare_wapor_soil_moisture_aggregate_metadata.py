@@ -0,0 +1,91 @@
+#!python3
+# Prepare eo3 metadata for one temporal aggregate of WaPOR v3 dekadal soil moisture rasters.
+#
+## Main steps
+# 1. Populate EasiPrepare class from the aggregate code and its source rasters
+# 2. Return the validated dataset doc
+
+import logging
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from eodatasets3.images import GridSpec, ValidDataMethod
+from eodatasets3.model import DatasetDoc
+
+from wapor_v3_odc_products_py.eo3assemble.easi_assemble import EasiPrepare
+from wapor_v3_odc_products_py.logs import get_logger
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+
+# Static namespace (seed) to generate uuids for datacube indexing
+UUID_NAMESPACE = uuid.UUID("5d0b3c0e-4f0e-4d67-9a55-1f0c4d0d7b7e")
+
+
+def prepare_dataset(
+    dataset_path: str | Path,
+    product_yaml: str | Path,
+    aggregate_code: str,
+    measurement_paths: dict[str, str],
+    datetime_range: tuple[datetime, datetime],
+    source_dataset_ids: list[uuid.UUID],
+    output_path: str = None,
+    grid: GridSpec = None,
+    processed: datetime = None,
+    properties: dict = None,
+) -> DatasetDoc:
+    """
+    Prepare an eo3 metadata file for a temporal aggregate of WaPOR v3 soil moisture rasters.
+    @param dataset_path: Path to the directory of the aggregate geotiffs.
+    @param product_yaml: Path to the product definition yaml file.
+    @param aggregate_code: Code of the aggregate e.g. WAPOR-3.L2-RSM-M.2020-01.
+    @param measurement_paths: Path to the geotiff of each measurement.
+    @param datetime_range: Start and end datetimes of the source rasters.
+    @param source_dataset_ids: UUIDs of the datasets of the source rasters.
+    @param output_path: Path to write the output metadata file.
+    @param grid: GridSpec shared by the measurements. Default is to read from the geotiffs.
+    @param processed: When the aggregate was computed.
+    @param properties: Additional properties of the aggregate.
+
+    :return: DatasetDoc
+    """
+    file_format = "GeoTIFF"
+
+    p = EasiPrepare(dataset_path, product_yaml, output_path)
+
+    ## IDs and Labels should be dataset and Product unique
+    label = f"{aggregate_code.replace('.', '_')}-{p.product_name}"
+    p.dataset_id = uuid.uuid5(UUID_NAMESPACE, label)
+    p.product_uri = f"https://explorer.digitalearth.africa/product/{p.product_name}"
+
+    ## Satellite, Instrument and Processing level
+    p.platform = "WaPORv3"
+    p.producer = "www.fao.org"
+    p.properties["odc:file_format"] = file_format
+    for key, value in (properties or {}).items():
+        p.properties[key] = value
+
+    ## Scene capture and Processing
+    # As for the dekadal rasters, the searchable datetime is the last day of the period
+    start_datetime, end_datetime = datetime_range
+    p.datetime = end_datetime.replace(hour=0, minute=0, second=0)
+    p.datetime_range = datetime_range
+    p.processed = processed or datetime.now()
+    p.dataset_version = "v3.0"
+
+    ## Lineage
+    p.note_source_datasets("source", *source_dataset_ids)
+
+    ## Geometry
+    # The aggregates cover the full extent of the source rasters, so the valid data
+    # polygon is the bounds of the grid without reading any pixels.
+    p.valid_data_method = ValidDataMethod.bounds
+
+    ## Add measurement paths
+    for measurement_name, measurement_path in measurement_paths.items():
+        p.note_measurement(
+            measurement_name, measurement_path, relative_to_metadata=False, grid=grid
+        )
+
+    return p.to_dataset_doc(validate_correctness=True, sort_measurements=True)
@@ -15,7 +15,9 @@ from pathlib import Path
 from eodatasets3.images import ValidDataMethod
 from eodatasets3.model import DatasetDoc
 
+from wapor_v3_odc_products_py.cog_header import CogHeader
 from wapor_v3_odc_products_py.eo3assemble.easi_assemble import EasiPrepare
+from wapor_v3_odc_products_py.footprints import FootprintCache
 from wapor_v3_odc_products_py.logs import get_logger
 from wapor_v3_odc_products_py.utils import get_dekad, get_last_modified
 
@@ -30,16 +32,35 @@ logger = get_logger(Path(__file__).stem, level=logging.INFO)
 UUID_NAMESPACE = uuid.UUID("2f21a418-06e3-49b0-91d0-5e218f0c0b58")
 
 
+def get_dataset_id(tile_id: str, product_name: str) -> uuid.UUID:
+    """
+    Get the deterministic dataset UUID of a raster, from its raster code e.g.
+    WAPOR-3.L2-RSM-D.2018-01-D1 and the product name.
+    """
+    label = f"{re.sub(r'[.]', '_', tile_id)}-{product_name}"
+    return uuid.uuid5(UUID_NAMESPACE, label)
+
+
 def prepare_dataset(
     dataset_path: str | Path,
     product_yaml: str | Path,
     output_path: str = None,
+    valid_data_method: ValidDataMethod = ValidDataMethod.bounds,
+    footprint_cache: FootprintCache = None,
+    statistics: dict = None,
+    thumbnail_path: str = None,
+    header: CogHeader = None,
 ) -> DatasetDoc:
     """
     Prepare an eo3 metadata file for SAMPLE data product.
     @param dataset_path: Path to the geotiff to create dataset metadata for.
     @param product_yaml: Path to the product definition yaml file.
     @param output_path: Path to write the output metadata file.
+    @param valid_data_method: Method used to compute the valid data polygon.
+    @param footprint_cache: Cache of valid data polygons shared between datasets.
+    @param statistics: Summary statistics of the raster to add as dataset properties.
+    @param thumbnail_path: Path to a thumbnail of the raster to add as an accessory.
+    @param header: Header of the raster read with read_cog_headers(), so the raster isn't opened.
 
     :return: DatasetDoc
     """
@@ -61,15 +82,8 @@ def prepare_dataset(
 
     ## IDs and Labels should be dataset and Product unique
     # Populate the DatasetDoc with values
-    unique_name = (
-        f"{tile_id}"  # Unique dataset name, probably parsed from p.dataset_path or a filename
-    )
-    unique_name_replace = re.sub("\.", "_", unique_name)  # Can not have '.' in label
-
-    label = f"{unique_name_replace}-{p.product_name}"
-    # p.label = label # Optional
-    p.dataset_id = uuid.uuid5(
-        UUID_NAMESPACE, label
+    p.dataset_id = get_dataset_id(
+        tile_id, p.product_name
     )  # Unique dataset UUID built from the unique Product ID
     p.product_uri = f"https://explorer.digitalearth.africa/product/{p.product_name}"  # product_name is added by EasiPrepare().init()
 
@@ -109,7 +123,13 @@ def prepare_dataset(
     # ValidDataMethod.bounds = Use the image file bounds, ignoring actual pixel values
     # p.geometry = Provide a "valid data" polygon rather than read from the file, shapely.geometry.base.BaseGeometry()
     # p.crs = Provide a CRS string if measurements GridSpec.crs is None, "epsg:*" or WKT
-    p.valid_data_method = ValidDataMethod.bounds
+    p.valid_data_method = valid_data_method
+    # The valid data mask is essentially the same for every dekad, so for methods
+    # other than bounds compute the polygon from a COG overview once per unique mask.
+    if valid_data_method is not ValidDataMethod.bounds:
+        if footprint_cache is None:
+            footprint_cache = FootprintCache()
+        p.geometry = footprint_cache.get_footprint(p.product_name, dataset_path, valid_data_method)
 
     ## Product-specific properties, OPTIONAL
     # For examples see eodatasets3.properties.Eo3Dict().KNOWN_PROPERTIES
@@ -117,11 +137,31 @@ def prepare_dataset(
     # p.properties[f'{custom_prefix}:doi'] = ''
     # p.properties[f'{custom_prefix}:short_name'] = ''
     # p.properties[f'{custom_prefix}:processing_system'] = 'SomeAwesomeProcessor' # as an example
+    # Summary statistics computed from a COG overview, so searches can be filtered
+    # by coverage or wetness without loading pixels.
+    if statistics:
+        for key, value in statistics.items():
+            p.properties[key] = value
 
     ## Add measurement paths
     # This simple loop will go through all the measurements and determine their grids, the valid data polygon, etc
     # and add them to the dataset.
     # For LULC there is only one measurement, land_cover_class
-    p.note_measurement("relative_soil_moisture", dataset_path, relative_to_metadata=False)
+    # The grid from a header read ahead is all the bounds or a cached footprint need
+    if header is not None:
+        p.note_measurement(
+            "relative_soil_moisture",
+            dataset_path,
+            relative_to_metadata=False,
+            grid=header.grid,
+            nodata=header.nodata,
+        )
+    else:
+        p.note_measurement("relative_soil_moisture", dataset_path, relative_to_metadata=False)
+
+    ## Add accessories
+    # Quicklook shown by Explorer and stac browsers
+    if thumbnail_path is not None:
+        p.note_accessory_file("thumbnail", thumbnail_path, relative_to_metadata=False)
 
     return p.to_dataset_doc(validate_correctness=True, sort_measurements=True)
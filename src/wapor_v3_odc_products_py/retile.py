@@ -0,0 +1,377 @@
+import functools
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import click
+import numpy as np
+from eodatasets3.images import GridSpec, ValidDataMethod
+from eodatasets3.serialise import to_path
+from rasterio.io import DatasetReader, MemoryFile
+from rasterio.windows import Window, from_bounds
+
+from wapor_v3_odc_products_py import prepare_wapor_soil_moisture_africa_metadata
+from wapor_v3_odc_products_py.block_cache import open_raster
+from wapor_v3_odc_products_py.io import get_filesystem, is_s3_path
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.stac import write_stac_item
+from wapor_v3_odc_products_py.tasks import (
+    PARTITION_METHODS,
+    get_product_tasks,
+    get_shard_suffix,
+    get_task_id,
+    write_tasks_file,
+)
+from wapor_v3_odc_products_py.utils import get_last_modified
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Extent of Africa (min longitude, min latitude, max longitude, max latitude)
+AFRICA_EXTENT = (-26.0, -47.0, 64.0, 38.0)
+
+# Tiled product prepared from each source product
+TILED_PRODUCTS = {"wapor_soil_moisture": "wapor_soil_moisture_africa"}
+
+# Creation options for the tile COGs
+COG_PROFILE = {
+    "driver": "COG",
+    "compress": "DEFLATE",
+    "predictor": 2,
+    "blocksize": 512,
+    "overview_resampling": "nearest",
+}
+
+
+def get_tile_windows(
+    transform, shape: tuple[int, int], extent: tuple, tile_size: int
+) -> list[tuple[str, Window]]:
+    """
+    Get the windows of the tiles of a fixed tile grid that intersect an extent.
+
+    The tile grid is anchored at the origin of the raster grid so a tile covers
+    the same pixels in every raster on the same grid.
+
+    Parameters
+    ----------
+    transform : Affine
+        Transform of the raster grid.
+    shape : tuple[int, int]
+        Shape of the raster grid.
+    extent : tuple
+        Extent (min x, min y, max x, max y) to get the tiles for, in the CRS of the raster.
+    tile_size : int
+        Size of the tiles in pixels.
+
+    Returns
+    -------
+    list[tuple[str, Window]]
+        The tile index, e.g. x190y090, and window of each tile.
+    """
+    height, width = shape
+    window = from_bounds(*extent, transform=transform)
+    tile_col_start = max(int(math.floor(window.col_off / tile_size)), 0)
+    tile_row_start = max(int(math.floor(window.row_off / tile_size)), 0)
+    tile_col_stop = min(
+        int(math.ceil((window.col_off + window.width) / tile_size)), -(-width // tile_size)
+    )
+    tile_row_stop = min(
+        int(math.ceil((window.row_off + window.height) / tile_size)), -(-height // tile_size)
+    )
+
+    tiles = []
+    for tile_row in range(tile_row_start, tile_row_stop):
+        for tile_col in range(tile_col_start, tile_col_stop):
+            col_off = tile_col * tile_size
+            row_off = tile_row * tile_size
+            tile_window = Window(
+                col_off=col_off,
+                row_off=row_off,
+                width=min(tile_size, width - col_off),
+                height=min(tile_size, height - row_off),
+            )
+            tiles.append((f"x{tile_col:03d}y{tile_row:03d}", tile_window))
+    return tiles
+
+
+@functools.lru_cache(maxsize=None)
+def get_source_last_modified(raster: str):
+    """Get the Last-Modified timestamp of a source raster once for all its tiles."""
+    return get_last_modified(raster)
+
+
+def write_cog(
+    array: np.ndarray, profile: dict, output_path: str, scales: tuple = None, offsets: tuple = None
+):
+    """Write a single band array as a COG to a local file or S3."""
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as ds:
+            ds.write(array, 1)
+            if scales is not None:
+                ds.scales = scales
+            if offsets is not None:
+                ds.offsets = offsets
+        data = memfile.read()
+
+    fs = get_filesystem(path=output_path, anon=False)
+    if not is_s3_path(output_path):
+        fs.mkdirs(os.path.dirname(output_path), exist_ok=True)
+    with fs.open(output_path, "wb") as file:
+        file.write(data)
+
+
+def retile_raster_tile(
+    src: DatasetReader,
+    raster: str,
+    tile_index: str,
+    window: Window,
+    product_yaml: str | Path,
+    output_dir: str,
+    metadata_output_dir: str = None,
+    valid_data_method: ValidDataMethod = ValidDataMethod.filled,
+) -> str | None:
+    """
+    Cut a tile out of an open source raster, write it as a COG and write the
+    tile's dataset doc and stac item.
+
+    :param src: The source raster, opened once for all of its tiles
+    :param raster: Path or gsutil URI of the source raster
+    :return: The path of the tile COG, or None if the tile has no valid data.
+    """
+    array = src.read(1, window=window)
+    nodata = src.nodata
+    if nodata is not None and np.all(array == nodata):
+        logger.debug(f"Skipping tile {tile_index} of {raster} as it has no valid data")
+        return None
+    transform = src.window_transform(window)
+    profile = {
+        **COG_PROFILE,
+        "width": array.shape[1],
+        "height": array.shape[0],
+        "count": 1,
+        "dtype": array.dtype,
+        "crs": src.crs,
+        "transform": transform,
+        "nodata": nodata,
+    }
+
+    raster_code = get_task_id(raster)
+    tile_name = f"{raster_code}_{tile_index}"
+    tile_path = os.path.join(output_dir, tile_index, f"{tile_name}.tif")
+
+    write_cog(array, profile, tile_path, scales=src.scales, offsets=src.offsets)
+
+    if metadata_output_dir is not None:
+        metadata_output_path = Path(
+            os.path.join(metadata_output_dir, f"{tile_name}.odc-metadata.yaml")
+        )
+        output_path = metadata_output_path
+    else:
+        metadata_output_path = None
+        output_path = Path(os.path.join("/tmp", f"{tile_name}.odc-metadata.yaml"))
+
+    dataset_doc = prepare_wapor_soil_moisture_africa_metadata.prepare_dataset(
+        dataset_path=tile_path,
+        product_yaml=product_yaml,
+        source_dataset_path=raster,
+        tile_index=tile_index,
+        output_path=output_path,
+        grid=GridSpec(shape=array.shape, transform=transform, crs=src.crs),
+        array=array,
+        nodata=nodata,
+        valid_data_method=valid_data_method,
+        processed=get_source_last_modified(raster),
+    )
+
+    if metadata_output_path is not None:
+        to_path(metadata_output_path, dataset_doc)
+        logger.info(f"Wrote dataset to {metadata_output_path}")
+
+    write_stac_item(
+        dataset_doc, os.path.join(output_dir, tile_index, f"{tile_name}.stac-item.json")
+    )
+    return tile_path
+
+
+def retile_raster(
+    raster: str,
+    tiles: list[tuple[str, Window]],
+    product_yaml: str | Path,
+    output_dir: str,
+    metadata_output_dir: str = None,
+    valid_data_method: ValidDataMethod = ValidDataMethod.filled,
+) -> tuple[list[str], list[str]]:
+    """
+    Cut the tiles out of a source raster, opening it once to read every tile
+    window, and write each tile with its dataset doc and stac item.
+
+    :return: The paths of the tile COGs written, skipping tiles with no valid
+        data, and the indices of the tiles that failed.
+    """
+    tile_paths = []
+    failed_tiles = []
+    with open_raster(raster) as src:
+        for tile_index, window in tiles:
+            try:
+                tile_path = retile_raster_tile(
+                    src,
+                    raster,
+                    tile_index,
+                    window,
+                    product_yaml,
+                    output_dir,
+                    metadata_output_dir,
+                    valid_data_method,
+                )
+            except Exception as error:
+                logger.exception(error)
+                logger.error(f"Failed to re-tile tile {tile_index} of {raster}")
+                failed_tiles.append(tile_index)
+                continue
+            if tile_path is not None:
+                logger.info(f"Wrote tile {tile_path}")
+                tile_paths.append(tile_path)
+    return tile_paths, failed_tiles
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the source product to re-tile",
+)
+@click.option(
+    "--product-yaml",
+    type=click.Path(),
+    help="File path to the product definition yaml file of the tiled product",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(),
+    help="Local directory or S3 prefix to write the tile COGs and stac files to",
+)
+@click.option(
+    "--metadata-output-dir",
+    type=click.Path(),
+    default=None,
+    help="Directory to write the metadata docs to",
+)
+@click.option(
+    "--extent",
+    type=float,
+    nargs=4,
+    default=AFRICA_EXTENT,
+    help="Extent to re-tile as min x, min y, max x, max y in the CRS of the source rasters",
+)
+@click.option(
+    "--tile-size",
+    type=float,
+    default=5.0,
+    help="Size of the tiles in the units of the CRS of the source rasters e.g. degrees",
+)
+@click.option(
+    "--shard",
+    default=None,
+    help="Only process the shard i/N of the product's rasters, where 0 <= i < N",
+)
+@click.option(
+    "--partition-method",
+    type=click.Choice(PARTITION_METHODS),
+    default="time",
+    help="Method used to split the rasters into shards",
+)
+@click.option(
+    "--tasks-file",
+    type=click.Path(),
+    default=None,
+    help="File listing the rasters to process, as written by `create-tasks`",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=8,
+    help="Number of rasters to process concurrently",
+)
+def retile(
+    product_name: str,
+    product_yaml: str,
+    output_dir: str,
+    metadata_output_dir: str,
+    extent: tuple,
+    tile_size: float,
+    shard: str,
+    partition_method: str,
+    tasks_file: str,
+    max_workers: int,
+):
+    if product_name not in TILED_PRODUCTS:
+        raise NotImplementedError(f"Re-tiling has not been implemented for {product_name}")
+
+    if isinstance(metadata_output_dir, str):
+        if is_s3_path(metadata_output_dir):
+            raise RuntimeError("Metadata files require to be written to a local directory")
+        else:
+            metadata_output_dir = Path(metadata_output_dir).resolve()
+            metadata_output_dir.mkdir(parents=True, exist_ok=True)
+
+    if isinstance(product_yaml, str) and not is_s3_path(product_yaml):
+        product_yaml = Path(product_yaml).resolve()
+    if not is_s3_path(output_dir):
+        output_dir = str(Path(output_dir).resolve())
+
+    rasters = get_product_tasks(
+        product_name=product_name,
+        shard=shard,
+        partition_method=partition_method,
+        tasks_file=tasks_file,
+    )
+    # Use a gsutil URI instead of the the public URL
+    rasters = [i.replace("https://storage.googleapis.com/", "gs://") for i in rasters]
+    if not rasters:
+        logger.info(f"No rasters to re-tile into {output_dir}")
+        return
+
+    # All the rasters of a mapset share the same grid
+    with open_raster(rasters[0]) as src:
+        tile_size_pixels = round(tile_size / src.res[0])
+        tiles = get_tile_windows(src.transform, src.shape, extent, tile_size_pixels)
+    logger.info(
+        f"Re-tiling {len(rasters)} rasters into {len(tiles)} tiles of {tile_size_pixels} pixels"
+    )
+
+    failed_tasks = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                retile_raster,
+                raster,
+                tiles,
+                product_yaml,
+                output_dir,
+                metadata_output_dir,
+            ): raster
+            for raster in rasters
+        }
+        for idx, future in enumerate(as_completed(futures)):
+            raster = futures[future]
+            try:
+                tile_paths, failed_tiles = future.result()
+            except Exception as error:
+                logger.exception(error)
+                logger.error(f"Failed to re-tile {raster}")
+                failed_tasks.add(raster)
+                continue
+            if failed_tiles:
+                failed_tasks.add(raster)
+            logger.info(f"Wrote {len(tile_paths)} tiles of {raster} {idx+1}/{len(rasters)}")
+
+    if failed_tasks:
+        failed_tasks_file = os.path.join(
+            output_dir, f"{product_name}_retile_failed_tasks{get_shard_suffix(shard)}"
+        )
+        write_tasks_file(sorted(failed_tasks, key=get_task_id), failed_tasks_file)
+        logger.info(f"{len(failed_tasks)} failed tasks written to {failed_tasks_file}")
+
+
+if __name__ == "__main__":
+    retile()
@@ -0,0 +1,485 @@
+import logging
+import os
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import click
+import rasterio
+from datacube import Datacube
+from eodatasets3.images import ValidDataMethod
+
+from wapor_v3_odc_products_py.explorer import get_period, record_touched_periods
+from wapor_v3_odc_products_py.footprints import FootprintCache
+from wapor_v3_odc_products_py.io import GDAL_ENV_OPTIONS, is_s3_path
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.stac import create_stac_file
+from wapor_v3_odc_products_py.sync import (
+    diff_catalogue_and_index,
+    get_catalogue_listing,
+    get_indexed_datasets,
+    index_dataset_doc,
+)
+from wapor_v3_odc_products_py.tasks import get_task_id, read_tasks_file
+from wapor_v3_odc_products_py.utils import get_mapset_code
+from wapor_v3_odc_products_py.writes import ChangedWriter
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Seconds an idle worker waits before polling the queue again
+QUEUE_POLL_SECONDS = 5
+
+
+class WorkQueue:
+    """
+    Queue of work items, each a raster URL or a WaPOR v3 mapset code.
+
+    Work items are claimed with `get` and stay claimed until they are either
+    acknowledged with `ack` once processed or set aside with `fail`, so an item is
+    never lost if a worker stops while processing it.
+    """
+
+    def put(self, item: str):
+        raise NotImplementedError
+
+    def get(self) -> tuple[str, str] | None:
+        """Claim the next work item, returning its receipt and the item, or None if empty."""
+        raise NotImplementedError
+
+    def ack(self, receipt: str):
+        """Remove a processed work item from the queue."""
+        raise NotImplementedError
+
+    def fail(self, receipt: str):
+        """Set aside a work item that failed to process."""
+        raise NotImplementedError
+
+    def requeue(self) -> int:
+        """Return the claimed work items of stopped workers to the queue."""
+        raise NotImplementedError
+
+
+class DirectoryQueue(WorkQueue):
+    """
+    Queue spooled to a local directory, with a file per work item that is moved
+    between the `pending`, `processing` and `failed` subdirectories. Claiming an item
+    is an atomic rename, so several services can consume the same directory.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        for subdirectory in ("tmp", "pending", "processing", "failed"):
+            (self.path / subdirectory).mkdir(parents=True, exist_ok=True)
+
+    def put(self, item: str):
+        # File names sort in the order the items were queued
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex}.task"
+        tmp_path = self.path / "tmp" / name
+        tmp_path.write_text(item)
+        os.replace(tmp_path, self.path / "pending" / name)
+
+    def get(self) -> tuple[str, str] | None:
+        for name in sorted(os.listdir(self.path / "pending")):
+            try:
+                os.rename(self.path / "pending" / name, self.path / "processing" / name)
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+            return name, (self.path / "processing" / name).read_text()
+        return None
+
+    def ack(self, receipt: str):
+        os.remove(self.path / "processing" / receipt)
+
+    def fail(self, receipt: str):
+        os.replace(self.path / "processing" / receipt, self.path / "failed" / receipt)
+
+    def requeue(self) -> int:
+        names = os.listdir(self.path / "processing")
+        for name in names:
+            os.replace(self.path / "processing" / name, self.path / "pending" / name)
+        return len(names)
+
+
+class SQLiteQueue(WorkQueue):
+    """Queue stored in a table of a local SQLite database."""
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS work_items ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "item TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending')"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call, as connections can't be shared between worker threads
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def put(self, item: str):
+        with self._connect() as connection:
+            connection.execute("INSERT INTO work_items (item) VALUES (?)", (item,))
+
+    def get(self) -> tuple[str, str] | None:
+        with self._connect() as connection:
+            # Take the write lock first so two workers can't claim the same item
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT id, item FROM work_items WHERE status = 'pending' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE work_items SET status = 'processing' WHERE id = ?", (row[0],)
+                )
+            connection.execute("COMMIT")
+        return None if row is None else (str(row[0]), row[1])
+
+    def ack(self, receipt: str):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM work_items WHERE id = ?", (int(receipt),))
+
+    def fail(self, receipt: str):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE work_items SET status = 'failed' WHERE id = ?", (int(receipt),)
+            )
+
+    def requeue(self) -> int:
+        with self._connect() as connection:
+            return connection.execute(
+                "UPDATE work_items SET status = 'pending' WHERE status = 'processing'"
+            ).rowcount
+
+
+class RedisQueue(WorkQueue):
+    """
+    Queue stored in lists of a Redis compatible server, e.g. Redis, Valkey or KeyDB.
+    Work items are claimed by atomically moving them to a processing list.
+    """
+
+    def __init__(self, url: str, name: str = "wapor-work-items"):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("The redis package is required to use a Redis queue")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.pending, self.processing, self.failed = (
+            f"{name}:{status}" for status in ("pending", "processing", "failed")
+        )
+
+    def put(self, item: str):
+        self.client.lpush(self.pending, item)
+
+    def get(self) -> tuple[str, str] | None:
+        item = self.client.lmove(self.pending, self.processing, "RIGHT", "LEFT")
+        return None if item is None else (item, item)
+
+    def ack(self, receipt: str):
+        self.client.lrem(self.processing, 1, receipt)
+
+    def fail(self, receipt: str):
+        self.client.lrem(self.processing, 1, receipt)
+        self.client.lpush(self.failed, receipt)
+
+    def requeue(self) -> int:
+        count = 0
+        while self.client.lmove(self.processing, self.pending, "RIGHT", "RIGHT") is not None:
+            count += 1
+        return count
+
+
+def get_queue(url: str) -> WorkQueue:
+    """
+    Get the queue of a URL: `redis://` or `rediss://` for a Redis queue, `sqlite:///`
+    followed by the database path for a SQLite queue, or a directory path for a
+    directory spool.
+    """
+    if url.startswith(("redis://", "rediss://")):
+        return RedisQueue(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteQueue(url.removeprefix("sqlite:///"))
+    return DirectoryQueue(url)
+
+
+class IngestionService:
+    """
+    Long running service preparing and indexing the work items of a queue as they
+    arrive. A raster URL is prepared and indexed, and a mapset code queues the rasters
+    of the mapset that are new or changed since they were indexed.
+
+    The service is started once, so the imports, the datacube connection, the
+    filesystem clients and the footprint cache are shared by every work item. Each
+    worker thread keeps its own GDAL environment open, as GDAL configuration is
+    thread local.
+    """
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        product_name: str,
+        product_yaml: str | Path,
+        stac_output_dir: str | Path,
+        metadata_output_dir: str | Path = None,
+        valid_data_method: ValidDataMethod = ValidDataMethod.bounds,
+        footprint_cache_dir: str = None,
+        touched_periods_file: str = None,
+        dc: Datacube = None,
+    ):
+        self.queue = queue
+        self.product_name = product_name
+        self.product_yaml = product_yaml
+        self.stac_output_dir = stac_output_dir
+        self.metadata_output_dir = metadata_output_dir
+        self.valid_data_method = valid_data_method
+        self.mapset_code = get_mapset_code(product_name)
+        self.footprint_cache = FootprintCache(footprint_cache_dir)
+        self.touched_periods_file = touched_periods_file
+        self.writer = ChangedWriter()
+        self.dc = dc or Datacube(app="wapor-service")
+        self.processed = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def queue_mapset(self):
+        """Queue the rasters of the mapset that are not indexed or changed since."""
+        catalogue = get_catalogue_listing(self.product_name)
+        indexed = get_indexed_datasets(self.dc, self.product_name)
+        new, changed, _ = diff_catalogue_and_index(catalogue, indexed, self.product_name)
+        for raster in new + changed:
+            self.queue.put(raster)
+        logger.info(f"Queued {len(new)} new and {len(changed)} changed rasters")
+
+    def process_item(self, item: str):
+        """Prepare and index a raster, or queue the rasters of a mapset."""
+        if item == self.mapset_code:
+            self.queue_mapset()
+            return
+        if not item.endswith(".tif"):
+            raise ValueError(f"Work item is neither a raster nor the mapset {self.mapset_code}")
+
+        # Use a gsutil URI instead of the the public URL
+        geotiff = item.replace("https://storage.googleapis.com/", "gs://")
+        dataset_doc = create_stac_file(
+            product_name=self.product_name,
+            geotiff=geotiff,
+            product_yaml=self.product_yaml,
+            stac_output_dir=self.stac_output_dir,
+            metadata_output_dir=self.metadata_output_dir,
+            valid_data_method=self.valid_data_method,
+            footprint_cache=self.footprint_cache,
+            writer=self.writer,
+        )
+        uri = os.path.join(str(self.stac_output_dir), f"{get_task_id(geotiff)}.stac-item.json")
+        if not is_s3_path(uri):
+            uri = Path(uri).as_uri()
+        index_dataset_doc(self.dc, dataset_doc, uri, self.product_name)
+        if self.touched_periods_file:
+            # Recorded per item, as the service may run for much longer than the
+            # interval Explorer is refreshed at
+            period = get_period(dataset_doc.properties["datetime"])
+            record_touched_periods(self.touched_periods_file, {self.product_name: {period}})
+
+    def work(self, poll_seconds: float = QUEUE_POLL_SECONDS, exit_when_empty: bool = False):
+        """Process work items until the service is stopped, or the queue is empty."""
+        with rasterio.Env(**GDAL_ENV_OPTIONS):
+            while not self._stop.is_set():
+                claimed = self.queue.get()
+                if claimed is None:
+                    if exit_when_empty:
+                        return
+                    self._stop.wait(poll_seconds)
+                    continue
+
+                receipt, item = claimed
+                start = time.perf_counter()
+                try:
+                    self.process_item(item)
+                except Exception as error:
+                    logger.exception(error)
+                    logger.error(f"Failed to process {item}")
+                    self.queue.fail(receipt)
+                    with self._lock:
+                        self.failed += 1
+                    continue
+                self.queue.ack(receipt)
+                with self._lock:
+                    self.processed += 1
+                logger.info(f"Processed {item} in {time.perf_counter() - start:.2f}s")
+
+    def run(
+        self,
+        max_workers: int = 4,
+        poll_seconds: float = QUEUE_POLL_SECONDS,
+        exit_when_empty: bool = False,
+    ):
+        """Run the worker threads until they are stopped, or the queue is empty."""
+        workers = [
+            threading.Thread(
+                target=self.work, args=(poll_seconds, exit_when_empty), name=f"worker-{idx}"
+            )
+            for idx in range(max_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.writer.save_manifests()
+        logger.info(
+            f"Processed {self.processed} work items, {self.failed} failed, "
+            f"{self.writer.written} files written and {self.writer.unchanged} unchanged"
+        )
+
+    def stop(self, *args):
+        """Stop the workers once their current work items are processed."""
+        logger.info("Stopping the workers")
+        self._stop.set()
+
+
+@click.command()
+@click.option(
+    "--queue",
+    help="Queue to consume: a directory, sqlite:///path/to/queue.db or a redis:// URL",
+)
+@click.option(
+    "--product-name",
+    help="Name of the product the work items are rasters of",
+)
+@click.option(
+    "--product-yaml",
+    type=click.Path(),
+    help="File path to the product definition yaml file",
+)
+@click.option(
+    "--stac-output-dir",
+    type=click.Path(),
+    help="Directory to write the stac files to",
+)
+@click.option(
+    "--metadata-output-dir",
+    type=click.Path(),
+    default=None,
+    help="Directory to write the metadata docs to",
+)
+@click.option(
+    "--valid-data-method",
+    type=click.Choice([method.name for method in ValidDataMethod]),
+    default=ValidDataMethod.bounds.name,
+    help="Method used to compute the valid data polygon of each dataset",
+)
+@click.option(
+    "--footprint-cache-dir",
+    type=click.Path(),
+    default=None,
+    help="Directory to cache the valid data polygons in, shared between runs",
+)
+@click.option(
+    "--touched-periods-file",
+    type=click.Path(),
+    default=None,
+    help="File to record the months touched in, to only refresh their Explorer summaries",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=4,
+    help="Number of work items processed concurrently",
+)
+@click.option(
+    "--poll-seconds",
+    type=float,
+    default=QUEUE_POLL_SECONDS,
+    help="Seconds an idle worker waits before polling the queue again",
+)
+@click.option(
+    "--requeue-unfinished",
+    is_flag=True,
+    default=False,
+    help="Return work items claimed by a previous run that stopped to the queue",
+)
+@click.option(
+    "--exit-when-empty",
+    is_flag=True,
+    default=False,
+    help="Stop once the queue is empty instead of waiting for new work items",
+)
+def serve(
+    queue: str,
+    product_name: str,
+    product_yaml: str,
+    stac_output_dir: str,
+    metadata_output_dir: str,
+    valid_data_method: str,
+    footprint_cache_dir: str,
+    touched_periods_file: str,
+    max_workers: int,
+    poll_seconds: float,
+    requeue_unfinished: bool,
+    exit_when_empty: bool,
+):
+    if isinstance(metadata_output_dir, str):
+        if is_s3_path(metadata_output_dir):
+            raise RuntimeError("Metadata files require to be written to a local directory")
+        else:
+            metadata_output_dir = Path(metadata_output_dir).resolve()
+    if not is_s3_path(product_yaml):
+        product_yaml = Path(product_yaml).resolve()
+    if not is_s3_path(stac_output_dir):
+        stac_output_dir = Path(stac_output_dir).resolve()
+        stac_output_dir.mkdir(parents=True, exist_ok=True)
+
+    work_queue = get_queue(queue)
+    if requeue_unfinished:
+        logger.info(f"Requeued {work_queue.requeue()} unfinished work items")
+
+    service = IngestionService(
+        queue=work_queue,
+        product_name=product_name,
+        product_yaml=product_yaml,
+        stac_output_dir=stac_output_dir,
+        metadata_output_dir=metadata_output_dir,
+        valid_data_method=ValidDataMethod[valid_data_method],
+        footprint_cache_dir=footprint_cache_dir,
+        touched_periods_file=touched_periods_file,
+    )
+    signal.signal(signal.SIGTERM, service.stop)
+    signal.signal(signal.SIGINT, service.stop)
+    logger.info(f"Serving {max_workers} workers on the queue {queue}")
+    service.run(max_workers=max_workers, poll_seconds=poll_seconds, exit_when_empty=exit_when_empty)
+
+
+@click.command()
+@click.option(
+    "--queue",
+    help="Queue to add to: a directory, sqlite:///path/to/queue.db or a redis:// URL",
+)
+@click.option(
+    "--tasks-file",
+    default=None,
+    help="Optional tasks file of raster URLs to queue",
+)
+@click.argument("items", nargs=-1)
+def enqueue(queue: str, tasks_file: str, items: tuple[str]):
+    """Queue raster URLs or mapset codes for the ingestion service."""
+    items = list(items)
+    if tasks_file is not None:
+        items.extend(read_tasks_file(tasks_file))
+    work_queue = get_queue(queue)
+    for item in items:
+        work_queue.put(item)
+    logger.info(f"Queued {len(items)} work items on {queue}")
+
+
+if __name__ == "__main__":
+    serve()
@@ -1,21 +1,466 @@
 import json
 import logging
+import multiprocessing
 import os
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
 import click
+import rasterio
+from eodatasets3.images import ValidDataMethod
+from eodatasets3.model import DatasetDoc
 from eodatasets3.serialise import to_path
 from eodatasets3.stac import to_stac_item
-from odc.aws import s3_dump
 
 from wapor_v3_odc_products_py import prepare_wapor_soil_moisture_metadata
-from wapor_v3_odc_products_py.io import is_s3_path, is_url, is_gcsfs_path
+from wapor_v3_odc_products_py.cog_header import CogHeader, read_cog_headers
+from wapor_v3_odc_products_py.eo3assemble.easi_assemble import load_product_definition
+from wapor_v3_odc_products_py.footprints import FootprintCache
+from wapor_v3_odc_products_py.guards import (
+    MB,
+    ON_LIMIT_ACTIONS,
+    ResourceGuard,
+    ResourceLimitExceeded,
+    estimate_read_bytes,
+)
+from wapor_v3_odc_products_py.io import (
+    GDAL_ENV_OPTIONS,
+    get_filesystem,
+    is_gcsfs_path,
+    is_s3_path,
+    is_url,
+)
 from wapor_v3_odc_products_py.logs import get_logger
-from wapor_v3_odc_products_py.utils import get_mapset_rasters
+from wapor_v3_odc_products_py.overview_statistics import get_rasters_statistics
+from wapor_v3_odc_products_py.plan import (
+    estimate_stac_item_cost,
+    get_file_layout,
+    get_recorded_seconds_per_item,
+    get_up_to_date_tasks,
+    write_plan,
+)
+from wapor_v3_odc_products_py.tasks import (
+    PARTITION_METHODS,
+    get_product_tasks,
+    get_shard_suffix,
+    write_tasks_file,
+)
+from wapor_v3_odc_products_py.thumbnails import THUMBNAIL_FORMATS, write_thumbnails
+from wapor_v3_odc_products_py.writes import (
+    BufferedWriter,
+    ChangedWriter,
+    get_dataset_doc_bytes,
+    get_json_bytes,
+    write_bytes,
+)
 
 logger = get_logger(Path(__file__).stem, level=logging.INFO)
 
 
+def write_stac_item(
+    dataset_doc: DatasetDoc,
+    stac_item_destination_url: str | Path,
+    writer: ChangedWriter = None,
+):
+    """
+    Convert a dataset doc to a stac item and write it to a local file or S3. With a
+    writer, an existing stac item with the same content is not rewritten.
+    """
+    stac_item = to_stac_item(
+        dataset=dataset_doc, stac_item_destination_url=str(stac_item_destination_url)
+    )
+    data = get_json_bytes(stac_item)
+
+    if writer is None:
+        write_bytes(str(stac_item_destination_url), data, content_type="application/json")
+    elif not writer.write(stac_item_destination_url, data, content_type="application/json"):
+        logger.info(f"STAC unchanged at {stac_item_destination_url}")
+        return
+
+    logger.info(f"STAC written to {stac_item_destination_url}")
+
+
+def create_stac_file(
+    product_name: str,
+    geotiff: str,
+    product_yaml: str | Path,
+    stac_output_dir: str | Path,
+    metadata_output_dir: str | Path = None,
+    valid_data_method: ValidDataMethod = ValidDataMethod.bounds,
+    footprint_cache: FootprintCache = None,
+    statistics: dict = None,
+    thumbnail_path: str = None,
+    writer: ChangedWriter = None,
+    header: CogHeader = None,
+) -> DatasetDoc:
+    """
+    Generate the dataset metadata doc and stac item file for a single raster. With a
+    writer, files with unchanged content are not rewritten. With the header of the
+    raster read ahead, the raster isn't opened.
+
+    :return: The dataset metadata doc.
+    """
+    # File system Path() to the dataset
+    # or gsutil URI prefix  (gs://bucket/key) to the dataset.
+    if not is_s3_path(geotiff) and not is_gcsfs_path(geotiff):
+        dataset_path = Path(geotiff)
+    else:
+        dataset_path = geotiff
+
+    tile_id = os.path.basename(dataset_path).removesuffix(".tif")
+
+    if metadata_output_dir is not None:
+        metadata_output_path = Path(
+            os.path.join(metadata_output_dir, f"{tile_id}.odc-metadata.yaml")
+        )
+        output_path = metadata_output_path
+    else:
+        metadata_output_path = None
+        output_path = Path(os.path.join("/tmp", f"{tile_id}.odc-metadata.yaml"))
+
+    if product_name == "wapor_soil_moisture":
+        dataset_doc = prepare_wapor_soil_moisture_metadata.prepare_dataset(
+            dataset_path=dataset_path,
+            product_yaml=product_yaml,
+            output_path=output_path,
+            valid_data_method=valid_data_method,
+            footprint_cache=footprint_cache,
+            statistics=statistics,
+            thumbnail_path=thumbnail_path,
+            header=header,
+        )
+
+    # Write the dataset doc to file
+    if metadata_output_path is not None:
+        if writer is None:
+            to_path(metadata_output_path, dataset_doc)
+            written = True
+        else:
+            written = writer.write(metadata_output_path, get_dataset_doc_bytes(dataset_doc))
+        if written:
+            logger.info(f"Wrote dataset to {metadata_output_path}")
+
+    stac_item_destination_url = os.path.join(stac_output_dir, f"{tile_id}.stac-item.json")
+    write_stac_item(dataset_doc, stac_item_destination_url, writer)
+    return dataset_doc
+
+
+def create_stac_file_with_guard(
+    geotiff: str,
+    valid_data_method: ValidDataMethod = ValidDataMethod.bounds,
+    max_memory_mb: float = None,
+    max_seconds: float = None,
+    on_limit: str = "fallback",
+    **kwargs,
+) -> dict:
+    """
+    Generate the dataset metadata doc and stac item file for a single raster within
+    memory and time limits. If a limit is exceeded the raster is either processed again
+    with the bounds valid data method, which does not read any pixels, or the
+    ResourceLimitExceeded error is raised.
+
+    As a single raster read can't be interrupted, rasters whose read is estimated
+    from their header to exceed the memory limit use the bounds valid data method
+    up front.
+
+    :return: Run report of the raster with its peak memory use and time taken.
+    """
+    status = None
+    if max_memory_mb is not None and valid_data_method is not ValidDataMethod.bounds:
+        estimated_mb = estimate_read_bytes(geotiff, kwargs.get("header")) / MB
+        if estimated_mb > max_memory_mb:
+            message = (
+                f"Reading {geotiff} is estimated to need {estimated_mb:.0f} MB, "
+                f"more than its {max_memory_mb} MB memory limit"
+            )
+            if on_limit == "abort":
+                raise ResourceLimitExceeded(message)
+            logger.warning(f"{message}, using the bounds valid data method")
+            status = "fallback"
+            report = {
+                "status": status,
+                "valid_data_method": valid_data_method.name,
+                "name": geotiff,
+                "estimated_read_mb": round(estimated_mb, 1),
+            }
+
+    if status is None:
+        with ResourceGuard(geotiff, max_memory_mb, max_seconds) as guard:
+            try:
+                create_stac_file(geotiff=geotiff, valid_data_method=valid_data_method, **kwargs)
+                status = "ok"
+            except ResourceLimitExceeded as error:
+                if on_limit == "abort" or valid_data_method is ValidDataMethod.bounds:
+                    raise
+                logger.warning(f"{error}, falling back to the bounds valid data method")
+                status = "fallback"
+        report = {"status": status, "valid_data_method": valid_data_method.name, **guard.report}
+
+    if status == "fallback":
+        with ResourceGuard(geotiff, max_memory_mb, max_seconds) as guard:
+            create_stac_file(geotiff=geotiff, valid_data_method=ValidDataMethod.bounds, **kwargs)
+        report["fallback"] = {"valid_data_method": ValidDataMethod.bounds.name, **guard.report}
+    return report
+
+
+class StacWorkSpec:
+    """
+    Picklable spec of the stac item of one raster: its path, code and period, and
+    what was computed for it in the parent. Worker processes are sent these instead of
+    the objects used to prepare the item.
+    """
+
+    __slots__ = ("path", "code", "period", "statistics", "thumbnail_path", "header")
+
+    def __init__(
+        self,
+        path: str,
+        statistics: dict = None,
+        thumbnail_path: str = None,
+        header: CogHeader = None,
+    ):
+        self.path = path
+        self.code = os.path.basename(path).removesuffix(".tif")
+        self.period = self.code.split(".")[-1]
+        self.statistics = statistics
+        self.thumbnail_path = thumbnail_path
+        self.header = header
+
+
+def create_stac_item(spec: StacWorkSpec, writer, **kwargs) -> dict:
+    """
+    Generate the dataset metadata doc and stac item file of a work spec.
+
+    :return: Run report of the raster, also when it failed.
+    """
+    try:
+        return create_stac_file_with_guard(
+            geotiff=spec.path,
+            statistics=spec.statistics,
+            thumbnail_path=spec.thumbnail_path,
+            header=spec.header,
+            writer=writer,
+            **kwargs,
+        )
+    except Exception as error:
+        logger.exception(error)
+        logger.error(f"Failed to generate stac file for {spec.path}")
+        return {"status": "failed", "name": spec.path, "error": repr(error)}
+
+
+# Queue worker processes put the index of each item they start on, set by _init_worker
+_started_queue = None
+
+
+def _init_worker(started_queue, initializer, initargs: tuple):
+    global _started_queue
+    _started_queue = started_queue
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_started(func, index: int, item):
+    _started_queue.put(index)
+    return func(item)
+
+
+def map_in_processes(
+    func, items: list, processes: int, initializer=None, initargs: tuple = ()
+) -> Iterator[tuple[int, object]]:
+    """
+    Run a function on each item in a pool of spawned worker processes, yielding the
+    index of each item and its result, or the exception it raised, as they complete.
+
+    If a worker process dies, e.g. it is killed for using too much memory, the pool
+    is rebuilt and the unfinished items are submitted again. The items that were
+    running when it died are retried one at a time, so only an item that kills its
+    worker on its own is yielded with a BrokenProcessPool error.
+
+    :param func: Picklable function run on each item
+    :param items: Picklable items
+    :param processes: Number of worker processes
+    :param initializer: Function run once in each worker process
+    :param initargs: Arguments of the initializer
+    """
+    # Spawned rather than forked, as forking a process running threads can deadlock
+    context = multiprocessing.get_context("spawn")
+    started_queue = context.SimpleQueue()
+    pending, isolated = list(range(len(items))), []
+    while pending or isolated:
+        if isolated:
+            indices, max_workers = [isolated.pop(0)], 1
+        else:
+            indices, max_workers, pending = pending, processes, []
+
+        broken = []
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(started_queue, initializer, initargs),
+        ) as executor:
+            futures = {executor.submit(_run_started, func, i, items[i]): i for i in indices}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except BrokenProcessPool:
+                    broken.append(futures[future])
+                except Exception as error:
+                    yield futures[future], error
+
+        started = set()
+        while not started_queue.empty():
+            started.add(started_queue.get())
+        if not broken:
+            continue
+        running = [i for i in broken if i in started]
+        if max_workers == 1 or not running:
+            # Died running the item on its own, or before running any item
+            for i in broken:
+                yield i, BrokenProcessPool(f"The worker process died running item {i}")
+            continue
+        logger.warning(f"A worker process died, retrying the {len(running)} items it was running")
+        isolated.extend(running)
+        pending.extend(i for i in broken if i not in started)
+
+
+# Arguments of create_stac_file_with_guard shared by every work spec of a worker
+# process, set once by init_stac_worker
+_worker_kwargs = {}
+
+
+def init_stac_worker(footprint_cache_dir: str, warm_paths: list[str], kwargs: dict):
+    """
+    Initialise a worker process once for all its work specs: load the product
+    definition, keep a GDAL environment open and create the filesystem clients and the
+    footprint cache.
+    """
+    load_product_definition(str(kwargs["product_yaml"]))
+    # Kept open for the lifetime of the process, as GDAL configuration is per thread
+    # and each worker process runs its work specs in its main thread
+    rasterio.Env(**GDAL_ENV_OPTIONS).__enter__()
+    # fsspec reuses a filesystem instance created with the same arguments
+    for path in warm_paths:
+        get_filesystem(path=path, anon=True)
+        get_filesystem(path=path, anon=False)
+    _worker_kwargs.update(kwargs, footprint_cache=FootprintCache(footprint_cache_dir))
+
+
+def run_stac_worker(spec: StacWorkSpec) -> tuple[dict, list[tuple[str, bytes, str]]]:
+    """
+    Generate the stac item of a work spec in a worker process.
+
+    :return: Run report of the raster, and the files to write as (path, bytes, content type).
+    """
+    writer = BufferedWriter()
+    report = create_stac_item(spec, writer, **_worker_kwargs)
+    return report, writer.files
+
+
+def create_stac_items_in_processes(
+    specs: list[StacWorkSpec],
+    processes: int,
+    footprint_cache_dir: str,
+    writer: ChangedWriter,
+    **kwargs,
+) -> list[dict]:
+    """
+    Generate the stac items of work specs in a pool of worker processes, so the CPU
+    bound validation, serialisation and polygonisation use every core rather than
+    one at a time under the GIL. Workers return the serialised docs as bytes, which
+    are written here with the writer.
+
+    :return: Run report of each raster.
+    """
+    if not specs:
+        return []
+    warm_paths = [os.path.dirname(specs[0].path), str(kwargs["stac_output_dir"])]
+    run_report = [None] * len(specs)
+    results = map_in_processes(
+        run_stac_worker,
+        specs,
+        processes,
+        initializer=init_stac_worker,
+        initargs=(footprint_cache_dir, warm_paths, kwargs),
+    )
+    for done, (idx, result) in enumerate(results):
+        spec = specs[idx]
+        if isinstance(result, Exception):
+            # The worker process died, e.g. it was killed for using too much memory
+            logger.error(f"Failed to generate stac file for {spec.path}: {result!r}")
+            report, files = {"status": "failed", "name": spec.path, "error": repr(result)}, []
+        else:
+            report, files = result
+        for path, data, content_type in files:
+            writer.write(path, data, content_type)
+        logger.info(f"Generated stac file for {spec.code} {done+1}/{len(specs)}")
+        # Reported in the order of the rasters, as when generated in one process
+        run_report[idx] = report
+    return run_report
+
+
+def plan_stac_files(
+    product_name: str,
+    geotiffs: list[str],
+    stac_output_dir: str | Path,
+    metadata_output_dir: str | Path = None,
+    valid_data_method: ValidDataMethod = ValidDataMethod.bounds,
+    skip_up_to_date: bool = False,
+) -> dict:
+    """
+    Plan the generation of the stac files for a list of rasters from the listing of
+    the output directory and the header of one raster, without doing the work.
+    All the rasters of a mapset are assumed to share the layout of the first one
+    to process, so no header is read when there is nothing to process.
+
+    :return: The rasters to process, the rasters skipped as up to date and the
+        estimated remote requests, bytes read, objects written and wall time.
+    """
+    up_to_date = get_up_to_date_tasks(geotiffs, stac_output_dir, ".stac-item.json")
+    if skip_up_to_date:
+        skipped = set(up_to_date)
+        tasks = [geotiff for geotiff in geotiffs if geotiff not in skipped]
+    else:
+        tasks = geotiffs
+
+    if tasks:
+        layout = get_file_layout(tasks[0])
+        item_cost = estimate_stac_item_cost(layout, valid_data_method)
+        header_seconds = layout["header_seconds"]
+    else:
+        item_cost = {"requests": 0, "bytes_read": 0}
+        header_seconds = 0.0
+
+    run_report_file = os.path.join(stac_output_dir, f"{product_name}_stac_run_report")
+    seconds_per_item = get_recorded_seconds_per_item(run_report_file)
+    if seconds_per_item is not None:
+        throughput_source = run_report_file
+    else:
+        # Without a previous run, reading one header is a lower bound of the time per raster
+        seconds_per_item = header_seconds
+        throughput_source = "header read time of one raster (lower bound)"
+
+    estimates = {
+        "rasters": len(geotiffs),
+        "up_to_date": len(up_to_date),
+        "to_process": len(tasks),
+        "valid_data_method": valid_data_method.name,
+        "remote_requests": item_cost["requests"] * len(tasks),
+        "bytes_read": item_cost["bytes_read"] * len(tasks),
+        "objects_written": len(tasks) * (1 if metadata_output_dir is None else 2),
+        "seconds_per_raster": round(seconds_per_item, 3),
+        "projected_seconds": round(seconds_per_item * len(tasks), 1),
+        "throughput_source": throughput_source,
+    }
+    return {
+        "estimates": estimates,
+        "tasks": tasks,
+        "skipped": up_to_date if skip_up_to_date else [],
+    }
+
+
 @click.command()
 @click.option(
     "--product-name",
@@ -37,11 +482,129 @@ logger = get_logger(Path(__file__).stem, level=logging.INFO)
     default=None,
     help="Directory to write the metadata docs to",
 )
+@click.option(
+    "--shard",
+    default=None,
+    help="Only process the shard i/N of the product's rasters, where 0 <= i < N",
+)
+@click.option(
+    "--partition-method",
+    type=click.Choice(PARTITION_METHODS),
+    default="time",
+    help="Method used to split the rasters into shards",
+)
+@click.option(
+    "--tasks-file",
+    type=click.Path(),
+    default=None,
+    help="File listing the rasters to process, as written by `create-tasks`",
+)
+@click.option(
+    "--valid-data-method",
+    type=click.Choice([method.name for method in ValidDataMethod]),
+    default=ValidDataMethod.bounds.name,
+    help="Method used to compute the valid data polygon of each dataset",
+)
+@click.option(
+    "--footprint-cache-dir",
+    type=click.Path(),
+    default=None,
+    help="Directory to cache the valid data polygons in, shared between runs",
+)
+@click.option(
+    "--skip-up-to-date",
+    is_flag=True,
+    default=False,
+    help="Skip rasters whose stac file was written after the raster was last modified",
+)
+@click.option(
+    "--plan",
+    is_flag=True,
+    default=False,
+    help="Only write a plan of the work to do with cost estimates, without doing it",
+)
+@click.option(
+    "--statistics",
+    is_flag=True,
+    default=False,
+    help="Add summary statistics computed from a COG overview of each raster as properties",
+)
+@click.option(
+    "--statistics-max-workers",
+    type=int,
+    default=8,
+    help="Number of rasters to compute the summary statistics of in parallel",
+)
+@click.option(
+    "--thumbnail-dir",
+    type=click.Path(),
+    default=None,
+    help="Directory or S3 prefix to write thumbnails read from a COG overview of each raster to",
+)
+@click.option(
+    "--thumbnail-format",
+    type=click.Choice(list(THUMBNAIL_FORMATS)),
+    default="png",
+    help="Image format of the thumbnails",
+)
+@click.option(
+    "--thumbnail-max-workers",
+    type=int,
+    default=8,
+    help="Number of thumbnails to write in parallel",
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=1,
+    help="Number of worker processes generating stac files, 1 to generate them in this process",
+)
+@click.option(
+    "--async-headers",
+    is_flag=True,
+    default=False,
+    help="Read the grid of every raster up front with range requests on one event loop",
+)
+@click.option(
+    "--max-item-memory-mb",
+    type=float,
+    default=None,
+    help="Maximum increase in memory use in MB while processing a single raster",
+)
+@click.option(
+    "--max-item-seconds",
+    type=float,
+    default=None,
+    help="Maximum time in seconds to process a single raster",
+)
+@click.option(
+    "--on-limit",
+    type=click.Choice(ON_LIMIT_ACTIONS),
+    default="fallback",
+    help="Fall back to the bounds valid data method or fail a raster that exceeds a limit",
+)
 def create_stac_files(
     product_name: str,
     product_yaml,
     stac_output_dir,
     metadata_output_dir,
+    shard,
+    partition_method,
+    tasks_file,
+    valid_data_method,
+    footprint_cache_dir,
+    max_item_memory_mb,
+    max_item_seconds,
+    on_limit,
+    skip_up_to_date,
+    plan,
+    statistics,
+    statistics_max_workers,
+    thumbnail_dir,
+    thumbnail_format,
+    thumbnail_max_workers,
+    processes,
+    async_headers,
 ):
 
     valid_product_names = ["wapor_soil_moisture"]
@@ -62,68 +625,112 @@ def create_stac_files(
     if isinstance(stac_output_dir, str):
         if not is_s3_path(stac_output_dir):
             stac_output_dir = Path(stac_output_dir).resolve()
+            stac_output_dir.mkdir(parents=True, exist_ok=True)
 
     logger.info(f"Generating stac files for the product {product_name}")
 
-    if product_name == "wapor_soil_moisture":
-        mapset_code = "L2-RSM-D"
-
-    geotiffs = get_mapset_rasters(mapset_code)
+    geotiffs = get_product_tasks(
+        product_name=product_name,
+        shard=shard,
+        partition_method=partition_method,
+        tasks_file=tasks_file,
+    )
     # Use a gsutil URI instead of the the public URL
     geotiffs = [i.replace("https://storage.googleapis.com/", "gs://") for i in geotiffs]
 
-    for idx, geotiff in enumerate(geotiffs):
-        logger.info(f"Generating stac file for {geotiff} {idx+1}/{len(geotiffs)}")
-
-        # File system Path() to the dataset
-        # or gsutil URI prefix  (gs://bucket/key) to the dataset.
-        if not is_s3_path(geotiff) and not is_gcsfs_path(geotiff):
-            dataset_path = Path(geotiff)
-        else:
-            dataset_path = geotiff
-
-        tile_id = os.path.basename(dataset_path).removesuffix(".tif")
+    valid_data_method = ValidDataMethod[valid_data_method]
+    shard_suffix = get_shard_suffix(shard)
 
-        if metadata_output_dir is not None:
-            metadata_output_path = Path(
-                os.path.join(metadata_output_dir, f"{tile_id}.odc-metadata.yaml")
-            )
-            output_path = metadata_output_path
-        else:
-            metadata_output_path = None
-            output_path = Path(os.path.join("/tmp", f"{tile_id}.odc-metadata.yaml"))
+    if plan:
+        stac_plan = plan_stac_files(
+            product_name=product_name,
+            geotiffs=geotiffs,
+            stac_output_dir=stac_output_dir,
+            metadata_output_dir=metadata_output_dir,
+            valid_data_method=valid_data_method,
+            skip_up_to_date=skip_up_to_date,
+        )
+        plan_file = os.path.join(stac_output_dir, f"{product_name}_stac_plan{shard_suffix}")
+        write_plan(stac_plan, plan_file)
+        return
+    if skip_up_to_date:
+        skipped = set(get_up_to_date_tasks(geotiffs, stac_output_dir, ".stac-item.json"))
+        geotiffs = [geotiff for geotiff in geotiffs if geotiff not in skipped]
+        logger.info(f"Skipping {len(skipped)} rasters with up to date stac files")
 
-        if product_name == "wapor_soil_moisture":
-            dataset_doc = prepare_wapor_soil_moisture_metadata.prepare_dataset(
-                dataset_path=dataset_path, product_yaml=product_yaml, output_path=output_path
-            )
+    rasters_statistics = {}
+    if statistics:
+        rasters_statistics = get_rasters_statistics(geotiffs, max_workers=statistics_max_workers)
 
-        # Write the dataset doc to file
-        if metadata_output_path is not None:
-            to_path(metadata_output_path, dataset_doc)
-            logger.info(f"Wrote dataset to {metadata_output_path}")
+    thumbnails = {}
+    if thumbnail_dir is not None:
+        if not is_s3_path(thumbnail_dir):
+            thumbnail_dir = str(Path(thumbnail_dir).resolve())
+        thumbnails = write_thumbnails(
+            geotiffs,
+            thumbnail_dir,
+            thumbnail_format=thumbnail_format,
+            max_workers=thumbnail_max_workers,
+        )
 
-        stac_item_destination_url = os.path.join(stac_output_dir, f"{tile_id}.stac-item.json")
+    # Rasters whose header can't be read are opened with GDAL as usual
+    headers = {}
+    if async_headers:
+        headers, _ = read_cog_headers(geotiffs)
 
-        stac_item = to_stac_item(
-            dataset=dataset_doc, stac_item_destination_url=str(stac_item_destination_url)
+    specs = [
+        StacWorkSpec(
+            geotiff,
+            statistics=rasters_statistics.get(geotiff),
+            thumbnail_path=thumbnails.get(geotiff),
+            header=headers.get(geotiff),
         )
+        for geotiff in geotiffs
+    ]
+    item_kwargs = dict(
+        product_name=product_name,
+        product_yaml=product_yaml,
+        stac_output_dir=stac_output_dir,
+        metadata_output_dir=metadata_output_dir,
+        valid_data_method=valid_data_method,
+        max_memory_mb=max_item_memory_mb,
+        max_seconds=max_item_seconds,
+        on_limit=on_limit,
+    )
 
-        if is_s3_path(stac_item_destination_url):
-            s3_dump(
-                data=json.dumps(stac_item, indent=2),
-                url=stac_item_destination_url,
-                ACL="bucket-owner-full-control",
-                ContentType="application/json",
+    writer = ChangedWriter()
+    if processes > 1 and specs:
+        run_report = create_stac_items_in_processes(
+            specs, processes, footprint_cache_dir, writer, **item_kwargs
+        )
+    else:
+        footprint_cache = FootprintCache(footprint_cache_dir)
+        run_report = []
+        for idx, spec in enumerate(specs):
+            logger.info(f"Generating stac file for {spec.path} {idx+1}/{len(specs)}")
+            run_report.append(
+                create_stac_item(spec, writer, footprint_cache=footprint_cache, **item_kwargs)
             )
-        else:
-            with open(stac_item_destination_url, "w") as file:
-                json.dump(stac_item, file, indent=2)  # `indent=4` makes it human-readable
+    failed_tasks = [i["name"] for i in run_report if i["status"] == "failed"]
 
-        logger.info(f"STAC written to {stac_item_destination_url}")
+    writer.save_manifests()
+    logger.info(f"{writer.written} files written and {writer.unchanged} files unchanged")
 
-        print("manual break")
-        break
+    offenders = [i for i in run_report if i.get("exceeded") or i["status"] != "ok"]
+    run_report_file = os.path.join(stac_output_dir, f"{product_name}_stac_run_report{shard_suffix}")
+    with get_filesystem(path=str(run_report_file), anon=False).open(run_report_file, "w") as file:
+        json.dump(run_report, file, indent=2)
+    logger.info(
+        f"Run report written to {run_report_file}, "
+        f"{len(offenders)} rasters exceeded a limit or failed"
+    )
+
+    if failed_tasks:
+        failed_tasks_file = os.path.join(
+            stac_output_dir, f"{product_name}_stac_failed_tasks{shard_suffix}"
+        )
+        write_tasks_file(failed_tasks, str(failed_tasks_file))
+        logger.info(f"{len(failed_tasks)} failed tasks written to {failed_tasks_file}")
 
 
 if __name__ == "__main__":
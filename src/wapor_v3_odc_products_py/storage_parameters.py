@@ -1,18 +1,189 @@
+import collections
 import json
 import logging
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import click
-import rioxarray
+import rasterio
+import yaml
 from tqdm import tqdm
 
+from wapor_v3_odc_products_py.block_cache import open_raster
+from wapor_v3_odc_products_py.cog_header import read_cog_headers
 from wapor_v3_odc_products_py.io import check_directory_exists, get_filesystem
+from wapor_v3_odc_products_py.loading import (
+    DEFAULT_CHUNK_BYTES,
+    get_dask_chunks,
+    get_spatial_dims,
+)
 from wapor_v3_odc_products_py.logs import get_logger
-from wapor_v3_odc_products_py.utils import get_mapset_rasters
+from wapor_v3_odc_products_py.plan import (
+    get_file_layout,
+    get_header_requests,
+    write_plan,
+)
+from wapor_v3_odc_products_py.tasks import (
+    PARTITION_METHODS,
+    get_product_tasks,
+    get_shard_suffix,
+    write_tasks_file,
+)
+from wapor_v3_odc_products_py.utils import get_unique_dicts
 
 logger = get_logger(Path(__file__).stem, level=logging.INFO)
 
+# Storage parameters describing the internal layout of a raster.
+LAYOUT_PARAMETERS = [
+    "block_x",
+    "block_y",
+    "overview_factors",
+    "compression",
+    "predictor",
+    "interleave",
+    "is_cog",
+]
+
+
+def is_cog(ds: rasterio.DatasetReader) -> bool:
+    """
+    Check if an open raster follows the Cloud Optimized GeoTIFF layout, i.e. it
+    is internally tiled and has overviews unless it fits in a single block.
+    """
+    if ds.driver != "GTiff":
+        return False
+    block_y, block_x = ds.block_shapes[0]
+    if ds.width <= block_x and ds.height <= block_y:
+        # A single block, which rasterio doesn't report as tiled
+        return True
+    return ds.profile.get("tiled", False) and bool(ds.overviews(1))
+
+
+def get_raster_storage_parameters(file_path: str) -> dict:
+    """
+    Get the storage parameters and the internal layout of a raster from its header.
+
+    Parameters
+    ----------
+    file_path : str
+        File path or URL of the raster.
+
+    Returns
+    -------
+    dict
+        The CRS, resolution, alignment, data type, nodata, scale factor and offset
+        of the raster, and its internal block size, overview decimation factors,
+        compression, predictor, interleave and whether it is a COG.
+    """
+    with open_raster(file_path) as ds:
+        res_x, res_y = ds.transform.a, ds.transform.e
+        block_y, block_x = ds.block_shapes[0]
+        image_structure = ds.tags(ns="IMAGE_STRUCTURE")
+        item = {
+            "crs": f"EPSG:{ds.crs.to_epsg()}",
+            "res_x": res_x,
+            "res_y": res_y,
+            "align_x": round(ds.transform.c % abs(res_x), 12),
+            "align_y": round(ds.transform.f % abs(res_y), 12),
+            "add_offset": ds.offsets[0],
+            "scale_factor": ds.scales[0],
+            "dtype": ds.dtypes[0],
+            "nodata": ds.nodata,
+            "block_x": block_x,
+            "block_y": block_y,
+            "overview_factors": sorted(ds.overviews(1)),
+            "compression": image_structure.get("COMPRESSION"),
+            "predictor": int(image_structure.get("PREDICTOR", 1)),
+            "interleave": image_structure.get("INTERLEAVE"),
+            "is_cog": is_cog(ds),
+        }
+    return item
+
+
+def summarise_layouts(storage_parameters_list: list[dict]) -> list[tuple[dict, int]]:
+    """
+    Count the rasters sharing each distinct internal layout, most common first.
+    """
+    counts = collections.Counter(
+        json.dumps({k: item[k] for k in LAYOUT_PARAMETERS}, sort_keys=True)
+        for item in storage_parameters_list
+    )
+    return [(json.loads(layout), count) for layout, count in counts.most_common()]
+
+
+def get_recommended_product_section(
+    storage_parameters_list: list[dict], chunk_bytes: int = DEFAULT_CHUNK_BYTES
+) -> dict:
+    """
+    Get recommended `load` and `storage` sections of a product definition from the
+    storage parameters of the product's rasters.
+
+    The load grid is the native grid of the rasters and the storage chunking is a
+    whole number of the most common internal blocks, so that loads with these
+    settings read whole blocks without resampling.
+    """
+    grids = get_unique_dicts(
+        [
+            {k: item[k] for k in ["crs", "res_x", "res_y", "align_x", "align_y"]}
+            for item in storage_parameters_list
+        ]
+    )
+    if len(grids) > 1:
+        raise ValueError(f"The rasters are on {len(grids)} different grids: {grids}")
+    grid = grids[0]
+
+    layout, _ = summarise_layouts(storage_parameters_list)[0]
+    dtype = collections.Counter(item["dtype"] for item in storage_parameters_list).most_common(1)
+    chunks = get_dask_chunks((layout["block_y"], layout["block_x"]), dtype[0][0], chunk_bytes)
+
+    y_dim, x_dim = get_spatial_dims(grid["crs"])
+    resolution = {x_dim: grid["res_x"], y_dim: grid["res_y"]}
+    return {
+        "load": {
+            "crs": grid["crs"],
+            "resolution": resolution,
+            "align": {x_dim: grid["align_x"], y_dim: grid["align_y"]},
+        },
+        "storage": {
+            "crs": grid["crs"],
+            "resolution": dict(resolution),
+            "chunking": {x_dim: chunks["x"], y_dim: chunks["y"]},
+            "tile_size": {
+                x_dim: abs(grid["res_x"]) * chunks["x"],
+                y_dim: abs(grid["res_y"]) * chunks["y"],
+            },
+        },
+    }
+
+
+def plan_storage_parameters(
+    geotiffs_file_paths: list[str], max_workers: int = 16, recommend: bool = False
+) -> dict:
+    """
+    Plan getting the storage parameters of a list of rasters from the header of one
+    raster, without doing the work. Only the header of each raster is read.
+    """
+    number_of_rasters = len(geotiffs_file_paths)
+    if number_of_rasters:
+        layout = get_file_layout(geotiffs_file_paths[0])
+    else:
+        layout = {"header_bytes": 0, "header_seconds": 0.0}
+    estimates = {
+        "rasters": number_of_rasters,
+        "to_process": number_of_rasters,
+        "remote_requests": get_header_requests(layout["header_bytes"]) * number_of_rasters,
+        "bytes_read": layout["header_bytes"] * number_of_rasters,
+        "objects_written": 2 if recommend else 1,
+        "seconds_per_raster": round(layout["header_seconds"], 3),
+        "projected_seconds": round(
+            layout["header_seconds"] * math.ceil(number_of_rasters / max_workers), 1
+        ),
+        "throughput_source": "header read time of one raster",
+    }
+    return {"estimates": estimates, "tasks": geotiffs_file_paths, "skipped": []}
+
 
 @click.command()
 @click.option(
@@ -25,45 +196,103 @@ logger = get_logger(Path(__file__).stem, level=logging.INFO)
     default=None,
     help="Directory to write the unique storage parameters text file to",
 )
+@click.option(
+    "--shard",
+    default=None,
+    help="Only process the shard i/N of the product's rasters, where 0 <= i < N",
+)
+@click.option(
+    "--partition-method",
+    type=click.Choice(PARTITION_METHODS),
+    default="time",
+    help="Method used to split the rasters into shards",
+)
+@click.option(
+    "--tasks-file",
+    type=click.Path(),
+    default=None,
+    help="File listing the rasters to process, as written by `create-tasks`",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=16,
+    help="Number of raster headers to read concurrently",
+)
+@click.option(
+    "--async-headers",
+    is_flag=True,
+    default=False,
+    help="Decode the raster headers from range requests on one event loop instead of GDAL",
+)
+@click.option(
+    "--plan",
+    is_flag=True,
+    default=False,
+    help="Only write a plan of the work to do with cost estimates, without doing it",
+)
+@click.option(
+    "--recommend",
+    is_flag=True,
+    default=False,
+    help="Also write recommended load and storage sections for the product definition",
+)
 def get_storage_parameters(
     product_name: str,
     output_dir: str,
+    shard: str,
+    partition_method: str,
+    tasks_file: str,
+    max_workers: int,
+    async_headers: bool,
+    recommend: bool,
+    plan: bool,
 ):
-    if product_name == "wapor_soil_moisture":
-        mapset_code = "L2-RSM-D"
+    geotiffs_file_paths = get_product_tasks(
+        product_name=product_name,
+        shard=shard,
+        partition_method=partition_method,
+        tasks_file=tasks_file,
+    )
 
-    geotiffs_file_paths = get_mapset_rasters(mapset_code)
+    shard_suffix = get_shard_suffix(shard)
+    if plan:
+        plan_file = os.path.join(
+            output_dir, f"{product_name}_storage_parameters_plan{shard_suffix}"
+        )
+        fs = get_filesystem(path=output_dir, anon=False)
+        if not check_directory_exists(path=output_dir):
+            fs.mkdirs(path=output_dir, exist_ok=True)
+        write_plan(plan_storage_parameters(geotiffs_file_paths, max_workers, recommend), plan_file)
+        return
 
     storage_parameters_list = []
+    failed_tasks = []
 
-    for file_path in tqdm(iterable=geotiffs_file_paths, total=len(geotiffs_file_paths)):
-        da = rioxarray.open_rasterio(file_path)
-        crs = da.rio.crs.to_epsg()  # Coordinate Reference System
-        res_x, res_y = da.rio.resolution()  # Pixel resolution (x, y)
-        dtype = str(da.dtype)  # Data type of the first band
-        nodata = da.rio.nodata
-        attrs = da.attrs
-        add_offset = attrs.get("add_offset", None)
-        scale_factor = attrs.get("scale_factor", None)
+    if async_headers:
+        headers, failed_tasks = read_cog_headers(geotiffs_file_paths, max_concurrency=max_workers)
+        storage_parameters_list = [i.get_storage_parameters() for i in headers.values()]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(get_raster_storage_parameters, file_path): file_path
+                for file_path in geotiffs_file_paths
+            }
+            for future in tqdm(iterable=as_completed(futures), total=len(futures)):
+                file_path = futures[future]
+                try:
+                    storage_parameters_list.append(future.result())
+                except Exception as error:
+                    logger.exception(error)
+                    logger.error(f"Failed to get the storage parameters for {file_path}")
+                    failed_tasks.append(file_path)
 
-        item = {
-            "crs": f"EPSG:{crs}",
-            "res_x": res_x,
-            "res_y": res_y,
-            "add_offset": add_offset,
-            "scale_factor": scale_factor,
-            "dtype": dtype,
-            "nodata": nodata,
-        }
-        storage_parameters_list.append(item)
+    for layout, count in summarise_layouts(storage_parameters_list):
+        logger.info(f"{count} rasters have the layout {layout}")
 
-    # Convert dicts to JSON strings to create a unique set
-    unique_storage_parameters = [
-        json.loads(s) for s in {json.dumps(d, sort_keys=True) for d in storage_parameters_list}
-    ]
-    storage_parameters_json_array = json.dumps(unique_storage_parameters)
+    storage_parameters_json_array = json.dumps(get_unique_dicts(storage_parameters_list))
 
-    output_file = os.path.join(output_dir, f"{product_name}_storage_parameters")
+    output_file = os.path.join(output_dir, f"{product_name}_storage_parameters{shard_suffix}")
 
     fs = get_filesystem(path=output_dir, anon=False)
     if not check_directory_exists(path=output_dir):
@@ -72,7 +301,23 @@ def get_storage_parameters(
 
     with fs.open(output_file, "w") as file:
         file.write(storage_parameters_json_array)
-    logger.info(f"Tasks chunks written to {output_file}")
+    logger.info(f"Storage parameters written to {output_file}")
+
+    if recommend and storage_parameters_list:
+        product_section = get_recommended_product_section(storage_parameters_list)
+        product_section_file = os.path.join(
+            output_dir, f"{product_name}_recommended_product_section{shard_suffix}.yaml"
+        )
+        with fs.open(product_section_file, "w") as file:
+            yaml.safe_dump(product_section, file, sort_keys=False)
+        logger.info(f"Recommended product definition sections written to {product_section_file}")
+
+    if failed_tasks:
+        failed_tasks_file = os.path.join(
+            output_dir, f"{product_name}_storage_parameters_failed_tasks{shard_suffix}"
+        )
+        write_tasks_file(failed_tasks, failed_tasks_file)
+        logger.info(f"{len(failed_tasks)} failed tasks written to {failed_tasks_file}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import click
+from datacube import Datacube
+from datacube.index.hl import Doc2Dataset
+from datacube.utils import changes
+from eodatasets3 import serialise
+from eodatasets3.images import ValidDataMethod
+
+from wapor_v3_odc_products_py.explorer import (
+    get_period,
+    new_touched_periods,
+    record_touched_periods,
+)
+from wapor_v3_odc_products_py.footprints import FootprintCache
+from wapor_v3_odc_products_py.io import get_filesystem, is_s3_path
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.plan import get_modified_time
+from wapor_v3_odc_products_py.prepare_wapor_soil_moisture_metadata import get_dataset_id
+from wapor_v3_odc_products_py.stac import create_stac_file
+from wapor_v3_odc_products_py.tasks import get_task_id, write_tasks_file
+from wapor_v3_odc_products_py.throttle import call_throttled, get_host
+from wapor_v3_odc_products_py.utils import get_mapset_code, get_mapset_rasters
+from wapor_v3_odc_products_py.writes import ChangedWriter
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Largest fraction of the indexed datasets a sync archives without --force, as a
+# larger drop is more likely an API error or truncated listing than removed rasters
+MAX_ARCHIVE_FRACTION = 0.1
+
+
+def get_catalogue_listing(product_name: str) -> dict[str, tuple[str, datetime | None]]:
+    """
+    Get the rasters of a product from the WaPOR v3 catalogue and their last modified
+    times, from one listing of each directory the rasters are stored in.
+
+    Returns
+    -------
+    dict[str, tuple[str, datetime | None]]
+        The gsutil URI and last modified time of each raster, by raster code.
+    """
+    rasters = get_mapset_rasters(get_mapset_code(product_name))
+    # Use a gsutil URI instead of the the public URL
+    rasters = [i.replace("https://storage.googleapis.com/", "gs://") for i in rasters]
+
+    modified_times = {}
+    for directory in sorted({os.path.dirname(raster) for raster in rasters}):
+        fs = get_filesystem(path=directory, anon=True)
+        listing = call_throttled(get_host(directory), fs.ls, directory, detail=True)
+        for info in listing:
+            modified_times[os.path.basename(info["name"])] = get_modified_time(info)
+
+    return {
+        get_task_id(raster): (raster, modified_times.get(os.path.basename(raster)))
+        for raster in rasters
+    }
+
+
+def get_indexed_datasets(dc: Datacube, product_name: str) -> dict[uuid.UUID, datetime | None]:
+    """Get the processing time of each active dataset of a product in the index."""
+    indexed = {}
+    for row in dc.index.datasets.search_returning(
+        field_names=("id",),
+        custom_offsets={"processed": ["properties", "odc:processing_datetime"]},
+        product=product_name,
+    ):
+        processed = row.processed
+        if isinstance(processed, str):
+            processed = datetime.fromisoformat(processed.replace("Z", "+00:00"))
+        indexed[uuid.UUID(str(row.id))] = processed
+    return indexed
+
+
+def as_utc(value: datetime | None) -> datetime | None:
+    """
+    Treat naive datetimes as UTC so they can be compared with aware datetimes, truncated
+    to whole seconds as the Last-Modified header the processing time is taken from has
+    no sub-second precision, unlike the listing's modified times.
+    """
+    if value is None:
+        return value
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.replace(microsecond=0)
+
+
+def diff_catalogue_and_index(
+    catalogue: dict[str, tuple[str, datetime | None]],
+    indexed: dict[uuid.UUID, datetime | None],
+    product_name: str,
+) -> tuple[list[str], list[str], list[uuid.UUID]]:
+    """
+    Compare the rasters in the catalogue with the datasets in the index, matching them
+    by the deterministic dataset UUID of each raster.
+
+    Returns
+    -------
+    tuple[list[str], list[str], list[uuid.UUID]]
+        The rasters that are not indexed, the rasters modified since their dataset was
+        processed, and the UUIDs of the indexed datasets no longer in the catalogue.
+    """
+    new, changed = [], []
+    catalogue_ids = set()
+    for tile_id, (raster, modified) in sorted(catalogue.items()):
+        dataset_id = get_dataset_id(tile_id, product_name)
+        catalogue_ids.add(dataset_id)
+        if dataset_id not in indexed:
+            new.append(raster)
+            continue
+        processed, modified = as_utc(indexed[dataset_id]), as_utc(modified)
+        if modified is not None and (processed is None or modified > processed):
+            changed.append(raster)
+    removed = sorted(set(indexed) - catalogue_ids, key=str)
+    return new, changed, removed
+
+
+def check_archive(catalogue_size: int, indexed_size: int, removed_size: int, force: bool):
+    """
+    Refuse to archive datasets when the catalogue listing is empty or the datasets to
+    archive are more than MAX_ARCHIVE_FRACTION of the index, unless forced.
+
+    :raises RuntimeError: If archiving looks like the result of a bad listing
+    """
+    if force or removed_size == 0:
+        return
+    if catalogue_size == 0:
+        raise RuntimeError(
+            f"The catalogue listing is empty, refusing to archive all {indexed_size} datasets. "
+            "Use --force to archive them anyway"
+        )
+    if removed_size > MAX_ARCHIVE_FRACTION * indexed_size:
+        raise RuntimeError(
+            f"Refusing to archive {removed_size} of {indexed_size} datasets, more than "
+            f"{MAX_ARCHIVE_FRACTION:.0%} of the index. Use --force to archive them anyway"
+        )
+
+
+def index_dataset_doc(dc: Datacube, dataset_doc, uri: str, product_name: str):
+    """Add a dataset to the index, or update it if it already exists."""
+    resolver = Doc2Dataset(dc.index, products=[product_name])
+    dataset, error = resolver(serialise.to_doc(dataset_doc), uri)
+    if error:
+        raise ValueError(f"Failed to resolve the dataset {uri}: {error}")
+    if dc.index.datasets.has(dataset.id):
+        # Restore datasets archived by a previous sync whose raster was re-published
+        dc.index.datasets.restore([dataset.id])
+        dc.index.datasets.update(dataset, updates_allowed={tuple(): changes.allow_any})
+    else:
+        dc.index.datasets.add(dataset)
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the product to sync the index of with the WaPOR v3 catalogue",
+)
+@click.option(
+    "--product-yaml",
+    type=click.Path(),
+    help="File path to the product definition yaml file",
+)
+@click.option(
+    "--stac-output-dir",
+    type=click.Path(),
+    help="Directory to write the stac files of the new and changed datasets to",
+)
+@click.option(
+    "--metadata-output-dir",
+    type=click.Path(),
+    default=None,
+    help="Directory to write the metadata docs to",
+)
+@click.option(
+    "--valid-data-method",
+    type=click.Choice([method.name for method in ValidDataMethod]),
+    default=ValidDataMethod.bounds.name,
+    help="Method used to compute the valid data polygon of each dataset",
+)
+@click.option(
+    "--footprint-cache-dir",
+    type=click.Path(),
+    default=None,
+    help="Directory to cache the valid data polygons in, shared between runs",
+)
+@click.option(
+    "--touched-periods-file",
+    type=click.Path(),
+    default=None,
+    help="File to record the months touched in, to only refresh their Explorer summaries",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Only write the new, changed and removed datasets without changing the index",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="Archive the removed datasets even when the listing is empty or most are removed",
+)
+def sync(
+    product_name: str,
+    product_yaml: str,
+    stac_output_dir: str,
+    metadata_output_dir: str,
+    valid_data_method: str,
+    footprint_cache_dir: str,
+    touched_periods_file: str,
+    dry_run: bool,
+    force: bool,
+):
+    if isinstance(metadata_output_dir, str):
+        if is_s3_path(metadata_output_dir):
+            raise RuntimeError("Metadata files require to be written to a local directory")
+        else:
+            metadata_output_dir = Path(metadata_output_dir).resolve()
+    if not is_s3_path(product_yaml):
+        product_yaml = Path(product_yaml).resolve()
+    if not is_s3_path(stac_output_dir):
+        stac_output_dir = Path(stac_output_dir).resolve()
+        stac_output_dir.mkdir(parents=True, exist_ok=True)
+
+    dc = Datacube(app="wapor-sync")
+
+    catalogue = get_catalogue_listing(product_name)
+    indexed = get_indexed_datasets(dc, product_name)
+    new, changed, removed = diff_catalogue_and_index(catalogue, indexed, product_name)
+    logger.info(
+        f"{len(catalogue)} rasters in the catalogue and {len(indexed)} datasets in the index: "
+        f"{len(new)} new, {len(changed)} changed and {len(removed)} removed"
+    )
+
+    if dry_run:
+        diff_file = os.path.join(stac_output_dir, f"{product_name}_sync_diff")
+        with get_filesystem(path=str(diff_file), anon=False).open(diff_file, "w") as file:
+            json.dump(
+                {"new": new, "changed": changed, "removed": [str(i) for i in removed]},
+                file,
+                indent=2,
+            )
+        logger.info(f"Sync diff written to {diff_file}")
+        return
+
+    check_archive(len(catalogue), len(indexed), len(removed), force)
+
+    valid_data_method = ValidDataMethod[valid_data_method]
+    footprint_cache = FootprintCache(footprint_cache_dir)
+
+    writer = ChangedWriter()
+    touched = new_touched_periods()
+    failed_tasks = []
+    tasks = new + changed
+    for idx, geotiff in enumerate(tasks):
+        logger.info(f"Syncing {geotiff} {idx+1}/{len(tasks)}")
+        try:
+            dataset_doc = create_stac_file(
+                product_name=product_name,
+                geotiff=geotiff,
+                product_yaml=product_yaml,
+                stac_output_dir=stac_output_dir,
+                metadata_output_dir=metadata_output_dir,
+                valid_data_method=valid_data_method,
+                footprint_cache=footprint_cache,
+                writer=writer,
+            )
+            uri = os.path.join(str(stac_output_dir), f"{get_task_id(geotiff)}.stac-item.json")
+            if not is_s3_path(uri):
+                uri = Path(uri).as_uri()
+            index_dataset_doc(dc, dataset_doc, uri, product_name)
+            touched[product_name].add(get_period(dataset_doc.properties["datetime"]))
+        except Exception as error:
+            logger.exception(error)
+            logger.error(f"Failed to sync {geotiff}")
+            failed_tasks.append(geotiff)
+
+    writer.save_manifests()
+    logger.info(f"{writer.written} files written and {writer.unchanged} files unchanged")
+
+    if removed:
+        for dataset in dc.index.datasets.bulk_get(removed):
+            touched[product_name].add(get_period(dataset.center_time))
+        dc.index.datasets.archive(removed)
+        logger.info(f"Archived {len(removed)} datasets no longer in the catalogue")
+
+    if touched_periods_file:
+        record_touched_periods(touched_periods_file, touched)
+
+    if failed_tasks:
+        failed_tasks_file = os.path.join(stac_output_dir, f"{product_name}_sync_failed_tasks")
+        write_tasks_file(failed_tasks, str(failed_tasks_file))
+        logger.info(f"{len(failed_tasks)} failed tasks written to {failed_tasks_file}")
+
+
+if __name__ == "__main__":
+    sync()
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import click
+
+from wapor_v3_odc_products_py.io import check_directory_exists, get_filesystem
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.utils import get_mapset_code, get_mapset_rasters
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+PARTITION_METHODS = ["time", "hash"]
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """
+    Parse a shard specification of the form `i/N` into the zero based shard
+    index `i` and the total number of shards `N`.
+    """
+    try:
+        shard_index, shard_count = [int(i) for i in shard.split("/")]
+    except ValueError:
+        raise ValueError(f"Shard {shard} is not of the form i/N")
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard {shard} must satisfy 0 <= i < N")
+    return shard_index, shard_count
+
+
+def get_shard_suffix(shard: str | None) -> str:
+    """Get the suffix used to name the outputs written by a shard."""
+    if shard is None:
+        return ""
+    shard_index, shard_count = parse_shard(shard)
+    return f"_shard_{shard_index}_of_{shard_count}"
+
+
+def get_task_id(task: str) -> str:
+    """
+    Get the identifier of a task i.e. the raster code, which is stable
+    whether the raster is referenced by a public URL or a gsutil URI.
+    """
+    return os.path.basename(task).removesuffix(".tif")
+
+
+def get_stable_hash(task: str) -> int:
+    """Get a hash of the task identifier that does not change between processes."""
+    return int(hashlib.md5(get_task_id(task).encode("utf-8")).hexdigest(), 16)
+
+
+def split_tasks(tasks: list[str], number_of_chunks: int, partition_method: str = "time") -> list:
+    """
+    Split a list of tasks into chunks.
+
+    Parameters
+    ----------
+    tasks : list[str]
+        Raster URLs to split.
+    number_of_chunks : int
+        Number of chunks to split the tasks into.
+    partition_method : str
+        `time` splits the tasks, ordered by raster code (and therefore by time),
+        into contiguous chunks whose sizes differ by at most one task.
+        `hash` assigns each task to a chunk using a stable hash of its raster code,
+        so a task stays in the same chunk as new rasters are added to the mapset.
+
+    Returns
+    -------
+    list
+        A list of `number_of_chunks` lists of tasks.
+    """
+    if partition_method not in PARTITION_METHODS:
+        raise ValueError(f"Partition method must be one of {PARTITION_METHODS}")
+
+    sorted_tasks = sorted(tasks, key=get_task_id)
+
+    if partition_method == "hash":
+        chunks = [[] for _ in range(number_of_chunks)]
+        for task in sorted_tasks:
+            chunks[get_stable_hash(task) % number_of_chunks].append(task)
+    else:
+        chunk_size, remainder = divmod(len(sorted_tasks), number_of_chunks)
+        chunks = []
+        start = 0
+        for idx in range(number_of_chunks):
+            end = start + chunk_size + (1 if idx < remainder else 0)
+            chunks.append(sorted_tasks[start:end])
+            start = end
+    return chunks
+
+
+def get_shard_tasks(tasks: list[str], shard: str, partition_method: str = "time") -> list[str]:
+    """Get the tasks to be processed by the shard `i/N`."""
+    shard_index, shard_count = parse_shard(shard)
+    return split_tasks(tasks, shard_count, partition_method)[shard_index]
+
+
+def write_tasks_file(tasks: list[str], path: str):
+    """Write a list of tasks to a JSON file."""
+    fs = get_filesystem(path=path, anon=False)
+    with fs.open(path, "w") as file:
+        json.dump(tasks, file, indent=2)
+
+
+def read_tasks_file(path: str) -> list[str]:
+    """Read a list of tasks from a JSON file."""
+    fs = get_filesystem(path=path, anon=True)
+    with fs.open(path, "r") as file:
+        tasks = json.load(file)
+    return tasks
+
+
+def get_product_tasks(
+    product_name: str,
+    shard: str = None,
+    partition_method: str = "time",
+    tasks_file: str = None,
+) -> list[str]:
+    """
+    Get the raster URLs to process for a product, either from a tasks file
+    or from the WaPOR v3 catalogue listing of the product's mapset,
+    optionally restricted to a single shard.
+    """
+    if tasks_file is not None:
+        tasks = read_tasks_file(tasks_file)
+        logger.info(f"Found {len(tasks)} tasks in {tasks_file}")
+    else:
+        tasks = get_mapset_rasters(get_mapset_code(product_name))
+
+    if shard is not None:
+        tasks = get_shard_tasks(tasks, shard, partition_method)
+        logger.info(f"Shard {shard} has {len(tasks)} tasks")
+    return tasks
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the product to create the tasks for",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(),
+    help="Directory to write the tasks chunk files to",
+)
+@click.option(
+    "--number-of-chunks",
+    type=int,
+    default=1,
+    help="Number of chunks to split the tasks into e.g. the number of parallel workers",
+)
+@click.option(
+    "--partition-method",
+    type=click.Choice(PARTITION_METHODS),
+    default="time",
+    help="Split the tasks into contiguous time periods or by a stable hash of the raster code",
+)
+def create_tasks(
+    product_name: str,
+    output_dir: str,
+    number_of_chunks: int,
+    partition_method: str,
+):
+    tasks = get_mapset_rasters(get_mapset_code(product_name))
+
+    chunks = split_tasks(tasks, number_of_chunks, partition_method)
+
+    fs = get_filesystem(path=output_dir, anon=False)
+    if not check_directory_exists(path=output_dir):
+        fs.mkdirs(path=output_dir, exist_ok=True)
+        logger.info(f"Created directory {output_dir}")
+
+    for idx, chunk in enumerate(chunks):
+        output_file = os.path.join(
+            output_dir, f"{product_name}_tasks{get_shard_suffix(f'{idx}/{number_of_chunks}')}"
+        )
+        write_tasks_file(chunk, output_file)
+        logger.info(f"{len(chunk)} tasks written to {output_file}")
+
+
+if __name__ == "__main__":
+    create_tasks()
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from wapor_v3_odc_products_py.aggregate import (
+    accumulate_window,
+    get_aggregate_code,
+    get_mean,
+    get_windows,
+    group_rasters_by_period,
+)
+
+RASTERS = [
+    "gs://bucket/L2-RSM-D/WAPOR-3.L2-RSM-D.2020-01-D1.tif",
+    "gs://bucket/L2-RSM-D/WAPOR-3.L2-RSM-D.2021-01-D1.tif",
+    "gs://bucket/L2-RSM-D/WAPOR-3.L2-RSM-D.2020-02-D3.tif",
+]
+
+
+@pytest.mark.parametrize(
+    "period,expected",
+    [
+        ("monthly", {"2020-01": [RASTERS[0]], "2020-02": [RASTERS[2]], "2021-01": [RASTERS[1]]}),
+        ("annual", {"2020": [RASTERS[0], RASTERS[2]], "2021": [RASTERS[1]]}),
+        ("monthly_climatology", {"01": [RASTERS[0], RASTERS[1]], "02": [RASTERS[2]]}),
+    ],
+)
+def test_group_rasters_by_period(period, expected):
+    assert group_rasters_by_period(RASTERS, period) == expected
+
+
+def test_get_aggregate_code():
+    code = "WAPOR-3.L2-RSM-D.2020-01-D1"
+    assert get_aggregate_code(code, "monthly", "2020-01") == "WAPOR-3.L2-RSM-M.2020-01"
+    assert get_aggregate_code(code, "monthly_climatology", "01") == "WAPOR-3.L2-RSM-LTM.01"
+
+
+def test_get_windows_cover_grid():
+    windows = get_windows((5, 7), 4)
+    assert sum(window.width * window.height for window in windows) == 35
+
+
+def test_accumulate_window_and_mean(tmp_path):
+    arrays = [
+        np.array([[10, -9999], [20, -9999]], dtype="int16"),
+        np.array([[21, 5], [-9999, -9999]], dtype="int16"),
+    ]
+    rasters = []
+    for idx, array in enumerate(arrays):
+        path = str(tmp_path / f"{idx}.tif")
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            width=2,
+            height=2,
+            count=1,
+            dtype="int16",
+            nodata=-9999,
+            crs="EPSG:4326",
+            transform=from_origin(0, 2, 1, 1),
+        ) as ds:
+            ds.write(array, 1)
+        rasters.append(path)
+
+    sources = [rasterio.open(raster) for raster in rasters]
+    total, count = accumulate_window(sources, get_windows((2, 2), 2)[0])
+    for src in sources:
+        src.close()
+    assert total.dtype == np.int32
+    np.testing.assert_array_equal(count, [[2, 1], [1, 0]])
+    mean = get_mean(total, count, "int16", -9999)
+    np.testing.assert_array_equal(mean, [[16, 5], [20, -9999]])
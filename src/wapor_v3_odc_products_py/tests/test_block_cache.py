@@ -0,0 +1,100 @@
+from unittest import mock
+
+import fsspec
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from wapor_v3_odc_products_py.block_cache import BlockCache
+
+
+def write_raster(path):
+    array = np.arange(256 * 256, dtype="int32").reshape(256, 256)
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=256,
+        height=256,
+        count=1,
+        dtype="int32",
+        crs="EPSG:4326",
+        transform=from_origin(0, 256, 1, 1),
+        tiled=True,
+        blockxsize=64,
+        blockysize=64,
+    ) as ds:
+        ds.write(array, 1)
+    return array
+
+
+def test_block_cache_serves_repeat_reads_from_disk(tmp_path):
+    path = str(tmp_path / "raster.tif")
+    array = write_raster(path)
+    fs = fsspec.filesystem("file")
+
+    with (
+        mock.patch("wapor_v3_odc_products_py.block_cache.get_remote_filesystem", return_value=fs),
+        mock.patch.object(fs, "cat_file", wraps=fs.cat_file) as cat_file,
+    ):
+        cache = BlockCache(tmp_path / "cache", max_bytes=2**30, block_size=4096)
+        with rasterio.open(path, opener=cache.opener) as ds:
+            np.testing.assert_array_equal(ds.read(1), array)
+        assert cat_file.call_count > 0
+
+        # A new cache on the same directory, as in another process, reads from disk only
+        cat_file.reset_mock()
+        cache = BlockCache(tmp_path / "cache", max_bytes=2**30, block_size=4096)
+        with rasterio.open(path, opener=cache.opener) as ds:
+            np.testing.assert_array_equal(
+                ds.read(1, window=((64, 128), (0, 64))), array[64:128, :64]
+            )
+        assert cat_file.call_count == 0
+
+
+def test_block_cache_evicts_least_recently_used(tmp_path):
+    path = tmp_path / "file.bin"
+    data = bytes(range(256)) * 64
+    path.write_bytes(data)
+
+    with mock.patch(
+        "wapor_v3_odc_products_py.block_cache.get_remote_filesystem",
+        return_value=fsspec.filesystem("file"),
+    ):
+        cache = BlockCache(tmp_path / "cache", max_bytes=4096, block_size=1024)
+        with cache.open(str(path)) as file:
+            assert file.read() == data
+            file.seek(-10, 2)
+            assert file.read(100) == data[-10:]
+
+    blocks = list((tmp_path / "cache" / "blocks").rglob("*-*"))
+    assert 0 < sum(block.stat().st_size for block in blocks) <= 4096
+    # The last blocks read are kept
+    assert any(block.name.endswith("-15") for block in blocks)
+
+
+def test_block_cache_batches_index_updates(tmp_path):
+    path = tmp_path / "file.bin"
+    data = bytes(range(256)) * 64
+    path.write_bytes(data)
+
+    with mock.patch(
+        "wapor_v3_odc_products_py.block_cache.get_remote_filesystem",
+        return_value=fsspec.filesystem("file"),
+    ):
+        cache = BlockCache(tmp_path / "cache", max_bytes=2**30, block_size=1024)
+        with mock.patch.object(cache, "_connect", wraps=cache._connect) as connect:
+            with cache.open(str(path)) as file:
+                # Looking up the file info
+                connect.reset_mock()
+                for _ in range(3):
+                    file.seek(0)
+                    assert file.read() == data
+                assert connect.call_count == 0
+            # Recording the blocks read and checking the total size
+            assert connect.call_count == 2
+
+        with cache._connect() as connection:
+            total = connection.execute("SELECT size FROM total").fetchone()[0]
+            assert total == connection.execute("SELECT SUM(size) FROM blocks").fetchone()[0]
+    assert total == len(data)
@@ -0,0 +1,62 @@
+import uuid
+
+import yaml
+from datacube.index.abstract import default_metadata_type_docs
+from datacube.model import MetadataType, Product
+
+from wapor_v3_odc_products_py.bulk_index import get_staging_rows, read_dataset_doc
+
+PRODUCT = "wapor_soil_moisture"
+
+
+def get_product() -> Product:
+    eo3 = [doc for doc in default_metadata_type_docs() if doc["name"] == "eo3"][0]
+    return Product(
+        MetadataType(eo3, id_=1),
+        {
+            "name": PRODUCT,
+            "metadata_type": "eo3",
+            "metadata": {"product": {"name": PRODUCT}},
+            "measurements": [{"name": "relative_soil_moisture", "dtype": "int16", "units": "%"}],
+        },
+        id_=2,
+    )
+
+
+def write_eo3_doc(tmp_path, product_name: str = PRODUCT) -> tuple:
+    dataset_id, source_id = str(uuid.uuid4()), str(uuid.uuid4())
+    doc = {
+        "$schema": "https://schemas.opendatacube.org/dataset",
+        "id": dataset_id,
+        "product": {"name": product_name},
+        "crs": "EPSG:4326",
+        "grids": {
+            "default": {"shape": [200, 300], "transform": [0.1, 0, -30, 0, -0.1, 40, 0, 0, 1]}
+        },
+        "measurements": {"relative_soil_moisture": {"path": "rsm.tif"}},
+        "properties": {"datetime": "2020-01-10T00:00:00Z"},
+        "lineage": {"source": [source_id]},
+    }
+    path = tmp_path / f"{dataset_id}.odc-metadata.yaml"
+    path.write_text(yaml.safe_dump(doc))
+    return str(path), dataset_id, source_id
+
+
+def test_read_dataset_doc_moves_lineage_to_sources(tmp_path):
+    path, _, source_id = write_eo3_doc(tmp_path)
+    doc, sources = read_dataset_doc(path, get_product())
+    assert sources == [("source", source_id)]
+    assert doc["lineage"] == {"source_datasets": {}}
+    assert doc["extent"]["lat"] == {"begin": 20.0, "end": 40.0}
+
+
+def test_get_staging_rows(tmp_path):
+    path, dataset_id, source_id = write_eo3_doc(tmp_path)
+    other_product_path, _, _ = write_eo3_doc(tmp_path, product_name="other")
+    dataset_rows, location_rows, source_rows, failed = get_staging_rows(
+        get_product(), [path, other_product_path]
+    )
+    assert [row[:3] for row in dataset_rows] == [(dataset_id, 1, 2)]
+    assert location_rows == [(dataset_id, "file", "//" + path)]
+    assert source_rows == [(dataset_id, "source", source_id)]
+    assert failed == [other_product_path]
@@ -0,0 +1,53 @@
+from unittest import mock
+
+import numpy as np
+
+from wapor_v3_odc_products_py.catalogue import CatalogueListing, get_catalogue_listing
+
+PAGES = {
+    "https://catalogue/rasters": {
+        "items": [
+            {"code": "B", "downloadUrl": "https://b.tif", "links": [{"href": "x"}], "size": 2},
+            {"code": "A", "downloadUrl": "https://a.tif", "links": [{"href": "y"}], "size": 1},
+        ],
+        "links": [{"rel": "next", "href": "https://catalogue/rasters?page=2"}],
+    },
+    "https://catalogue/rasters?page=2": {
+        "items": [{"code": "Ç", "downloadUrl": "https://c.tif", "links": [{"href": "z"}]}],
+        "links": [{"rel": "self", "href": "https://catalogue/rasters?page=2"}],
+    },
+}
+
+
+def request(method, url):
+    response = mock.Mock()
+    response.json.return_value = {"response": PAGES[url]}
+    return response
+
+
+@mock.patch("wapor_v3_odc_products_py.catalogue.throttled_request", side_effect=request)
+def test_get_catalogue_listing_projection(_):
+    listing = get_catalogue_listing("https://catalogue/rasters")
+    assert listing.columns == ("code", "downloadUrl")
+    assert listing.get_column("code") == ["B", "A", "Ç"]
+    assert listing.sort("code").get_column("downloadUrl") == [
+        "https://a.tif",
+        "https://b.tif",
+        "https://c.tif",
+    ]
+
+    listing = get_catalogue_listing("https://catalogue/rasters", ("links", "size"))
+    assert listing.get_column("links") == ["x", "y", "z"]
+    assert listing.get_column("size") == ["2", "1", ""]
+
+
+def test_save_and_load_memory_mapped(tmp_path):
+    listing = CatalogueListing.from_columns({"code": ["A", "Ç"], "downloadUrl": ["a", "c"]})
+    path = str(tmp_path / "listing.npy")
+    listing.save(path)
+
+    loaded = CatalogueListing.load(path)
+    assert isinstance(loaded._array, np.memmap)
+    assert loaded.get_column("code") == ["A", "Ç"]
+    combined = CatalogueListing.concatenate([loaded, listing])
+    assert combined.to_dataframe()["downloadUrl"].to_list() == ["a", "c", "a", "c"]
@@ -0,0 +1,118 @@
+import asyncio
+import functools
+import http.server
+import threading
+import time
+from unittest import mock
+
+import aiohttp
+import numpy as np
+import pytest
+import rasterio
+from eodatasets3.images import GridSpec
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+
+from wapor_v3_odc_products_py import cog_header
+from wapor_v3_odc_products_py.cog_header import read_cog_header, read_cog_headers
+from wapor_v3_odc_products_py.storage_parameters import get_raster_storage_parameters
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """File server answering range requests, as object stores do."""
+
+    requests = []
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.requests.append(range_header)
+        try:
+            with open(self.translate_path(self.path), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        start, end = (int(i) for i in range_header.removeprefix("bytes=").split("-"))
+        chunk = data[start : end + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{start + len(chunk) - 1}/{len(data)}")
+        self.send_header("Content-Length", str(len(chunk)))
+        self.end_headers()
+        self.wfile.write(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def cog_url(tmp_path):
+    path = tmp_path / "raster.tif"
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=1024,
+        height=512,
+        count=1,
+        dtype="int16",
+        nodata=-9999,
+        crs="EPSG:4326",
+        transform=from_origin(-30, 40, 0.01, 0.01),
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="deflate",
+        predictor=2,
+    ) as ds:
+        ds.write(np.arange(1024 * 512, dtype="int16").reshape(512, 1024), 1)
+        ds.scales = (0.01,)
+        ds.build_overviews([2, 4], Resampling.nearest)
+
+    handler = functools.partial(RangeRequestHandler, directory=str(tmp_path))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/raster.tif", str(path)
+    server.shutdown()
+
+
+def test_read_cog_headers_matches_gdal(cog_url):
+    url, path = cog_url
+    headers, failed = read_cog_headers([url, f"{url}.missing"])
+    assert failed == [f"{url}.missing"]
+    assert headers[url].get_storage_parameters() == get_raster_storage_parameters(path)
+    with rasterio.open(path) as ds:
+        grid = GridSpec.from_rio(ds)
+    assert headers[url].grid == grid
+    assert headers[url].grid.crs == grid.crs
+    assert headers[url].nodata == -9999
+
+
+def test_read_cog_header_fetches_more_of_large_headers(cog_url):
+    url, path = cog_url
+    RangeRequestHandler.requests.clear()
+
+    async def read():
+        async with aiohttp.ClientSession() as session:
+            return await read_cog_header(session, url, initial_bytes=64)
+
+    header = asyncio.run(read())
+    assert header.overview_factors == [2, 4]
+    assert RangeRequestHandler.requests[0] == "bytes=0-63"
+    assert len(RangeRequestHandler.requests) > 1
+
+
+def test_read_cog_headers_resolves_mirrors_concurrently(cog_url):
+    url, _ = cog_url
+    urls = [f"{url}?copy={i}" for i in range(8)]
+
+    def resolve_mirror_path(path):
+        # Blocking, as checking a mirror is current makes a request
+        time.sleep(0.5)
+        return url
+
+    start = time.monotonic()
+    with mock.patch.object(cog_header, "resolve_mirror_path", side_effect=resolve_mirror_path):
+        headers, failed = read_cog_headers(urls, max_concurrency=8)
+    assert failed == [] and len(headers) == 8
+    # Resolving the mirrors one at a time on the event loop would take 4 seconds
+    assert time.monotonic() - start < 2
@@ -0,0 +1,64 @@
+import json
+from datetime import datetime, timezone
+from unittest import mock
+
+from click.testing import CliRunner
+
+from wapor_v3_odc_products_py.explorer import (
+    get_period,
+    read_touched_periods,
+    record_touched_periods,
+    record_touched_periods_cli,
+    refresh_explorer,
+)
+
+
+def test_get_period():
+    assert get_period("2020-01-21T00:00:00Z") == "2020-01"
+    assert get_period(datetime(2020, 12, 1, tzinfo=timezone.utc)) == "2020-12"
+
+
+def test_record_touched_periods_merges(tmp_path):
+    path = str(tmp_path / "touched.json")
+    record_touched_periods(path, {"wapor_soil_moisture": {"2020-01"}})
+    record_touched_periods(path, {"wapor_soil_moisture": {"2020-02"}, "other": {"2021-05"}})
+    assert read_touched_periods(path) == {
+        "wapor_soil_moisture": {"2020-01", "2020-02"},
+        "other": {"2021-05"},
+    }
+
+
+def test_refresh_explorer_only_touched_products(tmp_path):
+    path = str(tmp_path / "touched.json")
+    runner = CliRunner()
+    with mock.patch("wapor_v3_odc_products_py.explorer.subprocess.run") as run:
+        result = runner.invoke(refresh_explorer, ["--touched-periods-file", path])
+        assert result.exit_code == 0, result.output
+        run.assert_not_called()
+
+        record_touched_periods(path, {"wapor_soil_moisture": {"2020-01"}})
+        result = runner.invoke(
+            refresh_explorer,
+            ["--touched-periods-file", path, "--command", "docker compose exec cubedash-gen"],
+        )
+        assert result.exit_code == 0, result.output
+        run.assert_called_once_with(
+            ["docker", "compose", "exec", "cubedash-gen", "wapor_soil_moisture"], check=True
+        )
+    assert read_touched_periods(path) == {}
+
+
+def test_record_touched_periods_cli(tmp_path):
+    path = str(tmp_path / "touched.json")
+    stac_item_files = []
+    for task_id, date in [("2020-01-D3", "2020-01-21"), ("2020-02-D1", "2020-02-01")]:
+        stac_item_file = tmp_path / f"WAPOR-3.L2-RSM-D.{task_id}.stac-item.json"
+        stac_item_file.write_text(json.dumps({"properties": {"datetime": f"{date}T00:00:00Z"}}))
+        stac_item_files.append(str(stac_item_file))
+
+    result = CliRunner().invoke(
+        record_touched_periods_cli,
+        ["--product-name", "wapor_soil_moisture", "--touched-periods-file", path, *stac_item_files],
+    )
+    assert result.exit_code == 0, result.output
+    assert read_touched_periods(path) == {"wapor_soil_moisture": {"2020-01", "2020-02"}}
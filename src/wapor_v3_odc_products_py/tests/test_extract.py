@@ -0,0 +1,150 @@
+import os
+from unittest import mock
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely.geometry import Point, box
+
+from wapor_v3_odc_products_py import extract
+from wapor_v3_odc_products_py.extract import (
+    extract_time_series,
+    get_block_windows,
+    get_zonal_statistics,
+)
+from wapor_v3_odc_products_py.loading import get_storage_profile
+
+TRANSFORM = from_origin(0, 64, 1, 1)
+
+
+def write_raster(path, array):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=64,
+        height=64,
+        count=1,
+        dtype=array.dtype,
+        nodata=-9999,
+        crs="EPSG:4326",
+        transform=TRANSFORM,
+        tiled=True,
+        blockxsize=16,
+        blockysize=16,
+    ) as ds:
+        ds.write(array, 1)
+
+
+@pytest.fixture
+def rasters(tmp_path):
+    paths = []
+    for dekad in (1, 2):
+        array = np.arange(64 * 64, dtype="int32").reshape(64, 64) * dekad
+        array[11, 11] = -9999
+        path = str(tmp_path / f"WAPOR-3.L2-RSM-D.2020-01-D{dekad}.tif")
+        write_raster(path, array)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def gdf():
+    return gpd.GeoDataFrame(
+        {"name": ["point", "square", "straddling"]},
+        geometry=[
+            # Centre of the pixel at row 5, column 20
+            Point(20.5, 58.5),
+            # Rows and columns 10 to 12
+            box(10, 51, 13, 54),
+            # Rows 2 to 3 and columns 14 to 17, across two blocks
+            box(14, 60, 18, 62),
+        ],
+        crs="EPSG:4326",
+    )
+
+
+def test_get_block_windows(rasters, gdf):
+    profile = get_storage_profile(rasters[0])
+    block_windows = get_block_windows(gdf, profile)
+    # Each block is read once, for all the geometries within it
+    windows = [window for window, _, _ in block_windows]
+    assert windows == [
+        Window(col_off=0, row_off=0, width=16, height=16),
+        Window(col_off=16, row_off=0, width=16, height=16),
+    ]
+
+    rows, cols = {}, {}
+    for window, pixel_indices, geometry_indices in block_windows:
+        window_rows, window_cols = np.unravel_index(
+            pixel_indices, (int(window.height), int(window.width))
+        )
+        for position in np.unique(geometry_indices):
+            in_geometry = geometry_indices == position
+            rows.setdefault(position, set()).update(window_rows[in_geometry] + window.row_off)
+            cols.setdefault(position, set()).update(window_cols[in_geometry] + window.col_off)
+    assert rows == {0: {5}, 1: {10, 11, 12}, 2: {2, 3}}
+    assert cols == {0: {20}, 1: {10, 11, 12}, 2: {14, 15, 16, 17}}
+
+    # Outside the grid
+    outside = gpd.GeoDataFrame(geometry=[box(100, 100, 110, 110)], crs="EPSG:4326")
+    assert get_block_windows(outside, profile) == []
+
+
+def test_get_zonal_statistics():
+    statistics = get_zonal_statistics(
+        np.array([1, 2, -9999, 6, -9999]), np.array([0, 0, 0, 2, 3]), 4, -9999
+    )
+    assert statistics["count"].tolist() == [2, 0, 1, 0]
+    np.testing.assert_array_equal(statistics["mean"], [1.5, np.nan, 6, np.nan])
+    np.testing.assert_array_equal(statistics["min"], [1, np.nan, 6, np.nan])
+    np.testing.assert_array_equal(statistics["max"], [2, np.nan, 6, np.nan])
+
+    statistics = get_zonal_statistics(np.array([np.nan, 2.5]), np.array([0, 0]), 1, None)
+    assert statistics["count"].tolist() == [1]
+    assert statistics["mean"].tolist() == [2.5]
+
+
+def test_extract_time_series(tmp_path, rasters, gdf):
+    output_file = str(tmp_path / "time_series.parquet")
+    missing = str(tmp_path / "WAPOR-3.L2-RSM-D.2020-01-D3.tif")
+    failed = extract_time_series(gdf, rasters + [missing], output_file, "name", max_workers=2)
+    assert failed == [missing]
+
+    df = pd.read_parquet(output_file).set_index(["raster", "id"])
+    square = df.loc[("WAPOR-3.L2-RSM-D.2020-01-D2", "square")]
+    # The nodata pixel at row 11, column 11 is left out
+    values = [2 * (row * 64 + col) for row in (10, 11, 12) for col in (10, 11, 12)]
+    values.remove(2 * (11 * 64 + 11))
+    assert square["count"] == 8
+    assert square["mean"] == pytest.approx(np.mean(values))
+    assert (square["min"], square["max"]) == (min(values), max(values))
+    point = df.loc[("WAPOR-3.L2-RSM-D.2020-01-D1", "point")]
+    assert (point["count"], point["mean"]) == (1, 5 * 64 + 20)
+    # Combined across the two blocks it spans
+    straddling = df.loc[("WAPOR-3.L2-RSM-D.2020-01-D1", "straddling")]
+    values = [row * 64 + col for row in (2, 3) for col in (14, 15, 16, 17)]
+    assert straddling["count"] == 8
+    assert straddling["mean"] == pytest.approx(np.mean(values))
+    assert (straddling["min"], straddling["max"]) == (min(values), max(values))
+
+
+def test_extract_time_series_outside_the_grid(tmp_path, rasters):
+    output_file = str(tmp_path / "time_series.parquet")
+    outside = gpd.GeoDataFrame(geometry=[box(100, 100, 110, 110)], crs="EPSG:4326")
+    assert extract_time_series(outside, rasters, output_file) == []
+    assert len(pd.read_parquet(output_file)) == 0
+
+
+def test_extract_time_series_without_output(tmp_path, rasters, gdf):
+    output_file = str(tmp_path / "time_series.parquet")
+    assert extract_time_series(gdf, [], output_file) == []
+    assert not os.path.exists(output_file)
+
+    with mock.patch.object(extract, "extract_raster", side_effect=IOError("Read failed")):
+        assert sorted(extract_time_series(gdf, rasters, output_file)) == rasters
+    assert not os.path.exists(output_file)
@@ -0,0 +1,89 @@
+from unittest import mock
+
+import numpy as np
+import pytest
+import rasterio
+from eodatasets3.images import ValidDataMethod
+from rasterio.enums import Resampling
+from rasterio.features import shapes
+from rasterio.transform import from_origin
+from shapely.geometry import box, shape
+from shapely.ops import unary_union
+
+from wapor_v3_odc_products_py import footprints
+from wapor_v3_odc_products_py.footprints import (
+    FootprintCache,
+    get_footprint,
+    get_valid_mask,
+    read_overview_mask,
+)
+
+TRANSFORM = from_origin(-30, 40, 0.01, 0.01)
+
+
+def write_raster(path, array):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=array.shape[1],
+        height=array.shape[0],
+        count=1,
+        dtype=array.dtype,
+        nodata=-9999,
+        crs="EPSG:4326",
+        transform=TRANSFORM,
+        tiled=True,
+    ) as ds:
+        ds.write(array, 1)
+        ds.build_overviews([2, 4, 8], Resampling.nearest)
+
+
+@pytest.fixture
+def raster(tmp_path):
+    array = np.full((512, 512), -9999, dtype="int16")
+    # Edges that don't fall on the pixels the overviews sample
+    array[7:251, 13:301] = 1
+    path = str(tmp_path / "raster.tif")
+    write_raster(path, array)
+    valid = unary_union(
+        [
+            shape(geometry)
+            for geometry, value in shapes((array != -9999).astype("uint8"), transform=TRANSFORM)
+            if value
+        ]
+    )
+    return path, valid
+
+
+def test_get_valid_mask():
+    assert get_valid_mask(np.array([1, -9999]), -9999).tolist() == [True, False]
+    assert get_valid_mask(np.array([1.0, np.nan]), np.nan).tolist() == [True, False]
+    assert get_valid_mask(np.array([1, 0]), None).tolist() == [True, False]
+
+
+def test_footprint_covers_the_full_resolution_valid_data(raster):
+    path, valid = raster
+    mask, grid = read_overview_mask(path, max_size=64)
+    assert mask.shape == (64, 64)
+    for method in (ValidDataMethod.thorough, ValidDataMethod.filled):
+        footprint = get_footprint(mask, grid, method)
+        assert footprint.buffer(1e-9).contains(valid)
+        # Within the raster and not grown much beyond the valid data
+        assert box(-30, 34.88, -24.88, 40).buffer(1e-9).contains(footprint)
+        assert valid.buffer(3 * 0.08).contains(footprint)
+
+
+def test_footprint_cache(tmp_path, raster):
+    path, _ = raster
+    cache_dir = str(tmp_path / "cache")
+    with mock.patch.object(footprints, "get_footprint", wraps=get_footprint) as compute:
+        footprint = FootprintCache(cache_dir).get_footprint(
+            "wapor_soil_moisture", path, ValidDataMethod.thorough
+        )
+        # Another cache sharing the directory, e.g. another worker, reuses the polygon
+        cached = FootprintCache(cache_dir).get_footprint(
+            "wapor_soil_moisture", path, ValidDataMethod.thorough
+        )
+    assert compute.call_count == 1
+    assert cached.equals(footprint)
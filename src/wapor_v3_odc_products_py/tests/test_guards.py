@@ -0,0 +1,62 @@
+import time
+from unittest import mock
+
+import numpy as np
+import pytest
+import rasterio
+from eodatasets3.images import ValidDataMethod
+
+from wapor_v3_odc_products_py.guards import (
+    ResourceGuard,
+    ResourceLimitExceeded,
+    estimate_read_bytes,
+)
+from wapor_v3_odc_products_py.stac import create_stac_file_with_guard
+
+
+def test_resource_guard_report():
+    with ResourceGuard("item") as guard:
+        array = np.ones((1024, 1024, 16), dtype="uint8")
+        array.sum()
+    assert guard.exceeded is None
+    assert guard.report["name"] == "item"
+    assert guard.report["traced_peak_mb"] >= 16
+
+
+def test_resource_guard_time_limit():
+    with pytest.raises(ResourceLimitExceeded):
+        with ResourceGuard("item", max_seconds=0.05) as guard:
+            for _ in range(100):
+                time.sleep(0.01)
+    assert guard.report["exceeded"] == "time"
+
+
+def test_estimate_read_bytes(tmp_path):
+    path = str(tmp_path / "raster.tif")
+    with rasterio.open(
+        path, "w", driver="GTiff", width=200, height=100, count=1, dtype="int16"
+    ) as ds:
+        ds.write(np.zeros((100, 200), dtype="int16"), 1)
+    assert estimate_read_bytes(path) == 100 * 200 * 3
+
+
+def test_large_reads_use_bounds_up_front():
+    with (
+        mock.patch("wapor_v3_odc_products_py.stac.estimate_read_bytes", return_value=2**40),
+        mock.patch("wapor_v3_odc_products_py.stac.create_stac_file") as create_stac_file,
+    ):
+        report = create_stac_file_with_guard(
+            "raster.tif", valid_data_method=ValidDataMethod.thorough, max_memory_mb=1024
+        )
+        create_stac_file.assert_called_once_with(
+            geotiff="raster.tif", valid_data_method=ValidDataMethod.bounds
+        )
+        assert report["status"] == "fallback"
+
+        with pytest.raises(ResourceLimitExceeded):
+            create_stac_file_with_guard(
+                "raster.tif",
+                valid_data_method=ValidDataMethod.thorough,
+                max_memory_mb=1024,
+                on_limit="abort",
+            )
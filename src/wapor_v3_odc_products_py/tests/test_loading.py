@@ -0,0 +1,102 @@
+from unittest import mock
+
+import numpy as np
+import pytest
+import xarray as xr
+from affine import Affine
+from datacube.api.core import _calculate_chunk_sizes
+from odc.geo.geobox import GeoBox
+
+from wapor_v3_odc_products_py.loading import (
+    align_to_blocks,
+    get_dask_chunks,
+    get_spatial_dims,
+    load_product,
+    select_overview_factor,
+)
+
+TRANSFORM = Affine(0.01, 0.0, -30.0, 0.0, -0.01, 40.0)
+
+
+def test_select_overview_factor():
+    assert select_overview_factor(0.01, 0.01, [2, 4, 8]) == 1
+    assert select_overview_factor(0.01, 0.03, [2, 4, 8]) == 2
+    assert select_overview_factor(0.01, 0.04, [2, 4, 8]) == 4
+    assert select_overview_factor(0.01, -0.5, [2, 4, 8]) == 8
+    assert select_overview_factor(0.01, 0.5, []) == 1
+
+
+def test_get_dask_chunks():
+    # 2 blocks of 512 x 512 int16 per side in 4 MB
+    assert get_dask_chunks((512, 512), "int16", 4 * 1024 * 1024) == {
+        "time": 1,
+        "y": 1024,
+        "x": 1024,
+    }
+    # At least one block even if it is larger than the target size
+    assert get_dask_chunks((512, 512), "float64", 1024) == {"time": 1, "y": 512, "x": 512}
+
+
+def test_align_to_blocks():
+    # Blocks of 256 pixels are 2.56 degrees
+    x, y = align_to_blocks((-29.0, -24.0), (38.0, 36.0), TRANSFORM, (256, 256))
+    assert x == pytest.approx((-30.0, -22.32))
+    assert y == pytest.approx((34.88, 40.0))
+    # Blocks of the overview with factor 2 are twice as large
+    x, y = align_to_blocks((-29.0, -24.0), (38.0, 36.0), TRANSFORM, (256, 256), factor=2)
+    assert x == pytest.approx((-30.0, -19.76))
+    assert y == pytest.approx((34.88, 40.0))
+
+
+def test_load_product_keeps_the_requested_resolution():
+    profile = {
+        "crs": "EPSG:4326",
+        "res_x": 0.01,
+        "transform": TRANSFORM,
+        "block_shape": (256, 256),
+        "overview_factors": [2, 4],
+        "dtype": "int16",
+    }
+    dc = mock.Mock()
+    with mock.patch(
+        "wapor_v3_odc_products_py.loading.get_product_storage_profile", return_value=profile
+    ):
+        load_product(dc, "wapor_soil_moisture", x=(-29, -27), y=(36, 38), resolution=0.03)
+        assert dc.load.call_args.kwargs["resolution"] == (-0.03, 0.03)
+
+        load_product(
+            dc,
+            "wapor_soil_moisture",
+            x=(-29, -27),
+            y=(36, 38),
+            resolution=0.03,
+            snap_to_overview=True,
+        )
+        assert dc.load.call_args.kwargs["resolution"] == (-0.02, 0.02)
+
+
+@pytest.mark.parametrize("crs", ["EPSG:4326", "EPSG:6933"])
+def test_load_product_chunks_match_the_geobox_dimensions(crs):
+    profile = {
+        "crs": crs,
+        "res_x": 0.01,
+        "transform": TRANSFORM,
+        "block_shape": (256, 256),
+        "overview_factors": [],
+        "dtype": "int16",
+    }
+    dc = mock.Mock()
+    with mock.patch(
+        "wapor_v3_odc_products_py.loading.get_product_storage_profile", return_value=profile
+    ):
+        load_product(dc, "wapor_soil_moisture", x=(-29, -27), y=(36, 38))
+    dask_chunks = dc.load.call_args.kwargs["dask_chunks"]
+
+    geobox = GeoBox.from_bbox((-30, 30, -20, 40), crs, resolution=0.01)
+    assert get_spatial_dims(crs) == geobox.dimensions
+    # Raises a KeyError for chunks of dimensions the loaded data doesn't have
+    sources = xr.DataArray(np.empty(2, dtype=object), dims=("time",))
+    assert _calculate_chunk_sizes(sources, geobox, dask_chunks) == (
+        (1,),
+        (dask_chunks[geobox.dimensions[0]], dask_chunks[geobox.dimensions[1]]),
+    )
@@ -0,0 +1,93 @@
+import json
+
+import yaml
+from click.testing import CliRunner
+
+from wapor_v3_odc_products_py.merge import get_merged_output_name, merge_shard_outputs
+
+BASE = "https://storage.googleapis.com/fao-gismgr-wapor-3-data/DATA/WAPOR-3/MAPSET/L2-RSM-D"
+TASKS = [f"{BASE}/WAPOR-3.L2-RSM-D.2018-01-D{dekad}.tif" for dekad in (1, 2, 3)]
+
+STORAGE_PARAMETERS = {
+    "crs": "EPSG:4326",
+    "res_x": 0.01,
+    "res_y": -0.01,
+    "align_x": 0.0,
+    "align_y": 0.0,
+    "add_offset": 0.0,
+    "scale_factor": 1.0,
+    "dtype": "int16",
+    "nodata": -9999,
+    "block_x": 512,
+    "block_y": 512,
+    "overview_factors": [2, 4],
+    "compression": "DEFLATE",
+    "predictor": 2,
+    "interleave": "BAND",
+    "is_cog": True,
+}
+
+
+def test_get_merged_output_name():
+    assert get_merged_output_name("/out/test_stac_run_report_shard_0_of_2") == (
+        "test_stac_run_report"
+    )
+    assert get_merged_output_name("test_recommended_product_section_shard_11_of_12.yaml") == (
+        "test_recommended_product_section.yaml"
+    )
+
+
+def test_merge_shard_outputs(tmp_path):
+    storage_parameters = [
+        [{"crs": "EPSG:4326", "dtype": "int16"}],
+        [{"crs": "EPSG:4326", "dtype": "int16"}, {"crs": "EPSG:4326", "dtype": "float32"}],
+    ]
+    failed_tasks = [[TASKS[1]], [TASKS[0], TASKS[1]]]
+    for idx in range(2):
+        with open(tmp_path / f"test_storage_parameters_shard_{idx}_of_2", "w") as file:
+            json.dump(storage_parameters[idx], file)
+        with open(tmp_path / f"test_stac_failed_tasks_shard_{idx}_of_2", "w") as file:
+            json.dump(failed_tasks[idx], file)
+
+    output_dir = tmp_path / "merged"
+    result = CliRunner().invoke(
+        merge_shard_outputs,
+        ["--product-name", "test", "--input-dir", str(tmp_path), "--output-dir", str(output_dir)],
+    )
+    assert result.exit_code == 0, result.output
+
+    with open(output_dir / "test_storage_parameters") as file:
+        assert len(json.load(file)) == 2
+    with open(output_dir / "test_stac_failed_tasks") as file:
+        assert json.load(file) == [TASKS[0], TASKS[1]]
+
+
+def test_merge_shard_outputs_recommends_from_every_shard(tmp_path):
+    # The second shard's rasters use larger blocks, which the first shard doesn't see
+    storage_parameters = [
+        [STORAGE_PARAMETERS],
+        [
+            {**STORAGE_PARAMETERS, "block_x": 1024, "block_y": 1024, "nodata": nodata}
+            for nodata in (-9999, 0)
+        ],
+    ]
+    for idx in range(2):
+        with open(tmp_path / f"test_storage_parameters_shard_{idx}_of_2", "w") as file:
+            json.dump(storage_parameters[idx], file)
+        with open(
+            tmp_path / f"test_recommended_product_section_shard_{idx}_of_2.yaml", "w"
+        ) as file:
+            yaml.safe_dump({"storage": {"chunking": {"longitude": idx}}}, file)
+
+    output_dir = tmp_path / "merged"
+    result = CliRunner().invoke(
+        merge_shard_outputs,
+        ["--product-name", "test", "--input-dir", str(tmp_path), "--output-dir", str(output_dir)],
+    )
+    assert result.exit_code == 0, result.output
+
+    with open(output_dir / "test_recommended_product_section.yaml") as file:
+        product_section = yaml.safe_load(file)
+    assert product_section["load"]["resolution"] == {"longitude": 0.01, "latitude": -0.01}
+    # Five of the most common 1024 pixel blocks fit in a 64 MiB chunk
+    assert product_section["storage"]["chunking"] == {"longitude": 5120, "latitude": 5120}
@@ -0,0 +1,101 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+
+from wapor_v3_odc_products_py import io
+from wapor_v3_odc_products_py.io import (
+    MIRROR_MAP_ENV,
+    get_file_version,
+    get_mirror_map,
+    resolve_mirror_path,
+)
+from wapor_v3_odc_products_py.mirror import (
+    PART_STATE_SUFFIX,
+    PART_SUFFIX,
+    download_file,
+    get_md5_hash,
+    get_mirror_path,
+    get_mirror_prefix,
+    mirror_raster,
+    record_mirror_map,
+)
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source" / "L3" / "raster.tif"
+    path.parent.mkdir(parents=True)
+    path.write_bytes(os.urandom(10_000))
+    return str(path)
+
+
+def test_get_mirror_path():
+    source = "gs://fao-gismgr-wapor-3-data/DATA/WAPOR-3/MAPSET/L3-RSM-D/raster.tif"
+    assert get_mirror_prefix(source, "/data/mirror/") == (
+        "gs://fao-gismgr-wapor-3-data/",
+        "/data/mirror/fao-gismgr-wapor-3-data/",
+    )
+    assert get_mirror_path(source, "s3://bucket/mirror") == (
+        "s3://bucket/mirror/fao-gismgr-wapor-3-data/DATA/WAPOR-3/MAPSET/L3-RSM-D/raster.tif"
+    )
+
+
+def test_mirror_raster_skips_up_to_date(tmp_path, source):
+    mirror_dir = str(tmp_path / "mirror")
+    assert mirror_raster(source, mirror_dir, part_size=3000)
+    with open(get_mirror_path(source, mirror_dir), "rb") as file:
+        assert file.read() == open(source, "rb").read()
+    assert not mirror_raster(source, mirror_dir, part_size=3000)
+
+
+def test_download_file_resumes_and_verifies(tmp_path, source):
+    destination = str(tmp_path / "raster.tif")
+    info = {**LocalFileSystem().info(source), "md5Hash": get_md5_hash(source)}
+    download_file(source, destination, info, part_size=3000, max_workers=2)
+
+    # Interrupted after the first of the four parts
+    os.rename(destination, f"{destination}{PART_SUFFIX}")
+    with open(f"{destination}{PART_SUFFIX}", "r+b") as file:
+        file.seek(3000)
+        file.write(bytes(7000))
+    with open(f"{destination}{PART_STATE_SUFFIX}", "w") as file:
+        json.dump({"version": get_file_version(info), "size": 10_000, "parts": [0]}, file)
+
+    with mock.patch.object(
+        LocalFileSystem, "cat_file", autospec=True, side_effect=LocalFileSystem.cat_file
+    ) as cat_file:
+        download_file(source, destination, info, part_size=3000, max_workers=2)
+    assert sorted(call.kwargs["start"] for call in cat_file.call_args_list) == [3000, 6000, 9000]
+    assert get_md5_hash(destination) == info["md5Hash"]
+    assert not os.path.exists(f"{destination}{PART_STATE_SUFFIX}")
+
+    with pytest.raises(ValueError):
+        download_file(source, destination, {**info, "md5Hash": "bad"}, 3000, 2)
+    assert not os.path.exists(f"{destination}{PART_SUFFIX}")
+
+
+def test_resolve_mirror_path(tmp_path, source, monkeypatch):
+    mirror_dir = str(tmp_path / "mirror")
+    map_file = str(tmp_path / "mirror_map.json")
+    record_mirror_map(map_file, dict([get_mirror_prefix(source, mirror_dir)]))
+    monkeypatch.setenv(MIRROR_MAP_ENV, map_file)
+    get_mirror_map.cache_clear()
+    try:
+        # Not mirrored yet, so read from the source
+        assert resolve_mirror_path(source) == source
+        mirror_raster(source, mirror_dir)
+
+        # The missing mirror is trusted until it is checked again
+        assert resolve_mirror_path(source) == source
+        monkeypatch.setattr(io, "MIRROR_CHECK_TTL_SECONDS", 0)
+        assert resolve_mirror_path(source) == get_mirror_path(source, mirror_dir)
+        assert resolve_mirror_path("gs://other/raster.tif") == "gs://other/raster.tif"
+
+        # Republished since it was mirrored, so the mirror is out of date
+        os.utime(source, (0, 0))
+        assert resolve_mirror_path(source) == source
+    finally:
+        get_mirror_map.cache_clear()
@@ -0,0 +1,20 @@
+import numpy as np
+
+from wapor_v3_odc_products_py.overview_statistics import get_array_statistics
+
+
+def test_get_array_statistics():
+    array = np.array([[-9999, 0, 50], [100, -9999, -9999]], dtype="int16")
+    statistics = get_array_statistics(array, nodata=-9999, scale=0.01, percentiles=(50,))
+    assert statistics == {
+        "wapor:valid_fraction": 0.5,
+        "wapor:min": 0.0,
+        "wapor:max": 1.0,
+        "wapor:mean": 0.5,
+        "wapor:p50": 0.5,
+    }
+
+
+def test_get_array_statistics_no_valid_pixels():
+    array = np.full((2, 2), np.nan, dtype="float32")
+    assert get_array_statistics(array, nodata=None) == {"wapor:valid_fraction": 0.0}
@@ -0,0 +1,84 @@
+import os
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import pytest
+from eodatasets3.images import ValidDataMethod
+
+from wapor_v3_odc_products_py import plan, stac
+from wapor_v3_odc_products_py.plan import (
+    estimate_stac_item_cost,
+    get_footprint_level,
+    get_up_to_date_tasks,
+)
+from wapor_v3_odc_products_py.stac import plan_stac_files
+
+LAYOUT = {
+    "header_bytes": 40000,
+    "header_seconds": 0.5,
+    "levels": [
+        {"factor": 1, "shape": [8192, 8192], "tiles": 4096, "bytes": 100_000_000},
+        {"factor": 2, "shape": [4096, 4096], "tiles": 1024, "bytes": 25_000_000},
+        {"factor": 4, "shape": [2048, 2048], "tiles": 256, "bytes": 6_000_000},
+        {"factor": 8, "shape": [1024, 1024], "tiles": 64, "bytes": 1_500_000},
+    ],
+}
+
+
+def test_estimate_stac_item_cost():
+    # A HEAD request and the header read in ceil(40000 / 16384) requests
+    assert estimate_stac_item_cost(LAYOUT, ValidDataMethod.bounds) == {
+        "requests": 4,
+        "bytes_read": 40000,
+    }
+    # The finest overview at most 2048 pixels across is read for the footprint
+    assert get_footprint_level(LAYOUT)["factor"] == 4
+    assert estimate_stac_item_cost(LAYOUT, ValidDataMethod.filled) == {
+        "requests": 4 + 256,
+        "bytes_read": 40000 + 6_000_000,
+    }
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    written = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    for task_id in ["WAPOR-3.L2-RSM-D.2020-01-D1", "WAPOR-3.L2-RSM-D.2020-01-D2"]:
+        path = tmp_path / f"{task_id}.stac-item.json"
+        path.write_text("{}")
+        os.utime(path, (written.timestamp(), written.timestamp()))
+    return str(tmp_path), written
+
+
+def test_get_up_to_date_tasks(outputs):
+    output_dir, written = outputs
+    base = "https://storage.googleapis.com/fao-gismgr-wapor-3-data/DATA/WAPOR-3/MAPSET/L2-RSM-D"
+    tasks = [f"{base}/WAPOR-3.L2-RSM-D.2020-01-D{dekad}.tif" for dekad in (1, 2, 3)]
+    last_modified = {
+        # Republished after its stac item was written
+        tasks[0]: written + timedelta(days=1),
+        tasks[1]: written - timedelta(days=1),
+        tasks[2]: written - timedelta(days=1),
+    }
+    with mock.patch.object(plan, "get_last_modified", side_effect=last_modified.get) as head:
+        assert get_up_to_date_tasks(tasks, output_dir, ".stac-item.json") == [tasks[1]]
+    # Only the rasters with an output are checked
+    assert head.call_count == 2
+
+    assert get_up_to_date_tasks(tasks, os.path.join(output_dir, "missing"), ".json") == []
+
+
+def test_plan_stac_files_reads_no_header_without_tasks(outputs):
+    output_dir, written = outputs
+    # An empty shard, and a shard whose rasters are all up to date
+    for geotiffs in ([], ["WAPOR-3.L2-RSM-D.2020-01-D1.tif"]):
+        with (
+            mock.patch.object(plan, "get_last_modified", return_value=written),
+            mock.patch.object(stac, "get_file_layout") as get_file_layout,
+        ):
+            stac_plan = plan_stac_files(
+                "wapor_soil_moisture", geotiffs, output_dir, skip_up_to_date=True
+            )
+        get_file_layout.assert_not_called()
+        assert stac_plan["tasks"] == []
+        assert stac_plan["skipped"] == geotiffs
+        assert stac_plan["estimates"]["remote_requests"] == 0
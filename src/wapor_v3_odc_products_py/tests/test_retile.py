@@ -0,0 +1,115 @@
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pytest
+import rasterio
+from click.testing import CliRunner
+from rasterio.transform import from_origin
+
+from wapor_v3_odc_products_py import retile
+from wapor_v3_odc_products_py.retile import get_tile_windows, retile_raster
+
+PRODUCT_YAML = (
+    Path(__file__).parents[3] / "products" / "wapor_soil_moisture_africa.odc-product.yaml"
+)
+TRANSFORM = from_origin(-26, 38, 0.01, 0.01)
+
+
+@pytest.fixture
+def raster(tmp_path):
+    array = np.arange(400 * 600, dtype="int16").reshape(400, 600) % 1000
+    # The bottom left tile has no valid data
+    array[256:, :256] = -9999
+    path = str(tmp_path / "WAPOR-3.L2-RSM-D.2020-01-D1.tif")
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=600,
+        height=400,
+        count=1,
+        dtype="int16",
+        nodata=-9999,
+        crs="EPSG:4326",
+        transform=TRANSFORM,
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+    ) as ds:
+        ds.write(array, 1)
+        ds.scales = (0.001,)
+    return path, array
+
+
+def test_get_tile_windows():
+    tiles = get_tile_windows(TRANSFORM, (400, 600), (-26, 34, -20, 38), 256)
+    assert [tile_index for tile_index, _ in tiles] == [
+        "x000y000",
+        "x001y000",
+        "x002y000",
+        "x000y001",
+        "x001y001",
+        "x002y001",
+    ]
+    # Tiles at the edges are cut to the raster
+    assert tiles[-1][1].width == 600 - 512 and tiles[-1][1].height == 400 - 256
+
+    # Only the tiles intersecting the extent
+    tiles = get_tile_windows(TRANSFORM, (400, 600), (-23, 35, -21, 36), 256)
+    assert [tile_index for tile_index, _ in tiles] == ["x001y000", "x001y001"]
+
+
+def test_retile_raster(tmp_path, raster):
+    path, array = raster
+    output_dir = str(tmp_path / "tiles")
+    tiles = get_tile_windows(TRANSFORM, array.shape, (-26, 34, -20, 38), 256)
+
+    processed = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    with (
+        mock.patch.object(retile, "get_source_last_modified", return_value=processed),
+        mock.patch.object(retile, "open_raster", wraps=retile.open_raster) as open_raster,
+    ):
+        tile_paths, failed_tiles = retile_raster(path, tiles, PRODUCT_YAML, output_dir)
+    # The source is opened once, through the block cache, for all of its tiles
+    assert open_raster.call_count == 1
+    assert failed_tiles == []
+    assert len(tile_paths) == len(tiles) - 1
+    assert not os.path.exists(os.path.join(output_dir, "x000y001"))
+
+    for tile_index, window in tiles[:3] + tiles[4:]:
+        tile_path = os.path.join(
+            output_dir, tile_index, f"WAPOR-3.L2-RSM-D.2020-01-D1_{tile_index}.tif"
+        )
+        assert tile_path in tile_paths
+        assert os.path.exists(tile_path.replace(".tif", ".stac-item.json"))
+        with rasterio.open(tile_path) as ds:
+            # On the tile grid of the source, with the pixel values kept
+            assert ds.transform == rasterio.windows.transform(window, TRANSFORM)
+            assert ds.scales == (0.001,)
+            np.testing.assert_array_equal(ds.read(1), array[window.toslices()])
+
+
+def test_retile_empty_tasks_file(tmp_path):
+    tasks_file = tmp_path / "tasks.json"
+    tasks_file.write_text(json.dumps([]))
+    output_dir = tmp_path / "tiles"
+    result = CliRunner().invoke(
+        retile.retile,
+        [
+            "--product-name",
+            "wapor_soil_moisture",
+            "--product-yaml",
+            str(PRODUCT_YAML),
+            "--output-dir",
+            str(output_dir),
+            "--tasks-file",
+            str(tasks_file),
+        ],
+    )
+    # Nothing to re-tile, rather than an IndexError on the first raster
+    assert result.exit_code == 0, result.output
+    assert not output_dir.exists()
@@ -0,0 +1,61 @@
+from unittest import mock
+
+import pytest
+
+from wapor_v3_odc_products_py.service import IngestionService, get_queue
+
+
+@pytest.fixture(params=["directory", "sqlite"])
+def queue(request, tmp_path):
+    if request.param == "sqlite":
+        return get_queue(f"sqlite:///{tmp_path / 'queue.db'}")
+    return get_queue(str(tmp_path / "queue"))
+
+
+def test_queue_claims_in_order(queue):
+    for item in ["a.tif", "b.tif", "c.tif"]:
+        queue.put(item)
+
+    receipt_a, item_a = queue.get()
+    receipt_b, item_b = queue.get()
+    assert (item_a, item_b) == ("a.tif", "b.tif")
+    queue.ack(receipt_a)
+    queue.fail(receipt_b)
+
+    receipt_c, item_c = queue.get()
+    assert item_c == "c.tif"
+    assert queue.get() is None
+    # An item claimed by a worker that stopped is returned to the queue
+    assert queue.requeue() == 1
+    assert queue.get()[1] == "c.tif"
+
+
+def test_service_drains_queue(queue, tmp_path):
+    queue.put("gs://bucket/L2-RSM-D/WAPOR-3.L2-RSM-D.2020-01-D1.tif")
+    queue.put("L2-RSM-D")
+    queue.put("not-a-raster")
+
+    rasters = ["gs://bucket/L2-RSM-D/WAPOR-3.L2-RSM-D.2020-01-D2.tif"]
+    with (
+        mock.patch("wapor_v3_odc_products_py.service.create_stac_file") as create_stac_file,
+        mock.patch("wapor_v3_odc_products_py.service.index_dataset_doc") as index_dataset_doc,
+        mock.patch("wapor_v3_odc_products_py.service.get_catalogue_listing"),
+        mock.patch("wapor_v3_odc_products_py.service.get_indexed_datasets"),
+        mock.patch(
+            "wapor_v3_odc_products_py.service.diff_catalogue_and_index",
+            return_value=(rasters, [], []),
+        ),
+    ):
+        service = IngestionService(
+            queue,
+            "wapor_soil_moisture",
+            tmp_path / "product.yaml",
+            tmp_path,
+            dc=mock.Mock(),
+        )
+        service.run(max_workers=2, exit_when_empty=True)
+
+    # The mapset queues its new raster, which is processed in the same run
+    assert create_stac_file.call_count == index_dataset_doc.call_count == 2
+    assert (service.processed, service.failed) == (3, 1)
+    assert queue.get() is None
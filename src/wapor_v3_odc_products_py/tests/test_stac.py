@@ -0,0 +1,40 @@
+import os
+import pickle
+from concurrent.futures.process import BrokenProcessPool
+
+from wapor_v3_odc_products_py.stac import (
+    StacWorkSpec,
+    create_stac_items_in_processes,
+    map_in_processes,
+)
+from wapor_v3_odc_products_py.writes import ChangedWriter
+
+
+def square_or_die(item: int) -> int:
+    if item == 3:
+        # As when the kernel kills a worker for using too much memory
+        os._exit(1)
+    return item * item
+
+
+def test_stac_work_spec_is_compact_and_picklable():
+    spec = StacWorkSpec("gs://bucket/L2-RSM-D/WAPOR-3.L2-RSM-D.2020-01-D2.tif", {"a": 1.0})
+    assert not hasattr(spec, "__dict__")
+    assert spec.code == "WAPOR-3.L2-RSM-D.2020-01-D2"
+    assert spec.period == "2020-01-D2"
+
+    unpickled = pickle.loads(pickle.dumps(spec))
+    assert unpickled.path == spec.path
+    assert unpickled.statistics == {"a": 1.0}
+    assert unpickled.header is None
+
+
+def test_map_in_processes_fails_only_the_item_killing_its_worker():
+    results = dict(map_in_processes(square_or_die, list(range(6)), processes=2))
+    assert sorted(results) == list(range(6))
+    assert isinstance(results.pop(3), BrokenProcessPool)
+    assert results == {i: i * i for i in results}
+
+
+def test_create_stac_items_in_processes_without_specs():
+    assert create_stac_items_in_processes([], 2, None, ChangedWriter()) == []
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+
+from wapor_v3_odc_products_py.storage_parameters import (
+    get_recommended_product_section,
+    is_cog,
+    summarise_layouts,
+)
+
+STORAGE_PARAMETERS = {
+    "crs": "EPSG:4326",
+    "res_x": 0.01,
+    "res_y": -0.01,
+    "align_x": 0.0,
+    "align_y": 0.0,
+    "add_offset": 0.0,
+    "scale_factor": 1.0,
+    "dtype": "int16",
+    "nodata": -9999,
+    "block_x": 512,
+    "block_y": 512,
+    "overview_factors": [2, 4],
+    "compression": "DEFLATE",
+    "predictor": 2,
+    "interleave": "BAND",
+    "is_cog": True,
+}
+
+
+def write_raster(path, size, overviews=False, **profile):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=size,
+        height=size,
+        count=1,
+        dtype="uint8",
+        crs="EPSG:4326",
+        transform=from_origin(0, size, 1, 1),
+        **profile,
+    ) as ds:
+        ds.write(np.ones((size, size), "uint8"), 1)
+        if overviews:
+            ds.build_overviews([2, 4], Resampling.nearest)
+
+
+@pytest.mark.parametrize(
+    "size, overviews, profile, expected",
+    [
+        (256, True, {"tiled": True, "blockxsize": 64, "blockysize": 64}, True),
+        # Tiled without the overviews it needs
+        (256, False, {"tiled": True, "blockxsize": 64, "blockysize": 64}, False),
+        # Fits in a single block, so doesn't need overviews
+        (64, False, {"tiled": True, "blockxsize": 64, "blockysize": 64}, True),
+        (256, True, {"tiled": False}, False),
+    ],
+)
+def test_is_cog(tmp_path, size, overviews, profile, expected):
+    path = str(tmp_path / "raster.tif")
+    write_raster(path, size, overviews, **profile)
+    with rasterio.open(path) as ds:
+        assert is_cog(ds) == expected
+
+
+def test_summarise_layouts():
+    large_blocks = {**STORAGE_PARAMETERS, "block_x": 1024, "block_y": 1024}
+    # Rasters differing only outside their layout share a layout
+    other_nodata = {**STORAGE_PARAMETERS, "nodata": 0}
+    layouts = summarise_layouts([large_blocks, STORAGE_PARAMETERS, other_nodata])
+    assert [(layout["block_x"], count) for layout, count in layouts] == [(512, 2), (1024, 1)]
+    assert set(layouts[0][0]) == {
+        "block_x",
+        "block_y",
+        "overview_factors",
+        "compression",
+        "predictor",
+        "interleave",
+        "is_cog",
+    }
+
+
+def test_get_recommended_product_section():
+    product_section = get_recommended_product_section(
+        [STORAGE_PARAMETERS, {**STORAGE_PARAMETERS, "block_x": 256, "block_y": 256}] * 2
+        + [STORAGE_PARAMETERS]
+    )
+    assert product_section["load"] == {
+        "crs": "EPSG:4326",
+        "resolution": {"longitude": 0.01, "latitude": -0.01},
+        "align": {"longitude": 0.0, "latitude": 0.0},
+    }
+    # Eleven of the most common 512 pixel int16 blocks fit in a 64 MiB chunk
+    assert product_section["storage"]["chunking"] == {"longitude": 5632, "latitude": 5632}
+    assert product_section["storage"]["tile_size"] == pytest.approx(
+        {"longitude": 56.32, "latitude": 56.32}
+    )
+
+    projected = {**STORAGE_PARAMETERS, "crs": "EPSG:3857", "res_x": 100.0, "res_y": -100.0}
+    assert set(get_recommended_product_section([projected])["load"]["resolution"]) == {"x", "y"}
+
+    with pytest.raises(ValueError, match="2 different grids"):
+        get_recommended_product_section([STORAGE_PARAMETERS, {**STORAGE_PARAMETERS, "res_x": 0.1}])
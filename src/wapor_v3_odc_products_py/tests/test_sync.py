@@ -0,0 +1,57 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from wapor_v3_odc_products_py.prepare_wapor_soil_moisture_metadata import get_dataset_id
+from wapor_v3_odc_products_py.sync import check_archive, diff_catalogue_and_index
+
+PRODUCT = "wapor_soil_moisture"
+BASE = "gs://fao-gismgr-wapor-3-data/DATA/WAPOR-3/MAPSET/L2-RSM-D"
+
+
+def test_diff_catalogue_and_index():
+    modified = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    catalogue = {
+        f"WAPOR-3.L2-RSM-D.2018-01-D{dekad}": (
+            f"{BASE}/WAPOR-3.L2-RSM-D.2018-01-D{dekad}.tif",
+            modified,
+        )
+        for dekad in (1, 2, 3)
+    }
+    removed_id = get_dataset_id("WAPOR-3.L2-RSM-D.2017-12-D3", PRODUCT)
+    indexed = {
+        # Processed after the raster was modified
+        get_dataset_id("WAPOR-3.L2-RSM-D.2018-01-D1", PRODUCT): datetime(2024, 2, 1),
+        # Processed before the raster was modified
+        get_dataset_id("WAPOR-3.L2-RSM-D.2018-01-D2", PRODUCT): datetime(2023, 12, 1),
+        removed_id: datetime(2023, 12, 1),
+    }
+    new, changed, removed = diff_catalogue_and_index(catalogue, indexed, PRODUCT)
+    assert new == [f"{BASE}/WAPOR-3.L2-RSM-D.2018-01-D3.tif"]
+    assert changed == [f"{BASE}/WAPOR-3.L2-RSM-D.2018-01-D2.tif"]
+    assert removed == [removed_id]
+
+
+def test_diff_catalogue_and_index_ignores_sub_second_modified_times():
+    catalogue = {
+        "WAPOR-3.L2-RSM-D.2018-01-D1": (
+            f"{BASE}/WAPOR-3.L2-RSM-D.2018-01-D1.tif",
+            # gcsfs `updated` has milliseconds, the Last-Modified header doesn't
+            datetime(2024, 1, 1, 0, 0, 0, 734000, tzinfo=timezone.utc),
+        )
+    }
+    indexed = {
+        get_dataset_id("WAPOR-3.L2-RSM-D.2018-01-D1", PRODUCT): datetime(
+            2024, 1, 1, tzinfo=timezone.utc
+        )
+    }
+    assert diff_catalogue_and_index(catalogue, indexed, PRODUCT) == ([], [], [])
+
+
+def test_check_archive():
+    check_archive(catalogue_size=95, indexed_size=100, removed_size=5, force=False)
+    check_archive(catalogue_size=0, indexed_size=100, removed_size=100, force=True)
+    with pytest.raises(RuntimeError, match="empty"):
+        check_archive(catalogue_size=0, indexed_size=100, removed_size=100, force=False)
+    with pytest.raises(RuntimeError, match="50 of 100"):
+        check_archive(catalogue_size=50, indexed_size=100, removed_size=50, force=False)
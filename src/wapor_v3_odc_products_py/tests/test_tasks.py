@@ -0,0 +1,48 @@
+import pytest
+
+from wapor_v3_odc_products_py.tasks import (
+    get_shard_tasks,
+    parse_shard,
+    split_tasks,
+)
+
+BASE = "https://storage.googleapis.com/fao-gismgr-wapor-3-data/DATA/WAPOR-3/MAPSET/L2-RSM-D"
+TASKS = [
+    f"{BASE}/WAPOR-3.L2-RSM-D.{year}-{month:02d}-D{dekad}.tif"
+    for year in (2018, 2019)
+    for month in range(1, 13)
+    for dekad in (1, 2, 3)
+]
+
+
+@pytest.mark.parametrize("shard,expected", [("0/1", (0, 1)), ("3/4", (3, 4))])
+def test_parse_shard(shard, expected):
+    assert parse_shard(shard) == expected
+
+
+@pytest.mark.parametrize("shard", ["4/4", "-1/4", "1/0", "1", "a/b"])
+def test_parse_shard_fail(shard):
+    with pytest.raises(ValueError):
+        parse_shard(shard)
+
+
+@pytest.mark.parametrize("partition_method", ["time", "hash"])
+def test_split_tasks_covers_all_tasks(partition_method):
+    chunks = split_tasks(TASKS, 5, partition_method)
+    assert len(chunks) == 5
+    assert sorted(task for chunk in chunks for task in chunk) == sorted(TASKS)
+
+
+def test_split_tasks_time_is_contiguous_and_balanced():
+    chunks = split_tasks(list(reversed(TASKS)), 5, "time")
+    assert [len(chunk) for chunk in chunks] == [15, 15, 14, 14, 14]
+    assert [task for chunk in chunks for task in chunk] == TASKS
+
+
+def test_split_tasks_hash_is_stable():
+    # Adding rasters to the mapset does not move existing rasters between shards
+    new_tasks = [f"{BASE}/WAPOR-3.L2-RSM-D.2020-01-D{dekad}.tif" for dekad in (1, 2, 3)]
+    for idx in range(3):
+        shard = f"{idx}/3"
+        old_shard_tasks = get_shard_tasks(TASKS, shard, "hash")
+        assert set(old_shard_tasks) <= set(get_shard_tasks(TASKS + new_tasks, shard, "hash"))
@@ -0,0 +1,83 @@
+import pytest
+import requests
+
+from wapor_v3_odc_products_py import throttle
+from wapor_v3_odc_products_py.throttle import (
+    AdaptiveConcurrency,
+    call_throttled,
+    get_host,
+    is_throttling_error,
+)
+
+
+def throttled_error(status_code: int = 429) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(throttle.time, "sleep", lambda seconds: None)
+
+
+@pytest.mark.parametrize(
+    "path,expected",
+    [
+        ("https://storage.googleapis.com/bucket/key.tif", "storage.googleapis.com"),
+        ("gs://bucket/key.tif", "gs://bucket"),
+        ("s3://bucket/key.json", "s3://bucket"),
+        ("/tmp/key.json", None),
+    ],
+)
+def test_get_host(path, expected):
+    assert get_host(path) == expected
+
+
+def test_adaptive_concurrency_aimd():
+    concurrency = AdaptiveConcurrency(initial=8, minimum=1, maximum=10)
+    for _ in range(100):
+        concurrency.acquire()
+        concurrency.release(latency=0.1)
+    assert concurrency.limit == 10
+
+    concurrency.acquire()
+    concurrency.release(latency=0.1, throttled=True)
+    assert concurrency.limit == 5
+
+    # A latency spike is treated like throttling
+    concurrency.acquire()
+    concurrency.release(latency=10)
+    assert concurrency.limit == 2.5
+
+
+def test_call_throttled_retries_throttling():
+    calls = []
+
+    def request():
+        calls.append(1)
+        if len(calls) < 3:
+            raise throttled_error(429)
+        return "ok"
+
+    assert call_throttled("test.example.com", request) == "ok"
+    assert len(calls) == 3
+    assert throttle.get_host_throttle("test.example.com").concurrency.limit < 8
+
+
+def test_call_throttled_raises_other_errors():
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise throttled_error(404)
+
+    with pytest.raises(requests.HTTPError):
+        call_throttled("other.example.com", request)
+    assert len(calls) == 1
+
+
+def test_is_throttling_error_s3():
+    error = Exception()
+    error.response = {"Error": {"Code": "SlowDown"}, "ResponseMetadata": {"HTTPStatusCode": 503}}
+    assert is_throttling_error(error)
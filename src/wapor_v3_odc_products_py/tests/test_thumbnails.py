@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from wapor_v3_odc_products_py.thumbnails import apply_colour_ramp, read_thumbnail_array
+
+
+def test_apply_colour_ramp():
+    values = np.array([[0.0, 1.0, 0.5]], dtype="float32")
+    mask = np.array([[True, True, False]])
+    rgba = apply_colour_ramp(values, mask)
+    assert rgba.shape == (4, 1, 3)
+    assert tuple(rgba[:3, 0, 0]) == (140, 81, 10)
+    assert tuple(rgba[:3, 0, 1]) == (1, 102, 94)
+    assert tuple(rgba[3, 0]) == (255, 255, 0)
+
+
+def test_read_thumbnail_array_requires_overviews(tmp_path):
+    path = str(tmp_path / "no_overviews.tif")
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=64,
+        height=32,
+        count=1,
+        dtype="int16",
+        nodata=-9999,
+        crs="EPSG:4326",
+        transform=from_origin(0, 32, 1, 1),
+    ) as ds:
+        ds.write(np.full((32, 64), 500, dtype="int16"), 1)
+        ds.scales = (0.001,)
+
+    values, mask = read_thumbnail_array(path, size=32)
+    assert values.shape == (16, 32)
+    np.testing.assert_allclose(values, 0.5)
+    assert mask.all()
+
+    with pytest.raises(ValueError):
+        read_thumbnail_array(path, size=8)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from wapor_v3_odc_products_py.virtual_zarr import (
+    open_virtual_dataset,
+    read_layouts,
+    scan_cog,
+    write_references,
+)
+
+
+@pytest.fixture
+def rasters(tmp_path):
+    paths = []
+    for dekad in (2, 1):
+        path = str(tmp_path / f"WAPOR-3.L2-RSM-D.2018-01-D{dekad}.tif")
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            width=96,
+            height=80,
+            count=1,
+            dtype="int16",
+            nodata=-9999,
+            crs="EPSG:4326",
+            transform=from_origin(-30, 40, 0.1, 0.1),
+            tiled=True,
+            blockxsize=32,
+            blockysize=32,
+            compress="deflate",
+            predictor=2,
+        ) as ds:
+            ds.write(np.arange(80 * 96, dtype="int16").reshape(80, 96) * dekad, 1)
+        paths.append(path)
+    return paths
+
+
+def test_scan_cog_tile_offsets(rasters):
+    layout = scan_cog(rasters[0])
+    assert layout["tile_shape"] == [32, 32]
+    # 3 tiles across and 3 down, the last row of tiles partial
+    assert len(layout["offsets"]) == 9
+    with rasterio.open(rasters[0]) as ds:
+        for tile_index, (offset, bytecount) in enumerate(
+            zip(layout["offsets"], layout["bytecounts"])
+        ):
+            row, col = divmod(tile_index, 3)
+            assert offset == int(ds.get_tag_item(f"BLOCK_OFFSET_{col}_{row}", "TIFF", bidx=1))
+            assert bytecount == int(ds.get_tag_item(f"BLOCK_SIZE_{col}_{row}", "TIFF", bidx=1))
+
+
+def test_write_and_read_references(tmp_path, rasters):
+    reference_dir = str(tmp_path / "references")
+    layouts = [scan_cog(raster) for raster in rasters]
+    write_references(reference_dir, "relative_soil_moisture", layouts)
+
+    read = read_layouts(reference_dir, "relative_soil_moisture")
+    # Stacked by time
+    assert [layout["raster"] for layout in read] == rasters[::-1]
+    for layout in layouts:
+        match = next(i for i in read if i["raster"] == layout["raster"])
+        assert list(match["offsets"]) == layout["offsets"]
+        assert list(match["bytecounts"]) == layout["bytecounts"]
+        assert match["time"] == layout["time"]
+
+    ds = open_virtual_dataset(reference_dir, remote_protocol="file", mask_and_scale=False)
+    for time_index, raster in enumerate(rasters[::-1]):
+        with rasterio.open(raster) as src:
+            np.testing.assert_array_equal(
+                ds["relative_soil_moisture"][time_index].values, src.read(1)
+            )
@@ -0,0 +1,44 @@
+from unittest import mock
+
+from wapor_v3_odc_products_py.writes import (
+    MANIFEST_NAME,
+    BufferedWriter,
+    ChangedWriter,
+    get_content_hash,
+    get_json_bytes,
+)
+
+
+def test_json_bytes_are_canonical():
+    assert get_json_bytes({"b": 1, "a": {"d": 2, "c": 3}}) == get_json_bytes(
+        {"a": {"c": 3, "d": 2}, "b": 1}
+    )
+
+
+def test_changed_writer_skips_unchanged_files(tmp_path):
+    path = tmp_path / "item.stac-item.json"
+    writer = ChangedWriter()
+    assert writer.write(path, b"first")
+    assert not writer.write(path, b"first")
+    assert writer.write(path, b"second")
+    writer.save_manifests()
+    assert writer.report == {"written": 2, "unchanged": 1}
+    assert (tmp_path / MANIFEST_NAME).exists()
+
+    # A later run trusts the manifest without reading the file
+    with mock.patch(
+        "wapor_v3_odc_products_py.writes.get_content_hash", wraps=get_content_hash
+    ) as content_hash:
+        assert not ChangedWriter().write(path, b"second")
+    assert content_hash.call_count == 1
+
+    # A file changed outside of the writer is detected and rewritten
+    path.write_bytes(b"edited")
+    assert ChangedWriter().write(path, b"second")
+    assert path.read_bytes() == b"second"
+
+
+def test_buffered_writer_keeps_files():
+    writer = BufferedWriter()
+    assert writer.write("out/item.stac-item.json", b"{}", "application/json")
+    assert writer.files == [("out/item.stac-item.json", b"{}", "application/json")]
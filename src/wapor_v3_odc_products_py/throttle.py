@@ -0,0 +1,275 @@
+import logging
+import random
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+
+from wapor_v3_odc_products_py.logs import get_logger
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Maximum sustained requests per second for each host, other hosts use DEFAULT_RATE_LIMIT
+HOST_RATE_LIMITS = {
+    "data.apps.fao.org": 10,
+    "storage.googleapis.com": 200,
+}
+DEFAULT_RATE_LIMIT = 100
+
+# Bounds of the number of concurrent requests to a single host
+INITIAL_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+
+# HTTP status codes and S3 error codes returned when a request is throttled
+THROTTLING_STATUS_CODES = {429, 503}
+THROTTLING_ERROR_CODES = {
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+}
+
+REQUEST_TIMEOUT = 60
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate of requests, refilled at `rate` tokens
+    per second up to `capacity` tokens to allow short bursts.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """
+    Additive increase, multiplicative decrease (AIMD) limit on the number of
+    concurrent requests.
+
+    The limit grows by about one for every `limit` successful requests and is
+    multiplied by `decrease_factor` when a request is throttled or its latency
+    is more than `latency_spike_factor` times the moving average latency.
+    """
+
+    def __init__(
+        self,
+        initial: int = INITIAL_CONCURRENCY,
+        minimum: int = MIN_CONCURRENCY,
+        maximum: int = MAX_CONCURRENCY,
+        decrease_factor: float = 0.5,
+        latency_spike_factor: float = 3.0,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.latency_spike_factor = latency_spike_factor
+        self.average_latency = None
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Block until the number of requests in flight is below the limit."""
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency: float = None, throttled: bool = False):
+        """Release a request slot and adapt the limit to the outcome of the request."""
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self._decrease()
+            elif latency is not None:
+                if (
+                    self.average_latency is not None
+                    and latency > self.latency_spike_factor * self.average_latency
+                ):
+                    self._decrease()
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                if self.average_latency is None:
+                    self.average_latency = latency
+                else:
+                    self.average_latency = 0.9 * self.average_latency + 0.1 * latency
+            self._condition.notify_all()
+
+    def _decrease(self):
+        self.limit = max(self.minimum, self.limit * self.decrease_factor)
+
+
+class HostThrottle:
+    """Rate and concurrency limits shared by all the requests to a host."""
+
+    def __init__(self, rate: float):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = AdaptiveConcurrency()
+
+
+_host_throttles = {}
+_host_throttles_lock = threading.Lock()
+_sessions = threading.local()
+
+
+def get_host(path: str) -> str | None:
+    """
+    Get the host a path is served from: the network location of a URL or the bucket
+    of an object store path. Local paths have no host.
+    """
+    loc = urlparse(str(path))
+    if loc.scheme in ("http", "https"):
+        return loc.netloc
+    elif loc.scheme in ("s3", "gs", "gcs"):
+        return f"{loc.scheme}://{loc.netloc}"
+    return None
+
+
+def get_host_throttle(host: str) -> HostThrottle:
+    """Get the throttle shared by all the requests to a host."""
+    with _host_throttles_lock:
+        if host not in _host_throttles:
+            _host_throttles[host] = HostThrottle(HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+        return _host_throttles[host]
+
+
+def get_session() -> requests.Session:
+    """Get a requests session for the current thread, reusing its connection pool."""
+    if not hasattr(_sessions, "session"):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Check if an error from requests or botocore is due to throttling."""
+    response = getattr(error, "response", None)
+    if isinstance(response, requests.Response):
+        return response.status_code in THROTTLING_STATUS_CODES
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+        status_code = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return code in THROTTLING_ERROR_CODES or status_code in THROTTLING_STATUS_CODES
+    return False
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Check if an error is worth retrying i.e. a throttling, server or connection error."""
+    if is_throttling_error(error):
+        return True
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    if isinstance(response, requests.Response):
+        return response.status_code >= 500
+    if isinstance(response, dict):
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+    return False
+
+
+def get_retry_after(error: Exception) -> float:
+    """Get the delay in seconds requested by a server in the Retry-After header, if any."""
+    response = getattr(error, "response", None)
+    if isinstance(response, requests.Response):
+        try:
+            return float(response.headers.get("Retry-After", 0))
+        except ValueError:
+            return 0
+    return 0
+
+
+def call_throttled(
+    host: str | None,
+    func,
+    *args,
+    max_retries: int = 5,
+    base_delay: float = 0.5,
+    max_delay: float = 30,
+    **kwargs,
+):
+    """
+    Call a function making a request to a host, within the rate and concurrency
+    limits of the host, retrying throttled and transient failures with full
+    jitter exponential backoff.
+
+    Parameters
+    ----------
+    host : str | None
+        Host the request is made to, from `get_host`. If None the function is
+        called directly.
+    func : callable
+        Function making the request.
+    max_retries : int
+        Maximum number of retries before the error is raised.
+    base_delay : float
+        Upper bound in seconds of the delay before the first retry, doubled for
+        every retry.
+    max_delay : float
+        Maximum upper bound in seconds of the delay before a retry.
+    *args, **kwargs
+        Arguments passed to `func`.
+    """
+    if host is None:
+        return func(*args, **kwargs)
+
+    throttle = get_host_throttle(host)
+    for attempt in range(max_retries + 1):
+        throttle.bucket.acquire()
+        throttle.concurrency.acquire()
+        start = time.monotonic()
+        throttled = False
+        try:
+            return func(*args, **kwargs)
+        except Exception as error:
+            throttled = is_throttling_error(error)
+            if attempt == max_retries or not is_transient_error(error):
+                raise
+            delay = max(
+                random.uniform(0, min(max_delay, base_delay * 2**attempt)),
+                get_retry_after(error),
+            )
+            logger.warning(
+                f"Request to {host} failed with {error!r}, retrying in {delay:.2f}s "
+                f"({attempt + 1}/{max_retries})"
+            )
+        finally:
+            throttle.concurrency.release(time.monotonic() - start, throttled)
+        time.sleep(delay)
+
+
+def throttled_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Make an HTTP request within the rate and concurrency limits of the URL's host.
+    Throttled (429, 503) and server error responses are retried.
+    """
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+
+    def request():
+        response = get_session().request(method, url, **kwargs)
+        if response.status_code in THROTTLING_STATUS_CODES or response.status_code >= 500:
+            response.raise_for_status()
+        return response
+
+    return call_throttled(get_host(url), request)
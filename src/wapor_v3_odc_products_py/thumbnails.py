@@ -0,0 +1,161 @@
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+
+from wapor_v3_odc_products_py.block_cache import open_raster
+from wapor_v3_odc_products_py.footprints import get_valid_mask
+from wapor_v3_odc_products_py.io import get_filesystem, is_gcsfs_path, is_s3_path
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.tasks import get_task_id
+from wapor_v3_odc_products_py.throttle import call_throttled, get_host
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+THUMBNAIL_FORMATS = {"png": "PNG", "jpeg": "JPEG"}
+
+# Size in pixels of the longest side of the thumbnails
+THUMBNAIL_SIZE = 512
+
+# Colour ramp of scaled relative soil moisture from dry to wet, as (value, RGB) stops
+SOIL_MOISTURE_COLOUR_RAMP = [
+    (0.0, (140, 81, 10)),
+    (0.25, (216, 179, 101)),
+    (0.5, (246, 232, 195)),
+    (0.75, (90, 180, 172)),
+    (1.0, (1, 102, 94)),
+]
+
+
+def read_thumbnail_array(
+    file_path: str | Path, size: int = THUMBNAIL_SIZE
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Read the first band of a raster at thumbnail size from the smallest COG overview
+    with at least that many pixels, without reading the full resolution image.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The scaled pixel values and the valid data mask of the thumbnail.
+    """
+    with open_raster(file_path) as ds:
+        height, width = ds.shape
+        decimation = max(max(height, width) / size, 1)
+        # Without overviews GDAL would decimate the full resolution image
+        if decimation > 2 and not ds.overviews(1):
+            raise ValueError(f"{file_path} has no overviews to read a thumbnail from")
+        out_shape = (max(math.ceil(height / decimation), 1), max(math.ceil(width / decimation), 1))
+        # GDAL reads from the smallest overview at least as large as out_shape
+        array = ds.read(1, out_shape=out_shape, resampling=Resampling.nearest)
+        nodata, scale, offset = ds.nodata, ds.scales[0], ds.offsets[0]
+
+    mask = get_valid_mask(array, nodata)
+    return array.astype("float32") * scale + offset, mask
+
+
+def apply_colour_ramp(
+    values: np.ndarray, mask: np.ndarray, colour_ramp: list = SOIL_MOISTURE_COLOUR_RAMP
+) -> np.ndarray:
+    """
+    Colour values with a linear colour ramp.
+
+    Returns
+    -------
+    np.ndarray
+        RGBA array of shape (4, height, width), transparent where the mask is False.
+    """
+    stops = [stop for stop, _ in colour_ramp]
+    rgba = np.zeros((4, *values.shape), dtype="uint8")
+    for band in range(3):
+        band_colours = [colour[band] for _, colour in colour_ramp]
+        rgba[band] = np.interp(values, stops, band_colours).round().astype("uint8")
+    rgba[3] = np.where(mask, 255, 0)
+    rgba[:3, ~mask] = 0
+    return rgba
+
+
+def encode_image(rgba: np.ndarray, thumbnail_format: str = "png") -> bytes:
+    """Encode an RGBA array as a PNG, or an RGB JPEG with nodata in black."""
+    driver = THUMBNAIL_FORMATS[thumbnail_format]
+    bands = rgba if driver == "PNG" else rgba[:3]
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver=driver,
+            width=bands.shape[2],
+            height=bands.shape[1],
+            count=bands.shape[0],
+            dtype="uint8",
+        ) as ds:
+            ds.write(bands)
+        return memfile.read()
+
+
+def get_thumbnail_path(raster: str, output_dir: str, thumbnail_format: str = "png") -> str:
+    """Get the path a raster's thumbnail is written to."""
+    extension = "jpg" if thumbnail_format == "jpeg" else thumbnail_format
+    return os.path.join(str(output_dir), f"{get_task_id(raster)}.thumbnail.{extension}")
+
+
+def write_thumbnail(
+    raster: str,
+    output_dir: str,
+    thumbnail_format: str = "png",
+    size: int = THUMBNAIL_SIZE,
+) -> str:
+    """
+    Write a colour ramped thumbnail of a raster, read from a COG overview, to a local
+    directory or S3.
+
+    :return: The path of the thumbnail.
+    """
+    values, mask = read_thumbnail_array(raster, size)
+    data = encode_image(apply_colour_ramp(values, mask), thumbnail_format)
+
+    thumbnail_path = get_thumbnail_path(raster, output_dir, thumbnail_format)
+    fs = get_filesystem(path=thumbnail_path, anon=False)
+    if not is_s3_path(thumbnail_path) and not is_gcsfs_path(thumbnail_path):
+        fs.mkdirs(os.path.dirname(thumbnail_path), exist_ok=True)
+
+    def write():
+        with fs.open(thumbnail_path, "wb") as file:
+            file.write(data)
+
+    call_throttled(get_host(thumbnail_path), write)
+    return thumbnail_path
+
+
+def write_thumbnails(
+    rasters: list[str],
+    output_dir: str,
+    thumbnail_format: str = "png",
+    size: int = THUMBNAIL_SIZE,
+    max_workers: int = 8,
+) -> dict[str, str]:
+    """
+    Write the thumbnails of rasters in parallel. Rasters whose thumbnail fails to be
+    written are logged and left out of the result.
+
+    Returns
+    -------
+    dict[str, str]
+        The path of the thumbnail of each raster, by raster.
+    """
+
+    def get_thumbnail(raster: str) -> str | None:
+        try:
+            return write_thumbnail(raster, output_dir, thumbnail_format, size)
+        except Exception as error:
+            logger.error(f"Failed to write the thumbnail of {raster}: {error}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(get_thumbnail, rasters)
+        thumbnails = {raster: result for raster, result in zip(rasters, results) if result}
+    logger.info(f"Wrote the thumbnails of {len(thumbnails)}/{len(rasters)} rasters")
+    return thumbnails
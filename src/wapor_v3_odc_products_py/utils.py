@@ -1,5 +1,6 @@
 import calendar
 import collections
+import json
 import logging
 import os
 from datetime import datetime
@@ -7,16 +8,20 @@ from email.utils import parsedate_to_datetime
 from pathlib import Path
 
 import pandas as pd
-import requests
 from dateutil.relativedelta import relativedelta
 
+from wapor_v3_odc_products_py.catalogue import CatalogueListing, get_catalogue_listing
 from wapor_v3_odc_products_py.logs import get_logger
-from wapor_v3_odc_products_py.io import is_gcsfs_path, is_url
+from wapor_v3_odc_products_py.io import check_file_exists, is_gcsfs_path, is_url
+from wapor_v3_odc_products_py.throttle import throttled_request
 
 logger = get_logger(Path(__file__).stem, level=logging.INFO)
 
 BASE_URL = "https://data.apps.fao.org/gismgr/api/v2/catalog/workspaces/WAPOR-3/mapsets"
 
+# WaPOR v3 mapset code for each product the repository prepares metadata for
+PRODUCT_MAPSET_CODES = {"wapor_soil_moisture": "L2-RSM-D"}
+
 
 def get_WaPORv3_info(url: str) -> pd.DataFrame:
     """
@@ -37,7 +42,7 @@ def get_WaPORv3_info(url: str) -> pd.DataFrame:
     output_dict = collections.defaultdict(list)
     while "next" in [x["rel"] for x in data["links"]]:
         url_ = [x["href"] for x in data["links"] if x["rel"] == "next"][0]
-        response = requests.get(url_)
+        response = throttled_request("GET", url_)
         response.raise_for_status()
         data = response.json()["response"]
         for item in data["items"]:
@@ -55,15 +60,59 @@ def get_WaPORv3_info(url: str) -> pd.DataFrame:
     return output_df
 
 
-def get_mapset_rasters(wapor_v3_mapset_code: str) -> list[str]:
+def get_mapset_listing(wapor_v3_mapset_code: str, listing_path: str = None) -> CatalogueListing:
+    """
+    Get the code and download URL of the rasters of a mapset, sorted by code.
+
+    Parameters
+    ----------
+    wapor_v3_mapset_code : str
+        Code of the WaPOR v3 mapset
+    listing_path : str
+        Optional `.npy` file of a saved listing. The listing is loaded from it if it exists,
+        otherwise it is fetched from the catalogue and saved to it.
+
+    Returns
+    -------
+    CatalogueListing
+        The listing of the rasters of the mapset.
+    """
+    if listing_path and check_file_exists(listing_path):
+        listing = CatalogueListing.load(listing_path)
+        logger.info(f"Loaded the listing of the mapset {wapor_v3_mapset_code} from {listing_path}")
+        return listing
+
     wapor_v3_mapset_url = os.path.join(BASE_URL, wapor_v3_mapset_code, "rasters")
-    wapor_v3_mapset_rasters = get_WaPORv3_info(wapor_v3_mapset_url)["downloadUrl"].to_list()
+    listing = get_catalogue_listing(wapor_v3_mapset_url, ("code", "downloadUrl")).sort("code")
+    if listing_path:
+        listing.save(listing_path)
+    return listing
+
+
+def get_mapset_rasters(wapor_v3_mapset_code: str, listing_path: str = None) -> list[str]:
+    wapor_v3_mapset_rasters = get_mapset_listing(wapor_v3_mapset_code, listing_path).get_column(
+        "downloadUrl"
+    )
     logger.info(
         f"Found {len(wapor_v3_mapset_rasters)} rasters for the mapset {wapor_v3_mapset_code}"
     )
     return wapor_v3_mapset_rasters
 
 
+def get_mapset_code(product_name: str) -> str:
+    """Get the WaPOR v3 mapset code for a product name."""
+    try:
+        return PRODUCT_MAPSET_CODES[product_name]
+    except KeyError:
+        raise NotImplementedError(f"No WaPOR v3 mapset has been configured for {product_name}")
+
+
+def get_unique_dicts(dicts: list[dict]) -> list[dict]:
+    """Get the unique dictionaries in a list of JSON serialisable dictionaries."""
+    # Convert dicts to JSON strings to create a unique set
+    return [json.loads(s) for s in sorted({json.dumps(d, sort_keys=True) for d in dicts})]
+
+
 def get_dekad(year: str | int, month: str | int, dekad_label: str) -> tuple:
     """
     Get the end date of the dekad that a date belongs to and the time range
@@ -116,13 +165,13 @@ def get_dekad(year: str | int, month: str | int, dekad_label: str) -> tuple:
 
 
 def get_last_modified(file_path: str):
-    """Returns the Last-Modified timestamp 
+    """Returns the Last-Modified timestamp
     of a given URL if available."""
     if is_gcsfs_path(file_path):
         url = file_path.replace("gs://", "https://storage.googleapis.com/")
     else:
         url = file_path
-    response = requests.head(url, allow_redirects=True)
+    response = throttled_request("HEAD", url, allow_redirects=True)
     last_modified = response.headers.get("Last-Modified")
     if last_modified:
         return parsedate_to_datetime(last_modified)
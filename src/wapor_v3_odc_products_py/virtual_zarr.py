@@ -0,0 +1,470 @@
+import base64
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timezone
+from pathlib import Path
+
+import click
+import imagecodecs.numcodecs
+import numpy as np
+import pandas as pd
+import tifffile
+import xarray as xr
+from fsspec.implementations.reference import LazyReferenceMapper
+from rasterio.crs import CRS
+
+from wapor_v3_odc_products_py.block_cache import open_file
+from wapor_v3_odc_products_py.io import check_file_exists, get_filesystem
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.tasks import get_product_tasks, get_task_id
+from wapor_v3_odc_products_py.utils import get_dekad
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Block size used when reading the TIFF headers, the tile offsets and byte counts
+# of a large COG span several hundred kilobytes.
+HEADER_BLOCK_SIZE = 256 * 1024
+
+# Number of chunk references in each parquet file of the references
+RECORD_SIZE = 100_000
+
+# Numcodecs compressor config for each supported TIFF compression.
+TIFF_COMPRESSORS = {
+    tifffile.COMPRESSION.NONE: None,
+    tifffile.COMPRESSION.LZW: {"id": "imagecodecs_lzw"},
+    tifffile.COMPRESSION.ADOBE_DEFLATE: {"id": "imagecodecs_zlib"},
+    tifffile.COMPRESSION.DEFLATE: {"id": "imagecodecs_zlib"},
+    tifffile.COMPRESSION.ZSTD: {"id": "imagecodecs_zstd"},
+}
+
+# Numcodecs filter id for each supported TIFF predictor.
+TIFF_PREDICTORS = {
+    tifffile.PREDICTOR.NONE: None,
+    tifffile.PREDICTOR.HORIZONTAL: "imagecodecs_delta",
+    tifffile.PREDICTOR.FLOATINGPOINT: "imagecodecs_floatpred",
+}
+
+
+def get_raster_time(raster: str) -> int:
+    """Get the datetime of the dekad of a WaPOR v3 raster, in seconds since the epoch."""
+    year, month, dekad_label = get_task_id(raster).split(".")[-1].split("-")
+    input_datetime, _ = get_dekad(year, month, dekad_label)
+    return int(input_datetime.replace(tzinfo=timezone.utc).timestamp())
+
+
+def scan_cog(raster: str) -> dict:
+    """
+    Read the layout of a single band tiled GeoTIFF and the byte range of each
+    of its full resolution tiles from the TIFF header, without reading any pixels.
+
+    Parameters
+    ----------
+    raster : str
+        File path or URI of the GeoTIFF.
+
+    Returns
+    -------
+    dict
+        The grid, tile shape, codecs and nodata of the raster and, for each
+        tile in row major order, its offset and byte count.
+    """
+    with open_file(raster, block_size=HEADER_BLOCK_SIZE) as file:
+        with tifffile.TiffFile(file) as tif:
+            page = tif.pages[0]
+            if not page.is_tiled or page.samplesperpixel != 1:
+                raise NotImplementedError(
+                    f"Only single band tiled GeoTIFFs are supported: {raster}"
+                )
+            if page.compression not in TIFF_COMPRESSORS:
+                raise NotImplementedError(f"Unsupported compression {page.compression!r}: {raster}")
+            if page.predictor not in TIFF_PREDICTORS:
+                raise NotImplementedError(f"Unsupported predictor {page.predictor!r}: {raster}")
+
+            geotiff_metadata = tif.geotiff_metadata
+            scale_x, scale_y = geotiff_metadata["ModelPixelScale"][:2]
+            tie_i, tie_j, _, tie_x, tie_y = geotiff_metadata["ModelTiepoint"][:5]
+            epsg = geotiff_metadata.get(
+                "ProjectedCSTypeGeoKey", geotiff_metadata.get("GeographicTypeGeoKey")
+            )
+
+            gdal_nodata = page.tags.get("GDAL_NODATA")
+            nodata = float(gdal_nodata.value.strip("\x00")) if gdal_nodata else None
+
+            scale_factor, add_offset = None, None
+            gdal_metadata = page.tags.get("GDAL_METADATA")
+            if gdal_metadata:
+                scale = re.search(r'role="scale">([^<]+)<', gdal_metadata.value)
+                offset = re.search(r'role="offset">([^<]+)<', gdal_metadata.value)
+                scale_factor = float(scale.group(1)) if scale else None
+                add_offset = float(offset.group(1)) if offset else None
+
+            layout = {
+                "raster": raster,
+                "time": get_raster_time(raster),
+                "shape": list(page.shape),
+                "tile_shape": [page.tilelength, page.tilewidth],
+                "dtype": page.dtype.newbyteorder(tif.byteorder).str,
+                "compressor": TIFF_COMPRESSORS[page.compression],
+                "predictor": TIFF_PREDICTORS[page.predictor],
+                "nodata": nodata,
+                "scale_factor": scale_factor,
+                "add_offset": add_offset,
+                "crs": int(epsg),
+                "transform": [
+                    scale_x,
+                    0.0,
+                    tie_x - tie_i * scale_x,
+                    0.0,
+                    -scale_y,
+                    tie_y + tie_j * scale_y,
+                ],
+                "offsets": [int(i) for i in page.dataoffsets],
+                "bytecounts": [int(i) for i in page.databytecounts],
+            }
+    return layout
+
+
+def get_layout_key(layout: dict) -> tuple:
+    """Get the parts of a raster's layout that must match to stack rasters along time."""
+    return tuple(
+        json.dumps(layout[k])
+        for k in ["shape", "tile_shape", "dtype", "compressor", "predictor", "crs", "transform"]
+    )
+
+
+def inline(array: np.ndarray) -> str:
+    """Encode an array as an inline reference for an uncompressed zarr chunk."""
+    return "base64:" + base64.b64encode(array.tobytes()).decode("ascii")
+
+
+def zarray(shape: list, chunks: list, dtype: str, **kwargs) -> str:
+    metadata = {
+        "zarr_format": 2,
+        "shape": shape,
+        "chunks": chunks,
+        "dtype": dtype,
+        "compressor": None,
+        "filters": None,
+        "fill_value": None,
+        "order": "C",
+    }
+    metadata.update(kwargs)
+    return json.dumps(metadata)
+
+
+def get_metadata_references(measurement: str, layouts: list[dict]) -> dict:
+    """
+    Build the kerchunk references of the zarr metadata and the coordinates of a
+    virtual zarr dataset stacking the rasters along time.
+
+    Parameters
+    ----------
+    measurement : str
+        Name of the data variable.
+    layouts : list[dict]
+        Layouts of the rasters from `scan_cog`, all with the same grid and codecs,
+        sorted by time.
+
+    Returns
+    -------
+    dict
+        The references of every key but the chunks of the data variable.
+    """
+    first = layouts[0]
+    for layout in layouts[1:]:
+        if get_layout_key(layout) != get_layout_key(first):
+            raise ValueError(f"The layout of {layout['raster']} does not match {first['raster']}")
+
+    height, width = first["shape"]
+    tile_height, tile_width = first["tile_shape"]
+    a, _, c, _, e, f = first["transform"]
+    nodata = first["nodata"]
+    if nodata is None:
+        fill_value = None
+    elif np.isnan(nodata):
+        fill_value = "NaN"
+    else:
+        fill_value = int(nodata) if nodata == int(nodata) else nodata
+
+    filters = None
+    if first["predictor"] is not None:
+        filters = [
+            {"id": first["predictor"], "shape": first["tile_shape"], "dtype": first["dtype"]}
+        ]
+
+    data_attrs = {"_ARRAY_DIMENSIONS": ["time", "y", "x"], "grid_mapping": "spatial_ref"}
+    if first["scale_factor"] is not None:
+        data_attrs["scale_factor"] = first["scale_factor"]
+    if first["add_offset"] is not None:
+        data_attrs["add_offset"] = first["add_offset"]
+
+    return {
+        ".zgroup": json.dumps({"zarr_format": 2}),
+        ".zattrs": json.dumps({"rasters": [layout["raster"] for layout in layouts]}),
+        f"{measurement}/.zarray": zarray(
+            shape=[len(layouts), height, width],
+            chunks=[1, tile_height, tile_width],
+            dtype=first["dtype"],
+            compressor=first["compressor"],
+            filters=filters,
+            fill_value=fill_value,
+        ),
+        f"{measurement}/.zattrs": json.dumps(data_attrs),
+        "time/.zarray": zarray(shape=[len(layouts)], chunks=[len(layouts)], dtype="<i8"),
+        "time/.zattrs": json.dumps(
+            {
+                "_ARRAY_DIMENSIONS": ["time"],
+                "units": "seconds since 1970-01-01 00:00:00",
+                "calendar": "proleptic_gregorian",
+            }
+        ),
+        "time/0": inline(np.array([layout["time"] for layout in layouts], dtype="<i8")),
+        "x/.zarray": zarray(shape=[width], chunks=[width], dtype="<f8"),
+        "x/.zattrs": json.dumps({"_ARRAY_DIMENSIONS": ["x"]}),
+        "x/0": inline((c + a * (np.arange(width) + 0.5)).astype("<f8")),
+        "y/.zarray": zarray(shape=[height], chunks=[height], dtype="<f8"),
+        "y/.zattrs": json.dumps({"_ARRAY_DIMENSIONS": ["y"]}),
+        "y/0": inline((f + e * (np.arange(height) + 0.5)).astype("<f8")),
+        "spatial_ref/.zarray": zarray(shape=[], chunks=[], dtype="<i8"),
+        "spatial_ref/.zattrs": json.dumps(
+            {
+                "_ARRAY_DIMENSIONS": [],
+                "crs_wkt": CRS.from_epsg(first["crs"]).to_wkt(),
+                "GeoTransform": " ".join(str(i) for i in [c, a, 0.0, f, 0.0, e]),
+            }
+        ),
+        "spatial_ref/0": inline(np.array(0, dtype="<i8")),
+    }
+
+
+def write_references(reference_dir: str, measurement: str, layouts: list[dict]):
+    """
+    Write kerchunk parquet references for a virtual zarr dataset stacking the
+    rasters along time, where each chunk is a byte range of a COG tile.
+
+    The chunk references are streamed to parquet files of RECORD_SIZE references
+    each, so the references of a global mapset are never all held in memory, and
+    are read back lazily by `open_virtual_dataset`.
+
+    Parameters
+    ----------
+    reference_dir : str
+        Directory to write the references to. It is replaced if it exists.
+    measurement : str
+        Name of the data variable.
+    layouts : list[dict]
+        Layouts of the rasters from `scan_cog`, all with the same grid and codecs.
+    """
+    layouts = sorted(layouts, key=lambda layout: layout["time"])
+    metadata = get_metadata_references(measurement, layouts)
+    width = layouts[0]["shape"][1]
+    tiles_across = -(-width // layouts[0]["tile_shape"][1])
+
+    # Write next to the existing references and swap them once complete, so a
+    # failed run doesn't lose the references of the rasters already scanned
+    fs = get_filesystem(path=reference_dir, anon=False)
+    staging_dir = f"{reference_dir.rstrip('/')}.tmp"
+    refs = LazyReferenceMapper.create(staging_dir, fs=fs, record_size=RECORD_SIZE, engine="pyarrow")
+    # The chunk layout of the variables has to be set before their chunks
+    for key, value in metadata.items():
+        refs[key] = value
+    for time_index, layout in enumerate(layouts):
+        for tile_index, (offset, bytecount) in enumerate(
+            zip(layout["offsets"], layout["bytecounts"])
+        ):
+            # Sparse tiles (no data written) are left out and read as the fill value.
+            if bytecount == 0:
+                continue
+            row, col = divmod(tile_index, tiles_across)
+            refs[f"{measurement}/{time_index}.{row}.{col}"] = [
+                layout["raster"],
+                int(offset),
+                int(bytecount),
+            ]
+    refs.flush()
+
+    if fs.exists(reference_dir):
+        fs.rm(reference_dir, recursive=True)
+    fs.mv(staging_dir, reference_dir, recursive=True)
+
+
+def read_layouts(reference_dir: str, measurement: str) -> list[dict]:
+    """
+    Recover the layouts of the rasters in existing references so they can be
+    re-stacked with newly scanned rasters without scanning them again.
+    """
+    fs = get_filesystem(path=reference_dir, anon=False)
+    zmetadata = json.loads(fs.cat_file(f"{reference_dir}/.zmetadata"))
+    record_size = zmetadata["record_size"]
+    refs = zmetadata["metadata"]
+    metadata = refs[f"{measurement}/.zarray"]
+    attrs = refs[f"{measurement}/.zattrs"]
+    spatial_ref = refs["spatial_ref/.zattrs"]
+    rasters = refs[".zattrs"]["rasters"]
+
+    number_of_rasters, height, width = metadata["shape"]
+    _, tile_height, tile_width = metadata["chunks"]
+    number_of_tiles = -(-height // tile_height) * -(-width // tile_width)
+    c, a, _, f, _, e = [float(i) for i in spatial_ref["GeoTransform"].split()]
+
+    # The chunks of the data variable in row major order, as zarr numbers them
+    offsets = np.zeros(number_of_rasters * number_of_tiles, dtype="int64")
+    bytecounts = np.zeros(number_of_rasters * number_of_tiles, dtype="int64")
+    for path in fs.glob(f"{reference_dir}/{measurement}/refs.*.parq"):
+        record = int(path.rsplit("/", 1)[-1].split(".")[1])
+        with fs.open(path, "rb") as file:
+            table = pd.read_parquet(file, columns=["offset", "size"])
+        start = record * record_size
+        end = min(start + len(table), len(offsets))
+        offsets[start:end] = table["offset"].to_numpy()[: end - start]
+        bytecounts[start:end] = table["size"].to_numpy()[: end - start]
+
+    times = LazyReferenceMapper(reference_dir, fs=fs, engine="pyarrow")["time/0"]
+    times = np.frombuffer(times, dtype="<i8")
+
+    fill_value = metadata["fill_value"]
+
+    layouts = []
+    for time_index, raster in enumerate(rasters):
+        tiles = slice(time_index * number_of_tiles, (time_index + 1) * number_of_tiles)
+        layouts.append(
+            {
+                "raster": raster,
+                "time": int(times[time_index]),
+                "shape": [height, width],
+                "tile_shape": [tile_height, tile_width],
+                "dtype": metadata["dtype"],
+                "compressor": metadata["compressor"],
+                "predictor": metadata["filters"][0]["id"] if metadata["filters"] else None,
+                "nodata": None if fill_value is None else float(fill_value),
+                "scale_factor": attrs.get("scale_factor"),
+                "add_offset": attrs.get("add_offset"),
+                "crs": CRS.from_wkt(spatial_ref["crs_wkt"]).to_epsg(),
+                "transform": [a, 0.0, c, 0.0, e, f],
+                "offsets": offsets[tiles],
+                "bytecounts": bytecounts[tiles],
+            }
+        )
+    return layouts
+
+
+def open_virtual_dataset(
+    reference_dir: str, remote_protocol: str = "gs", remote_options: dict = None, **kwargs
+) -> xr.Dataset:
+    """
+    Lazily open the virtual zarr dataset described by parquet references, loading
+    the references of the chunks read only.
+
+    Parameters
+    ----------
+    reference_dir : str
+        Path to the parquet references written by `create-virtual-zarr`.
+    remote_protocol : str
+        Protocol of the referenced rasters e.g. `gs`, `s3` or `file`.
+    remote_options : dict
+        Options for the filesystem of the referenced rasters.
+        Default is anonymous access to public buckets.
+    **kwargs
+        Other arguments passed to `xarray.open_dataset` e.g. `mask_and_scale=False`
+        to keep the stored integer values.
+    """
+    # The TIFF codecs are provided by imagecodecs.
+    imagecodecs.numcodecs.register_codecs(verbose=False)
+    if remote_options is None:
+        remote_options = {"token": "anon"} if remote_protocol in ("gs", "gcs") else {"anon": True}
+    kwargs.setdefault("chunks", {})
+    references = LazyReferenceMapper(
+        reference_dir, fs=get_filesystem(path=reference_dir, anon=False), engine="pyarrow"
+    )
+    return xr.open_dataset(
+        "reference://",
+        engine="zarr",
+        backend_kwargs={
+            "consolidated": False,
+            "zarr_format": 2,
+            "storage_options": {
+                "fo": references,
+                "remote_protocol": remote_protocol,
+                "remote_options": remote_options,
+            },
+        },
+        **kwargs,
+    )
+
+
+@click.command()
+@click.option(
+    "--product-name",
+    help="Name of the product to create the virtual zarr references for",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(),
+    help="Directory to write the parquet references to. If they exist only rasters not in "
+    "them are scanned",
+)
+@click.option(
+    "--measurement",
+    default="relative_soil_moisture",
+    help="Name of the data variable in the virtual zarr dataset",
+)
+@click.option(
+    "--tasks-file",
+    type=click.Path(),
+    default=None,
+    help="File listing the rasters to include, as written by `create-tasks`",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=16,
+    help="Number of raster headers to read concurrently",
+)
+def create_virtual_zarr(
+    product_name: str,
+    output_dir: str,
+    measurement: str,
+    tasks_file: str,
+    max_workers: int,
+):
+    rasters = get_product_tasks(product_name=product_name, tasks_file=tasks_file)
+    # Use a gsutil URI instead of the the public URL
+    rasters = [i.replace("https://storage.googleapis.com/", "gs://") for i in rasters]
+
+    layouts = []
+    if check_file_exists(f"{output_dir}/.zmetadata"):
+        layouts = read_layouts(output_dir, measurement)
+        logger.info(f"Found {len(layouts)} rasters in the existing references {output_dir}")
+
+    indexed_rasters = {layout["raster"] for layout in layouts}
+    new_rasters = [raster for raster in rasters if raster not in indexed_rasters]
+    if not new_rasters:
+        logger.info(f"No new rasters to add to {output_dir}")
+        return
+    logger.info(f"Scanning the headers of {len(new_rasters)} new rasters")
+
+    failed_rasters = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(scan_cog, raster): raster for raster in new_rasters}
+        for future in as_completed(futures):
+            try:
+                layouts.append(future.result())
+            except Exception as error:
+                logger.exception(error)
+                logger.error(f"Failed to scan {futures[future]}")
+                failed_rasters.append(futures[future])
+
+    if failed_rasters:
+        logger.warning(f"{len(failed_rasters)} rasters failed to be scanned and were not added")
+    if not layouts:
+        logger.warning(f"No rasters to write references for to {output_dir}")
+        return
+
+    write_references(output_dir, measurement, layouts)
+    logger.info(f"Wrote references for {len(layouts)} rasters to {output_dir}")
+
+
+if __name__ == "__main__":
+    create_virtual_zarr()
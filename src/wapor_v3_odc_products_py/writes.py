@@ -0,0 +1,166 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+from eodatasets3 import serialise
+from eodatasets3.model import DatasetDoc
+from odc.aws import s3_dump
+
+from wapor_v3_odc_products_py.io import get_filesystem, is_s3_path
+from wapor_v3_odc_products_py.logs import get_logger
+from wapor_v3_odc_products_py.throttle import call_throttled, get_host
+
+logger = get_logger(Path(__file__).stem, level=logging.INFO)
+
+# Manifest of the content hashes of the files written to a local directory
+MANIFEST_NAME = ".content-hashes.json"
+
+
+def get_json_bytes(doc: dict) -> bytes:
+    """Serialise a JSON doc canonically, with sorted keys, so equal docs are equal bytes."""
+    return json.dumps(doc, indent=2, sort_keys=True).encode("utf-8")
+
+
+def get_dataset_doc_bytes(dataset_doc: DatasetDoc) -> bytes:
+    """Serialise a dataset doc as formatted YAML, in eodatasets3's canonical key order."""
+    stream = io.StringIO()
+    serialise.to_stream(stream, dataset_doc)
+    return stream.getvalue().encode("utf-8")
+
+
+def get_content_hash(data: bytes) -> str:
+    """MD5 of the content, which is also the ETag S3 gives an object uploaded in one part."""
+    return hashlib.md5(data).hexdigest()
+
+
+def write_bytes(path: str, data: bytes, content_type: str = None):
+    """Write a file to the local file system or S3."""
+    if is_s3_path(path):
+        call_throttled(
+            get_host(path),
+            s3_dump,
+            data=data,
+            url=path,
+            ACL="bucket-owner-full-control",
+            ContentType=content_type,
+        )
+    else:
+        with open(path, "wb") as file:
+            file.write(data)
+
+
+class ChangedWriter:
+    """
+    Writer of files to local directories or S3 that skips files whose content is
+    unchanged, so re-runs don't rewrite outputs and trigger reindexing.
+
+    The content hashes of the existing files of a directory are read once, the first
+    time a file is written to it: for S3 from the ETags of one listing of the prefix,
+    and for local directories from a manifest of the hashes written by previous runs.
+    Manifest entries are only trusted if the size and modification time of the file
+    still match, otherwise the existing file is hashed.
+    """
+
+    def __init__(self):
+        self.written = 0
+        self.unchanged = 0
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def _get_directory_hashes(self, directory: str) -> dict:
+        if directory in self._hashes:
+            return self._hashes[directory]
+
+        hashes = {}
+        if is_s3_path(directory):
+            fs = get_filesystem(path=directory, anon=False)
+            try:
+                listing = call_throttled(get_host(directory), fs.ls, directory, detail=True)
+            except FileNotFoundError:
+                listing = []
+            for info in listing:
+                etag = str(info.get("ETag", "")).strip('"')
+                # The ETag of a multipart upload is not the MD5 of the content
+                if etag and "-" not in etag:
+                    hashes[os.path.basename(info["name"])] = {"md5": etag}
+        else:
+            manifest_path = os.path.join(directory, MANIFEST_NAME)
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as file:
+                    hashes = json.load(file)
+        self._hashes[directory] = hashes
+        return hashes
+
+    def _get_local_entry(self, path: str, entry: dict | None) -> dict | None:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime_ns:
+            return entry
+        with open(path, "rb") as file:
+            content_hash = get_content_hash(file.read())
+        return {"md5": content_hash, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def write(self, path: str | Path, data: bytes, content_type: str = None) -> bool:
+        """
+        Write a file unless it already exists with the same content.
+
+        :return: Whether the file was written.
+        """
+        path = str(path)
+        directory, name = os.path.dirname(path), os.path.basename(path)
+        content_hash = get_content_hash(data)
+
+        with self._lock:
+            hashes = self._get_directory_hashes(directory)
+            entry = hashes.get(name)
+        if not is_s3_path(path):
+            entry = self._get_local_entry(path, entry)
+
+        if entry is not None and entry["md5"] == content_hash:
+            with self._lock:
+                hashes[name] = entry
+                self.unchanged += 1
+            return False
+
+        write_bytes(path, data, content_type)
+        entry = {"md5": content_hash}
+        if not is_s3_path(path):
+            stat = os.stat(path)
+            entry.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+        with self._lock:
+            hashes[name] = entry
+            self.written += 1
+        return True
+
+    def save_manifests(self):
+        """Save the content hashes of the files in each local directory written to."""
+        with self._lock:
+            for directory, hashes in self._hashes.items():
+                if is_s3_path(directory) or not hashes:
+                    continue
+                with open(os.path.join(directory, MANIFEST_NAME), "w") as file:
+                    json.dump(hashes, file, indent=2, sort_keys=True)
+
+    @property
+    def report(self) -> dict:
+        return {"written": self.written, "unchanged": self.unchanged}
+
+
+class BufferedWriter:
+    """
+    Writer keeping the files written in memory, e.g. in a worker process, so they can
+    be returned to the parent and written there with a ChangedWriter.
+    """
+
+    def __init__(self):
+        self.files = []
+
+    def write(self, path: str | Path, data: bytes, content_type: str = None) -> bool:
+        self.files.append((str(path), data, content_type))
+        return True
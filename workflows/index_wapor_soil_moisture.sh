@@ -3,6 +3,9 @@
 # Directory containing metadata files
 METADATA_DIR="./data/wapor_soil_moisture"
 
+# File recording the months touched by indexing, read by `make refresh-explorer`
+TOUCHED_PERIODS_FILE="./data/explorer_touched_periods.json"
+
 if [[ ! -d "$METADATA_DIR" ]]; then
     echo "Directory $METADATA_DIR does not exist. Exiting."
     exit 1
@@ -10,13 +13,24 @@ fi
 
 # Loop over each file in the metadata directory
 shopt -s nullglob  # Avoids executing loop if no matches
+added_files=()
 for metadata_file in "$METADATA_DIR"/*.stac-item.json; do
   # Check if the file is a regular file
   if [[ -f "$metadata_file" ]]; then
     echo "Adding product from metadata file: $metadata_file"
     # Run the datacube product add command
-    datacube dataset add "$metadata_file"
+    if datacube dataset add "$metadata_file"; then
+      added_files+=("$metadata_file")
+    fi
   else
     echo "Skipping non-regular file: $metadata_file"
   fi
-done
\ No newline at end of file
+done
+
+# Record the months of the added datasets so that their Explorer summaries are refreshed
+if [[ ${#added_files[@]} -gt 0 ]]; then
+  record-touched-periods \
+   --product-name="wapor_soil_moisture" \
+   --touched-periods-file="$TOUCHED_PERIODS_FILE" \
+   "${added_files[@]}"
+fi